@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+
+import os
+import re
+import sys
+import math
+import statistics
+import numpy
+import nibabel
+
+#Stand-ins for the AFNI programs dti_qa_lib calls, for test boxes without
+#AFNI. Each accepts exactly the arguments dti_qa_lib builds (anything else
+#is a fatal error, so a change to a call that the stand-ins do not follow
+#is caught), writes the same files and prints the same output. The
+#numerics are written from the AFNI documentation, independently of
+#dti_qa_native, so the two can be checked against each other (see
+#dti_qa_parity.py). Put this directory first on PATH to use them.
+
+
+def fatal(program, message):
+    sys.stderr.write('** FATAL ERROR ({} stand-in): {}\n'.format(program, message))
+    sys.exit(1)
+
+
+def parse_args(program, args, value_options, flag_options, n_inputs=1):
+    #This function reads '-option value' and '-flag' arguments followed by
+    #n_inputs input datasets, and stops at anything it does not know.
+    values = {}
+    flags = set()
+    position = 0
+    while position < len(args) and args[position].startswith('-'):
+        option = args[position]
+        if option in value_options and position+1 < len(args):
+            values[option] = args[position+1]
+            position += 2
+        elif option in flag_options:
+            flags.add(option)
+            position += 1
+        else:
+            fatal(program, 'unknown or incomplete option: {}'.format(option))
+    inputs = args[position:]
+    if len(inputs) != n_inputs:
+        fatal(program, 'expected {} input dataset(s), got: {}'.format(n_inputs, ' '.join(inputs)))
+    return values, flags, inputs
+
+
+def require(program, values, flags, value_options=(), flag_options=()):
+    missing = [x for x in value_options if x not in values]+[x for x in flag_options if x not in flags]
+    if missing:
+        fatal(program, 'missing option(s): {}'.format(' '.join(missing)))
+
+
+def load(program, dataset):
+    if not os.path.exists(dataset):
+        fatal(program, 'cannot open dataset: {}'.format(dataset))
+    return nibabel.load(dataset)
+
+
+def save(program, data, template_img, prefix):
+    #AFNI will not write over an existing dataset without -overwrite
+    if os.path.exists(prefix):
+        fatal(program, "output dataset name '{}' conflicts with existing file".format(prefix))
+    header = template_img.header.copy()
+    header.set_data_dtype(numpy.float32)
+    header.set_slope_inter(None, None)
+    nibabel.save(nibabel.Nifti1Image(numpy.asarray(data, dtype=numpy.float32), template_img.affine, header), prefix)
+
+
+def load_mask(program, dataset):
+    return numpy.asanyarray(load(program, dataset).dataobj) != 0
+
+
+def run_3dcalc(args):
+    #3dcalc -a dset -b mask -float -prefix out -expr a*b
+    values, flags, inputs = parse_args('3dcalc', args, ['-a', '-b', '-prefix', '-expr'], ['-float'], n_inputs=0)
+    require('3dcalc', values, flags, ['-a', '-b', '-prefix', '-expr'])
+    if values['-expr'] != 'a*b':
+        fatal('3dcalc', 'only -expr a*b is supported: {}'.format(values['-expr']))
+    img = load('3dcalc', values['-a'])
+    data = img.get_fdata(dtype=numpy.float32)
+    mask = numpy.asanyarray(load('3dcalc', values['-b']).dataobj).astype(numpy.float32)
+    if data.ndim == 4:
+        mask = mask[..., None]
+    save('3dcalc', data*mask, img, values['-prefix'])
+
+
+def parse_selector(program, dataset):
+    #dset[a,b,c] or dset[a..b]; '$' is the last volume
+    match = re.match(r'^(.*)\[(.*)\]$', dataset)
+    if match is None:
+        fatal(program, 'expected a sub-brick selector: {}'.format(dataset))
+    filename, selector = match.groups()
+    n_volumes = load(program, filename).shape[3]
+    volume_list = []
+    for part in selector.split(','):
+        part = part.replace('$', str(n_volumes-1))
+        if '..' in part:
+            first, last = part.split('..')
+            volume_list.extend(range(int(first), int(last)+1))
+        else:
+            volume_list.append(int(part))
+    if not volume_list or min(volume_list) < 0 or max(volume_list) >= n_volumes:
+        fatal(program, 'sub-brick selector out of range: {}'.format(selector))
+    return filename, volume_list
+
+
+def run_3dTcat(args):
+    #3dTcat -prefix out dset[selector]; the datum of the input is kept
+    values, flags, inputs = parse_args('3dTcat', args, ['-prefix'], [])
+    require('3dTcat', values, flags, ['-prefix'])
+    filename, volume_list = parse_selector('3dTcat', inputs[0])
+    img = load('3dTcat', filename)
+    prefix = values['-prefix']
+    if os.path.exists(prefix):
+        fatal('3dTcat', "output dataset name '{}' conflicts with existing file".format(prefix))
+    raw_data = numpy.asanyarray(img.dataobj.get_unscaled())[..., volume_list]
+    header = img.header.copy()
+    header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    nibabel.save(nibabel.Nifti1Image(raw_data, img.affine, header), prefix)
+
+
+def run_3dTstat(args):
+    #3dTstat -mean -prefix out dset
+    #3dTstat -tsnr -mask mask -prefix out dset
+    values, flags, inputs = parse_args('3dTstat', args, ['-prefix', '-mask'], ['-mean', '-tsnr'])
+    require('3dTstat', values, flags, ['-prefix'])
+    if len(flags) != 1:
+        fatal('3dTstat', 'expected exactly one of -mean and -tsnr')
+    img = load('3dTstat', inputs[0])
+    data = img.get_fdata(dtype=numpy.float64)
+    if '-mean' in flags:
+        save('3dTstat', data.mean(axis=3), img, values['-prefix'])
+        return
+    require('3dTstat', values, flags, ['-mask'])
+    #-tsnr is fabs(mean)/stdev, not detrended; 0 outside the mask
+    mask = load_mask('3dTstat', values['-mask'])
+    n_volumes = data.shape[3]
+    mean = data.sum(axis=3)/n_volumes
+    stdev = numpy.sqrt(((data-mean[..., None])**2).sum(axis=3)/(n_volumes-1))
+    tsnr = numpy.zeros(mean.shape)
+    good = mask & (stdev > 0)
+    tsnr[good] = numpy.fabs(mean[good])/stdev[good]
+    save('3dTstat', tsnr, img, values['-prefix'])
+
+
+def run_3dToutcount(args):
+    #3dToutcount -mask mask dset; prints the outlier count of each volume.
+    #Each voxel series has its median removed (the default -polort 0); a
+    #point is an outlier when it is further from 0 than
+    #qginv(0.001/N)*sqrt(PI/2)*MAD, MAD being the median absolute value.
+    values, flags, inputs = parse_args('3dToutcount', args, ['-mask'], [])
+    require('3dToutcount', values, flags, ['-mask'])
+    img = load('3dToutcount', inputs[0])
+    mask = load_mask('3dToutcount', values['-mask'])
+    series = img.get_fdata(dtype=numpy.float32)[mask].astype(numpy.float64)
+    n_volumes = series.shape[1]
+    alpha = statistics.NormalDist().inv_cdf(1.0-0.001/n_volumes)*math.sqrt(math.pi/2.0)
+    counts = numpy.zeros(n_volumes, dtype=int)
+    for voxel_series in series:
+        residual = numpy.fabs(voxel_series-numpy.median(voxel_series))
+        mad = numpy.median(residual)
+        if mad > 0:
+            counts += residual > alpha*mad
+    sys.stdout.write(''.join(['{}\n'.format(x) for x in counts]))
+
+
+def _sample(data, coords):
+    #Trilinear interpolation of a 3D array at voxel coordinates (3 x n);
+    #points outside the array get 0
+    floor = numpy.floor(coords).astype(int)
+    fraction = coords-floor
+    values = numpy.zeros(coords.shape[1])
+    for corner in range(8):
+        offset = numpy.array([(corner >> axis) & 1 for axis in range(3)])[:, None]
+        index = floor+offset
+        inside = numpy.all((index >= 0) & (index < numpy.array(data.shape)[:, None]), axis=0)
+        weight = numpy.prod(numpy.where(offset == 1, fraction, 1-fraction), axis=0)
+        values[inside] += weight[inside]*data[tuple(index[:, inside])]
+    return values
+
+
+def _rigid(params, points, center):
+    #Rotate points (mm, 3 x n) about center by angles params[3:] (radians,
+    #x then y then z) and shift them by params[:3] (mm)
+    cx, cy, cz = numpy.cos(params[3:])
+    sx, sy, sz = numpy.sin(params[3:])
+    rx = numpy.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = numpy.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = numpy.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return rz @ ry @ rx @ (points-center)+center+params[:3, None]
+
+
+def run_3dvolreg(args):
+    #3dvolreg -prefix out -float -maxdisp1D file -base base dset
+    #Each volume is registered to the base by least squares over the
+    #base's automask, linearized the way 3dvolreg does it (Cox and
+    #Jesmanowicz 1999): the derivatives of the base with respect to the six
+    #parameters are worked out once from its gradient and the linear
+    #problem is solved again at each step. The volumes are resampled into
+    #the base's grid and written; the maximum displacement of any automask
+    #voxel is written to the -maxdisp1D file.
+    values, flags, inputs = parse_args('3dvolreg', args, ['-prefix', '-maxdisp1D', '-base'], ['-float'])
+    require('3dvolreg', values, flags, ['-prefix', '-maxdisp1D', '-base'], ['-float'])
+    img = load('3dvolreg', inputs[0])
+    data = img.get_fdata(dtype=numpy.float64)
+    base = load('3dvolreg', values['-base']).get_fdata(dtype=numpy.float64)
+    if base.ndim == 4:
+        base = base[..., 0]
+    zooms = numpy.array(img.header.get_zooms()[:3], dtype=numpy.float64)[:, None]
+    #Automask: voxels above half the mean of the positive base voxels
+    automask = base > 0.5*base[base > 0].mean()
+    voxels = numpy.array(numpy.nonzero(automask), dtype=numpy.float64)
+    points = voxels*zooms
+    center = ((numpy.array(base.shape, dtype=numpy.float64)-1)/2.0)[:, None]*zooms
+    base_values = base[automask]
+    all_voxels = numpy.array(numpy.indices(base.shape).reshape(3, -1), dtype=numpy.float64)
+    #Derivatives of the base with respect to shifts (mm) and small rotations (radians) about center
+    gradient = numpy.array([x[automask] for x in numpy.gradient(base, *zooms[:, 0])])
+    arm = points-center
+    jacobian = numpy.array([gradient[0], gradient[1], gradient[2],
+                            gradient[2]*arm[1]-gradient[1]*arm[2],
+                            gradient[0]*arm[2]-gradient[2]*arm[0],
+                            gradient[1]*arm[0]-gradient[0]*arm[1]])
+    normal = jacobian @ jacobian.T
+
+    registered = numpy.zeros(data.shape)
+    maxdisp_list = []
+    for volume in range(data.shape[3]):
+        moving = data[..., volume]
+        params = numpy.zeros(6)
+
+        def residual(trial):
+            return _sample(moving, _rigid(trial, points, center)/zooms)-base_values
+
+        current = residual(params)
+        for iteration in range(30):
+            try:
+                update = -numpy.linalg.solve(normal, jacobian @ current)
+            except numpy.linalg.LinAlgError:
+                break
+            #Halve steps that do not lower the cost
+            for halving in range(6):
+                trial = residual(params+update)
+                if (trial**2).sum() < (current**2).sum():
+                    break
+                update = update/2.0
+            else:
+                break
+            params, current = params+update, trial
+            if numpy.abs(update[:3]).max() < 1e-4 and numpy.abs(update[3:]).max() < 1e-6:
+                break
+        registered[..., volume] = _sample(moving, _rigid(params, all_voxels*zooms, center)/zooms).reshape(base.shape)
+        displacement = _rigid(params, points, center)-points
+        maxdisp_list.append(numpy.sqrt((displacement**2).sum(axis=0)).max())
+
+    save('3dvolreg', registered, img, values['-prefix'])
+    with open(values['-maxdisp1D'], 'w') as fid:
+        fid.write('# 3dvolreg -maxdisp1D\n')
+        fid.write(''.join([' {:g}\n'.format(x) for x in maxdisp_list]))
+
+
+def run_3dROIstats(args):
+    #3dROIstats -nzmean -quiet -nomeanout -nobriklab -mask mask dset
+    #prints, for each volume, a tab and the mean of the nonzero voxels of
+    #each ROI (each nonzero mask value)
+    values, flags, inputs = parse_args('3dROIstats', args, ['-mask'], ['-nzmean', '-quiet', '-nomeanout', '-nobriklab'])
+    require('3dROIstats', values, flags, ['-mask'], ['-nzmean', '-quiet', '-nomeanout', '-nobriklab'])
+    img = load('3dROIstats', inputs[0])
+    data = img.get_fdata(dtype=numpy.float32).astype(numpy.float64)
+    if data.ndim == 3:
+        data = data[..., None]
+    labels = numpy.rint(numpy.asanyarray(load('3dROIstats', values['-mask']).dataobj)).astype(int)
+    for volume in range(data.shape[3]):
+        line = ''
+        for label in sorted(set(labels[labels != 0].tolist())):
+            roi_values = data[..., volume][labels == label]
+            roi_values = roi_values[roi_values != 0]
+            line += '\t{:g}'.format(roi_values.mean() if roi_values.size else 0.0)
+        sys.stdout.write(line+'\n')
+
+
+PROGRAMS = {
+    '3dcalc': run_3dcalc,
+    '3dTcat': run_3dTcat,
+    '3dTstat': run_3dTstat,
+    '3dToutcount': run_3dToutcount,
+    '3dvolreg': run_3dvolreg,
+    '3dROIstats': run_3dROIstats,
+    }
+
+
+def main(program, args):
+    if program not in PROGRAMS:
+        fatal(program, 'no stand-in for this program')
+    PROGRAMS[program](args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
@@ -0,0 +1,125 @@
+import logging
+import collections
+import numpy
+import dti_qa_native as dtan
+
+#Runs the QA on DWI data that are already in memory (NumPy arrays or
+#nibabel images), with the native engine, writing no files. Used from
+#Python, e.g. straight after preprocessing:
+#   import dti_qa_api as dtai
+#   results = dtai.qa_arrays(dwi_data, mask_data, shell_index, zooms=(2, 2, 2))
+#   results['1'].tsnr_mean
+
+
+#Metrics of one shell. outcount_array and maxdisp_array hold the value of
+#each volume of the shell (in the order of volumes), motion_params the
+#motion parameters of each (n x 6: x, y, z shifts in mm and x, y, z
+#rotations in degrees). maxdisp, maxdisp_array and motion_params are None
+#if motion was not estimated, mean_data and tsnr_data unless asked for.
+ShellResult = collections.namedtuple('ShellResult', [
+    'shell', 'volumes', 'outcount_mean', 'outcount_max', 'maxdisp', 'tsnr_mean',
+    'outcount_array', 'maxdisp_array', 'motion_params', 'mean_data', 'tsnr_data'])
+
+
+def _as_data(dti_data):
+    #This function returns what fused_shell_stats should read the DWI data
+    #from: the array itself, the array an in-memory nibabel image holds, or
+    #a file-backed nibabel image (read a volume at a time), and the voxel
+    #size if the image has one.
+    if isinstance(dti_data, numpy.ndarray):
+        return dti_data, None
+    zooms = dti_data.header.get_zooms()[:3]
+    if isinstance(dti_data.dataobj, numpy.ndarray):
+        return dti_data.dataobj, zooms
+    return dti_data, zooms
+
+
+def as_mask(mask_data):
+    #This function returns a mask (array or nibabel image) as booleans.
+    if not isinstance(mask_data, numpy.ndarray):
+        mask_data = numpy.asanyarray(mask_data.dataobj)
+    if mask_data.dtype == bool:
+        return mask_data
+    return mask_data != 0
+
+
+def shell_volume_lists(shell_index):
+    #This function returns a dictionary of each shell label (as a string,
+    #the way qa_the_dti labels shells) to the list of its volumes, from a
+    #sequence with one entry per volume: 0 for b=0 volumes, 1 for the first
+    #shell, 2 for the second, etc.
+    label_list = [str(x) for x in shell_index]
+    if '0' not in label_list:
+        logging.error('ERROR: shell_index did not contain any 0s, suggesting no b=0 volumes! There should be at least one!')
+        raise RuntimeError('shell_index contains no 0s')
+    volume_lists = {}
+    for volume, label in enumerate(label_list):
+        if label != '0':
+            volume_lists.setdefault(label, []).append(volume)
+    return {x: volume_lists[x] for x in sorted(volume_lists.keys())}
+
+
+def qa_arrays(dti_data, mask_data, shell_index, zooms=None, motion=1, keep_images=0):
+    #This function computes the QA metrics of every shell of DWI data that
+    #are already in memory and returns a dictionary of shell label to
+    #ShellResult. dti_data is a 4D array (x, y, z, volume) or a nibabel
+    #image, mask_data a 3D array or nibabel image (nonzero is in) and
+    #shell_index one label per volume (see shell_volume_lists). Arrays are
+    #read through views of their volumes, so the data are never copied or
+    #written to disk. zooms is the voxel size in mm (taken from the header
+    #of a nibabel image); it is needed for the motion estimates, which are
+    #skipped if motion is 0. If keep_images is set, the float32 mean and
+    #TSNR images of each shell are kept in its result.
+    logging.info('-------Starting: qa_arrays-------')
+    data, image_zooms = _as_data(dti_data)
+    if zooms is None:
+        zooms = image_zooms
+    mask = as_mask(mask_data)
+    if len(data.shape) != 4:
+        logging.error('ERROR: dti_data must be 4D, not {}D!'.format(len(data.shape)))
+        raise RuntimeError('qa_arrays: bad dti_data')
+    if tuple(mask.shape) != tuple(data.shape[:3]):
+        logging.error('ERROR: mask shape {} does not match dti_data shape {}!'.format(mask.shape, data.shape))
+        raise RuntimeError('qa_arrays: bad mask_data')
+    if len(shell_index) != data.shape[3]:
+        logging.error('ERROR: shell_index has {} entries for {} volumes!'.format(len(shell_index), data.shape[3]))
+        raise RuntimeError('qa_arrays: bad shell_index')
+    if motion and zooms is None:
+        logging.error('ERROR: zooms must be given to estimate motion from an array!')
+        raise RuntimeError('qa_arrays: zooms not given')
+
+    volume_lists = shell_volume_lists(shell_index)
+    index = dtan.mask_index(mask)
+    fused_stats = dtan.fused_shell_stats(data, volume_lists, mask, index=index)
+
+    results = {}
+    for shell_label, volume_list in volume_lists.items():
+        stats = fused_stats[shell_label]
+        outcount_mean, outcount_max, outcount_array = dtan.outcount(stats['masked_data'])
+        maxdisp = maxdisp_array = params_array = None
+        if motion:
+            if isinstance(data, numpy.ndarray):
+                volume_iter = dtan.iter_array_volumes(data, volume_list)
+            else:
+                volume_iter = dtan.iter_volumes(data, volume_list)
+            params_array, maxdisp_array = dtan.estimate_motion(volume_iter, len(volume_list), data.shape, zooms,
+                                                               stats['mean_data'], mask)
+            maxdisp = float(maxdisp_array.max())
+        results[shell_label] = ShellResult(
+            shell=shell_label,
+            volumes=volume_list,
+            outcount_mean=float(outcount_mean),
+            outcount_max=int(outcount_max),
+            maxdisp=maxdisp,
+            tsnr_mean=stats['tsnr_mean'],
+            outcount_array=outcount_array,
+            maxdisp_array=maxdisp_array,
+            motion_params=params_array,
+            mean_data=stats['mean_data'] if keep_images else None,
+            tsnr_data=stats['tsnr_data'] if keep_images else None,
+            )
+        #Let go of this shell's masked matrix before the next shell
+        del fused_stats[shell_label]
+
+    logging.info('-------Done: qa_arrays-------')
+    return results
@@ -0,0 +1,209 @@
+import os
+import csv
+import logging
+import concurrent.futures
+import dti_qa_lib as dtal
+import dti_qa_results as dtar
+import dti_qa_triage as dtatr
+
+
+#Columns every manifest must have
+MANIFEST_COLUMNS = ['sub', 'dti_image', 'mask_image', 'shell_index_file']
+
+#Columns a manifest may have; a blank entry is the same as none
+OPTIONAL_COLUMNS = ['atlas_image']
+
+
+def read_manifest(manifest_file):
+    #This function reads a CSV or TSV manifest of subjects. The file must
+    #have a header line with at least the columns in MANIFEST_COLUMNS, and
+    #may have those in OPTIONAL_COLUMNS (None where missing or blank).
+    #Relative image paths are taken relative to the manifest's directory.
+    logging.info('-------Starting: read_manifest-------')
+    if not os.path.exists(manifest_file):
+        logging.error('ERROR: manifest_file cannot be found: {}'.format(manifest_file))
+        raise RuntimeError('read_manifest: manifest_file not found!')
+
+    if manifest_file.endswith('.tsv'):
+        delimiter = '\t'
+    else:
+        delimiter = ','
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+
+    with open(manifest_file, 'r', newline='') as fid:
+        reader = csv.DictReader(fid, delimiter=delimiter)
+        if reader.fieldnames is None:
+            logging.error('ERROR: manifest_file is empty: {}'.format(manifest_file))
+            raise RuntimeError('read_manifest: manifest_file is empty!')
+        fieldnames = [x.strip() for x in reader.fieldnames]
+        missing = [x for x in MANIFEST_COLUMNS if x not in fieldnames]
+        if missing:
+            logging.error('ERROR: manifest_file is missing columns: {}'.format(', '.join(missing)))
+            raise RuntimeError('read_manifest: manifest_file is missing columns!')
+        reader.fieldnames = fieldnames
+
+        subject_list = []
+        for row in reader:
+            subject = {}
+            for column in MANIFEST_COLUMNS:
+                subject[column] = row[column].strip()
+            #Skip blank lines
+            if subject['sub'] == '':
+                continue
+            for column in MANIFEST_COLUMNS[1:]:
+                subject[column] = os.path.join(manifest_dir, subject[column])
+            for column in OPTIONAL_COLUMNS:
+                value = (row.get(column) or '').strip()
+                subject[column] = os.path.join(manifest_dir, value) if value != '' else None
+            subject_list.append(subject)
+
+    subs = [x['sub'] for x in subject_list]
+    if len(set(subs)) != len(subs):
+        logging.error('ERROR: manifest_file lists a subject more than once!')
+        raise RuntimeError('read_manifest: duplicate subjects in manifest_file!')
+
+    logging.info('Found {} subjects.'.format(len(subject_list)))
+    logging.info('-------Done: read_manifest-------')
+    return subject_list
+
+
+def split_cores(cores_per_job, jobs=1):
+    #This function splits the cores of one subject between the shells run
+    #at once (jobs, at most cores_per_job) and the OpenMP threads of each
+    #shell's AFNI programs, so jobs*threads stays within cores_per_job.
+    #Returns (jobs, threads).
+    cores_per_job = int(cores_per_job)
+    jobs = int(jobs)
+    if cores_per_job < 1 or jobs < 1:
+        logging.error('ERROR: cores_per_job and jobs must be at least 1!')
+        raise RuntimeError('split_cores: bad core budget')
+    if jobs > cores_per_job:
+        logging.info('Only {} cores per subject; running {} shells at once, not {}.'.format(cores_per_job, cores_per_job, jobs))
+        jobs = cores_per_job
+    return jobs, max(1, cores_per_job // jobs)
+
+
+def init_worker(threads):
+    #This function limits the threads used by the AFNI (OpenMP) children
+    #of a worker process; it is the initializer of the worker pools.
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+
+
+def qa_the_subject(subject, output_root, overwrite=0, engine='afni', jobs=1, cache_dir=None, cache_size=None, scratch_dir=None, timing=0, results_db=None, triage=None, compression=None):
+    #This function runs qa_the_dti for one manifest entry, writing into
+    #output_root/<sub>. Returns the subject ID, the metrics CSV written
+    #(None on failure) and an error message (None on success). The
+    #subject's atlas_image, if the manifest has one, is handed on too. If
+    #triage is a dictionary (of keyword arguments of
+    #dtatr.triage_the_dti, e.g. thresholds; it may be empty), the subject
+    #is screened first and the full QA only run if needed. compression is
+    #handed to qa_the_dti.
+    output_dir = os.path.join(output_root, subject['sub'])
+    qa_function = dtal.qa_the_dti
+    triage_kwargs = {}
+    if triage is not None:
+        qa_function = dtatr.triage_the_dti
+        triage_kwargs = triage
+    try:
+        output_file = qa_function(subject['sub'], subject['dti_image'], subject['mask_image'],
+                                  subject['shell_index_file'], output_dir, overwrite,
+                                  engine=engine, jobs=jobs, cache_dir=cache_dir, cache_size=cache_size,
+                                  scratch_dir=scratch_dir, timing=timing, results_db=results_db,
+                                  atlas_image=subject.get('atlas_image'), compression=compression, **triage_kwargs)
+    except Exception as err:
+        return subject['sub'], None, str(err)
+    return subject['sub'], output_file, None
+
+
+def combine_metrics(metric_file_list, output_file):
+    #This function concatenates per-subject QA metrics CSV files into one
+    #table with the same columns. The files must all have the same header
+    #(e.g. all written in triage mode, with the qa_path column, or none).
+    logging.info('Writing combined metrics file: {}'.format(output_file))
+    header_line = None
+    with open(output_file, 'w') as out_fid:
+        for metric_file in metric_file_list:
+            with open(metric_file, 'r') as fid:
+                lines = fid.read().splitlines()
+            if header_line is None:
+                header_line = lines[0]
+                out_fid.write(header_line+'\n')
+            elif lines[0] != header_line:
+                logging.error('ERROR: metrics file has other columns than the rest: {}'.format(metric_file))
+                raise RuntimeError('combine_metrics: metrics files do not match!')
+            for line in lines[1:]:
+                if line != '':
+                    out_fid.write(line+'\n')
+        if header_line is None:
+            out_fid.write(dtal.METRIC_HEADER+'\n')
+    return output_file
+
+
+def qa_the_cohort(manifest_file, output_root, output_file=None, overwrite=0, engine='afni',
+                  cores=None, cores_per_job=1, jobs=1, cache_dir=None, cache_size=None, scratch_dir=None, timing=0, results_db=None, triage=None, compression=None):
+    #This function runs the QA for every subject in a manifest on a pool of
+    #worker processes and writes one combined metrics table. cores is the
+    #total core budget (default: all cores) and cores_per_job is how many
+    #of them each subject may use, split by split_cores between jobs shells
+    #run at once and the OMP_NUM_THREADS of their AFNI children. cache_dir,
+    #cache_size, scratch_dir, timing and compression are handed to
+    #qa_the_dti for every subject. If results_db is set, every subject's
+    #metrics are stored in that results database and the combined table is
+    #exported from it instead of being put together from the per-subject
+    #CSV files (with the qa_path column in triage mode, as the per-subject
+    #files have). triage is handed to qa_the_subject (triage mode if not
+    #None). Returns the combined metrics file and the list of subjects that
+    #failed.
+    logging.info('-------Starting: qa_the_cohort-------')
+    if cores is None:
+        cores = os.cpu_count() or 1
+    cores = int(cores)
+    cores_per_job = int(cores_per_job)
+    if cores < 1 or cores_per_job < 1:
+        logging.error('ERROR: cores and cores_per_job must be at least 1!')
+        raise RuntimeError('qa_the_cohort: bad core budget')
+    workers = max(1, cores // cores_per_job)
+    jobs, threads = split_cores(cores_per_job, jobs)
+
+    subject_list = read_manifest(manifest_file)
+
+    if not os.path.exists(output_root):
+        logging.info('Creating output directory...')
+        os.makedirs(output_root)
+    if output_file is None:
+        output_file = os.path.join(output_root, 'cohort_QA_metrics.csv')
+    if os.path.exists(output_file) and not overwrite:
+        logging.error('ERROR: output_file exists and overwrite not set!')
+        raise RuntimeError('qa_the_cohort: output_file exists and overwrite not set!')
+
+    logging.info('Running {} subjects on {} workers with {} cores each ({} shells at once, {} threads each)...'.format(len(subject_list), workers, cores_per_job, jobs, threads))
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(threads,)) as executor:
+        futures = [executor.submit(qa_the_subject, subject, output_root, overwrite, engine, jobs, cache_dir, cache_size, scratch_dir, timing, results_db, triage, compression) for subject in subject_list]
+        for count, future in enumerate(concurrent.futures.as_completed(futures)):
+            sub, metric_file, error = future.result()
+            results[sub] = (metric_file, error)
+            if error is None:
+                logging.info('[{}/{}] {} finished.'.format(count+1, len(subject_list), sub))
+            else:
+                logging.error('[{}/{}] {} failed: {}'.format(count+1, len(subject_list), sub, error))
+
+    #Keep the combined table in manifest order
+    metric_file_list = []
+    finished_list = []
+    failed_list = []
+    for subject in subject_list:
+        metric_file, error = results[subject['sub']]
+        if error is None:
+            metric_file_list.append(metric_file)
+            finished_list.append(subject['sub'])
+        else:
+            failed_list.append(subject['sub'])
+    if results_db is not None:
+        dtar.export_csv(results_db, output_file, finished_list, qa_path=int(triage is not None))
+    else:
+        combine_metrics(metric_file_list, output_file)
+
+    logging.info('{} subjects finished, {} failed.'.format(len(metric_file_list), len(failed_list)))
+    logging.info('-------Done: qa_the_cohort-------')
+    return output_file, failed_list
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+import sys
+import logging
+import argparse
+import dti_qa_lib as dtal
+import dti_qa_batch as dtab
+import dti_qa_native as dtan
+import dti_qa_queue as dtaq
+import dti_qa_triage as dtatr
+import dti_qa_pgzip as dtaz
+
+#Runs the DWI QA for every subject in a manifest file and writes one
+#combined metrics table. The manifest is a .csv (or .tsv) file with a
+#header line containing: sub, dti_image, mask_image, shell_index_file
+#With --queue-dir, the subjects are claimed from a queue on a shared file
+#system instead, so the same command can be started on several nodes.
+
+
+#Set up argument parser and help dialogue
+parser=argparse.ArgumentParser(
+    description='''Create image QA metrics for a cohort of DWI datasets listed in a manifest file.''',
+    usage='python3 dti_qa_batch_exe.py manifest_file output_root [--output-file FILE] [--overwrite] [--engine {afni,native}] [--cores N] [--cores-per-job N] [--jobs N] [--cache-dir DIR [--cache-size SIZE]] [--scratch-dir DIR] [--timing] [--compress-threads N] [--compress-level L] [--triage [--triage-threshold METRIC=VALUE ...] [--triage-margin FRACTION]] [--results-db FILE] [--queue-dir DIR [--lease SECONDS] [--retry-failed] [--queue-status]]')
+parser.add_argument('--overwrite', help='if set, overwrite existing outputs', action='store_const', const=1, default=0)
+parser.add_argument('--engine', help='how to compute the mean, TSNR and outlier metrics: afni (the default) or native', choices=dtal.ENGINES, default='afni')
+parser.add_argument('--cores', help='total number of cores to use (default: all)', type=int, default=None)
+parser.add_argument('--cores-per-job', help='cores given to each subject, split between its shells run at once and the OMP_NUM_THREADS of their AFNI programs (default 1)', type=int, default=1)
+parser.add_argument('--jobs', help='shells of a subject to run at once, within --cores-per-job (default 1)', type=int, default=1)
+parser.add_argument('--cache-dir', help='keep stage outputs in a content-addressed cache in this directory and skip stages already cached', default=None)
+parser.add_argument('--cache-size', help='size limit of the cache (e.g. 50G); least recently used entries are evicted first', type=dtan.parse_memory_size, default=None)
+parser.add_argument('--scratch-dir', help='write intermediates to this directory (e.g. /dev/shm) as uncompressed .nii, delete them when used, and keep only the metrics CSVs', default=None)
+parser.add_argument('--timing', help='if set, write a JSON timing file next to each subject\'s metrics CSV', action='store_const', const=1, default=0)
+parser.add_argument('--compress-threads', help='gzip the .nii.gz images that are kept in this library on this many threads (pigz-style, readable by any NIfTI tool) instead of single-threaded in AFNI or nibabel; default: --cores-per-job divided by --jobs if only --compress-level is given', type=int, default=None)
+parser.add_argument('--compress-level', help='gzip level (1-9) of the kept .nii.gz images with --compress-threads (default {})'.format(dtaz.DEFAULT_LEVEL), type=int, default=None)
+parser.add_argument('--triage', help='compute approximate metrics on subsampled data first and only run the full QA if one is near or past its threshold; adds a qa_path column to the metrics CSV', action='store_const', const=1, default=0)
+parser.add_argument('--triage-threshold', help='with --triage, a threshold as metric=value (outcount thresholds are fractions of the mask voxels); may be repeated (defaults: {})'.format(', '.join(['{}={}'.format(x, y) for x, y in sorted(dtatr.DEFAULT_THRESHOLDS.items())])), type=dtatr.parse_threshold, action='append', default=None)
+parser.add_argument('--triage-margin', help='with --triage, also run the full QA when a metric is within this fraction of its threshold (default {})'.format(dtatr.DEFAULT_MARGIN), type=float, default=dtatr.DEFAULT_MARGIN)
+parser.add_argument('--results-db', help='also store every subject\'s metrics in this SQLite results database (on a local disk) and export the combined table from it', default=None)
+parser.add_argument('--queue-dir', help='claim subjects from a queue in this directory on a shared file system, so workers on several nodes can share the manifest', default=None)
+parser.add_argument('--lease', help='with --queue-dir, seconds without a heartbeat before a claimed subject is taken over by another worker (default {})'.format(dtaq.DEFAULT_LEASE), type=float, default=dtaq.DEFAULT_LEASE)
+parser.add_argument('--retry-failed', help='with --queue-dir, put subjects that failed before back in the queue', action='store_const', const=1, default=0)
+parser.add_argument('--queue-status', help='with --queue-dir, print the state of every subject in the queue and exit', action='store_const', const=1, default=0)
+parser.add_argument('--output-file', help='combined metrics table (default: output_root/cohort_QA_metrics.csv)', default=None)
+parser.add_argument('manifest_file', help='path and filename of the subject manifest (.csv or .tsv)')
+parser.add_argument('output_root', help='directory where each subject\'s output directory will be written')
+
+
+def main(args):
+
+    #Set basic logger
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+
+    logging.info('')
+    logging.info('-------Input Arguments--------')
+    logging.info('manifest_file: {}'.format(args.manifest_file))
+    logging.info('output_root: {}'.format(args.output_root))
+    logging.info('output_file: {}'.format(args.output_file))
+    logging.info('overwrite: {}'.format(args.overwrite))
+    logging.info('engine: {}'.format(args.engine))
+    logging.info('cores: {}'.format(args.cores))
+    logging.info('cores_per_job: {}'.format(args.cores_per_job))
+    logging.info('jobs: {}'.format(args.jobs))
+    logging.info('cache_dir: {}'.format(args.cache_dir))
+    logging.info('cache_size: {}'.format(args.cache_size))
+    logging.info('scratch_dir: {}'.format(args.scratch_dir))
+    logging.info('timing: {}'.format(args.timing))
+    logging.info('results_db: {}'.format(args.results_db))
+    logging.info('queue_dir: {}'.format(args.queue_dir))
+    logging.info('lease: {}'.format(args.lease))
+    logging.info('retry_failed: {}'.format(args.retry_failed))
+    logging.info('------------------------------')
+    logging.info('')
+
+    triage = None
+    if args.triage:
+        triage = dtatr.triage_options(args.triage_threshold, args.triage_margin)
+    logging.info('triage: {}'.format(triage))
+
+    compression = None
+    if args.compress_threads is not None or args.compress_level is not None:
+        compression = dtaz.compression_options(args.compress_threads or max(1, int(args.cores_per_job) // int(args.jobs)), args.compress_level or dtaz.DEFAULT_LEVEL)
+    logging.info('compression: {}'.format(compression))
+
+    if args.queue_status:
+        if args.queue_dir is None:
+            logging.error('ERROR: --queue-status needs --queue-dir!')
+            return 1
+        status = dtaq.queue_status(dtab.read_manifest(args.manifest_file), args.queue_dir, args.lease)
+        for state in ['done', 'failed', 'running', 'expired', 'waiting']:
+            print('{:>8} {:>5}: {}'.format(state, len(status[state]), ' '.join(status[state])))
+        return 0
+
+    try:
+        if args.queue_dir is not None:
+            output_file, failed_list = dtaq.qa_the_queue(args.manifest_file, args.output_root, args.queue_dir,
+                                                         output_file=args.output_file,
+                                                         cores=args.cores,
+                                                         cores_per_job=int(args.cores_per_job),
+                                                         jobs=int(args.jobs),
+                                                         lease_seconds=args.lease,
+                                                         retry_failed=int(args.retry_failed),
+                                                         overwrite=int(args.overwrite),
+                                                         engine=str(args.engine),
+                                                         cache_dir=args.cache_dir,
+                                                         cache_size=args.cache_size,
+                                                         scratch_dir=args.scratch_dir,
+                                                         timing=int(args.timing),
+                                                         results_db=args.results_db,
+                                                         triage=triage,
+                                                         compression=compression)
+        else:
+            output_file, failed_list = dtab.qa_the_cohort(args.manifest_file, args.output_root,
+                                                          output_file=args.output_file,
+                                                          overwrite=int(args.overwrite),
+                                                          engine=str(args.engine),
+                                                          cores=args.cores,
+                                                          cores_per_job=int(args.cores_per_job),
+                                                          jobs=int(args.jobs),
+                                                          cache_dir=args.cache_dir,
+                                                          cache_size=args.cache_size,
+                                                          scratch_dir=args.scratch_dir,
+                                                          timing=int(args.timing),
+                                                          results_db=args.results_db,
+                                                          triage=triage,
+                                                          compression=compression)
+    except Exception as err:
+        logging.error('Something went wrong: {}'.format(err))
+        return 1
+
+    if failed_list:
+        logging.error('Subjects that failed: {}'.format(', '.join(failed_list)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
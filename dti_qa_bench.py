@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import numpy
+import dti_qa_lib as dtal
+import dti_qa_native as dtan
+
+#Benchmarks the QA pipeline on synthetic DWI phantoms:
+#   1. Make a phantom (4D DWI, brain mask, shell index file) for every
+#      combination of matrix size, volume count and shell count
+#   2. Run qa_the_dti on it with every available engine, with timing on
+#   3. Report the wall time of each stage and of the whole run, and the
+#      throughput in voxels x volumes per second
+
+
+def make_phantom(output_dir, shape, n_volumes, n_shells, seed=0):
+    #This function writes a synthetic DWI dataset to output_dir: an
+    #ellipsoid "brain" whose signal falls off with b-value, Gaussian noise,
+    #a few corrupted volumes for the outlier counts, a matching mask and a
+    #shell index file with a b=0 volume at the start and every 10 volumes.
+    #Returns the paths of the DWI image, mask image and shell index file.
+    if dtan.nibabel is None:
+        raise RuntimeError('make_phantom: nibabel is needed to write phantoms')
+    rng = numpy.random.default_rng(seed)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    #Shell index list: b=0 every 10 volumes, the shells in turn otherwise
+    shell_index_list = []
+    for count in range(n_volumes):
+        if count % 10 == 0:
+            shell_index_list.append(0)
+        else:
+            shell_index_list.append(1+len([x for x in shell_index_list if x != 0]) % n_shells)
+
+    grid = numpy.meshgrid(*[numpy.linspace(-1, 1, x) for x in shape], indexing='ij')
+    radius = numpy.sqrt(sum([(x/0.8)**2 for x in grid]))
+    mask_data = radius < 1.0
+    tissue = 1000.0*(1.0-0.3*radius)*mask_data
+
+    dwi_data = numpy.zeros(tuple(shape)+(n_volumes,), dtype=numpy.float32)
+    for count, shell in enumerate(shell_index_list):
+        signal = tissue*numpy.exp(-0.7*shell)
+        dwi_data[..., count] = signal+rng.normal(0, 20, size=shape)
+    #Corrupt a few volumes so there are outliers to find
+    for count in rng.choice(n_volumes, size=max(1, n_volumes//20), replace=False):
+        dwi_data[..., count] *= 1.5
+
+    affine = numpy.diag([2.0, 2.0, 2.0, 1.0])
+    dti_image = os.path.join(output_dir, 'dwi.nii.gz')
+    mask_image = os.path.join(output_dir, 'mask.nii.gz')
+    shell_index_file = os.path.join(output_dir, 'shell_index.txt')
+    dtan.nibabel.save(dtan.nibabel.Nifti1Image(dwi_data, affine), dti_image)
+    dtan.nibabel.save(dtan.nibabel.Nifti1Image(mask_data.astype(numpy.int16), affine), mask_image)
+    with open(shell_index_file, 'w') as fid:
+        fid.write(' '.join([str(x) for x in shell_index_list]))
+    return dti_image, mask_image, shell_index_file
+
+
+def available_engines():
+    #This function returns the engines that can run here: the AFNI engine
+    #needs every AFNI program it calls on the PATH, the native engine only
+    #nibabel.
+    engines = []
+    if all([shutil.which(x) is not None for x in dtal.AFNI_PROGRAMS]):
+        engines.append('afni')
+    if dtan.nibabel is not None:
+        engines.append('native')
+    return engines
+
+
+def run_benchmark(work_dir, shape, n_volumes, n_shells, engine, repeats=1, **qa_kwargs):
+    #This function times qa_the_dti on one phantom with one engine and
+    #returns a list of result rows, one per stage plus one for the whole
+    #run ('qa_the_dti'). The fastest of the repeats is kept for each stage.
+    phantom_dir = os.path.join(work_dir, 'phantom_{}_{}_{}'.format('x'.join([str(x) for x in shape]), n_volumes, n_shells))
+    if not os.path.exists(os.path.join(phantom_dir, 'dwi.nii.gz')):
+        make_phantom(phantom_dir, shape, n_volumes, n_shells)
+    dti_image = os.path.join(phantom_dir, 'dwi.nii.gz')
+    mask_image = os.path.join(phantom_dir, 'mask.nii.gz')
+    shell_index_file = os.path.join(phantom_dir, 'shell_index.txt')
+    voxel_volumes = int(numpy.prod(shape))*n_volumes
+
+    best = {}
+    for repeat in range(repeats):
+        output_dir = os.path.join(work_dir, 'run_{}'.format(engine))
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        output_file = dtal.qa_the_dti('bench', dti_image, mask_image, shell_index_file, output_dir, 1,
+                                      engine=engine, timing=1, **qa_kwargs)
+        with open(output_file.split('.csv')[0]+'_timing.json', 'r') as fid:
+            stage_totals = json.load(fid)['stage_totals']
+        for stage, totals in stage_totals.items():
+            if stage not in best or totals['wall_s'] < best[stage]['wall_s']:
+                best[stage] = totals
+
+    rows = []
+    for stage, totals in best.items():
+        rows.append({
+            'size': 'x'.join([str(x) for x in shape]),
+            'volumes': n_volumes,
+            'shells': n_shells,
+            'engine': engine,
+            'stage': stage,
+            'count': totals['count'],
+            'wall_s': totals['wall_s'],
+            'cpu_s': totals['cpu_self_s']+totals['cpu_children_s'],
+            'vox_vols_per_s': voxel_volumes/totals['wall_s'] if totals['wall_s'] > 0 else float('inf'),
+            })
+    return rows
+
+
+BENCH_COLUMNS = ['size', 'volumes', 'shells', 'engine', 'stage', 'count', 'wall_s', 'cpu_s', 'vox_vols_per_s']
+
+
+def write_results(rows, output_file):
+    #This function writes the benchmark rows as a CSV file.
+    with open(output_file, 'w') as fid:
+        fid.write(','.join(BENCH_COLUMNS)+'\n')
+        for row in rows:
+            fid.write(','.join([str(row[x]) for x in BENCH_COLUMNS])+'\n')
+    return output_file
+
+
+def _parse_list(text, item_type=int):
+    return [item_type(x) for x in text.split(',') if x != '']
+
+
+#Set up argument parser and help dialogue
+parser=argparse.ArgumentParser(
+    description='''Benchmark the DWI QA pipeline on synthetic phantoms.''',
+    usage='python3 dti_qa_bench.py work_dir [--sizes 64x64x40,...] [--volumes 30,...] [--shells 1,...] [--engines afni,native] [--repeats N] [--jobs N] [--output-file FILE]')
+parser.add_argument('--sizes', help='comma-separated matrix sizes, e.g. 64x64x40,96x96x60 (default 64x64x40)', default='64x64x40')
+parser.add_argument('--volumes', help='comma-separated volume counts (default 33)', default='33')
+parser.add_argument('--shells', help='comma-separated shell counts (default 1,3)', default='1,3')
+parser.add_argument('--engines', help='comma-separated engines to run (default: every available engine)', default=None)
+parser.add_argument('--repeats', help='runs per configuration; the fastest is kept (default 1)', type=int, default=1)
+parser.add_argument('--jobs', help='shells run at once inside qa_the_dti (default 1)', type=int, default=1)
+parser.add_argument('--output-file', help='CSV file for the results (default: work_dir/bench_results.csv)', default=None)
+parser.add_argument('work_dir', help='directory for the phantoms and QA outputs')
+
+
+def main(args):
+
+    #Set basic logger
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.WARNING)
+
+    if args.engines is None:
+        engines = available_engines()
+    else:
+        engines = _parse_list(args.engines, str)
+    if not engines:
+        logging.error('ERROR: no engine can run here (is AFNI on the PATH?)')
+        return 1
+
+    rows = []
+    for size in args.sizes.split(','):
+        shape = tuple([int(x) for x in size.split('x')])
+        for n_volumes in _parse_list(args.volumes):
+            for n_shells in _parse_list(args.shells):
+                for engine in engines:
+                    new_rows = run_benchmark(args.work_dir, shape, n_volumes, n_shells, engine,
+                                             repeats=args.repeats, jobs=args.jobs)
+                    for row in new_rows:
+                        print('{size:>12} {volumes:>4} vols {shells} shells {engine:>7} {stage:>20}: {wall_s:8.3f} s  {vox_vols_per_s:14.0f} vox*vols/s'.format(**row))
+                    rows.extend(new_rows)
+
+    output_file = args.output_file
+    if output_file is None:
+        output_file = os.path.join(args.work_dir, 'bench_results.csv')
+    write_results(rows, output_file)
+    print('Results written to: {}'.format(output_file))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,176 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import subprocess
+import tempfile
+
+
+#Bump this whenever a change to the library changes what a stage writes,
+#so old cache entries are no longer used.
+CACHE_VERSION = '1'
+
+
+def _file_digest(input_file, cache_dir):
+    #This function returns the SHA-256 of a file's contents. Digests are
+    #remembered in cache_dir/hashes by path, size and modification time,
+    #so an unchanged input is only read once.
+    stat = os.stat(input_file)
+    memo_key = '{}:{}:{}'.format(os.path.abspath(input_file), stat.st_size, stat.st_mtime_ns)
+    memo_file = os.path.join(cache_dir, 'hashes', hashlib.sha256(memo_key.encode()).hexdigest())
+    if os.path.exists(memo_file):
+        with open(memo_file, 'r') as fid:
+            return fid.read().strip()
+
+    logging.info('Hashing input: {}'.format(input_file))
+    digest = hashlib.sha256()
+    with open(input_file, 'rb') as fid:
+        for block in iter(lambda: fid.read(1024*1024), b''):
+            digest.update(block)
+    digest = digest.hexdigest()
+
+    os.makedirs(os.path.dirname(memo_file), exist_ok=True)
+    temp_fid, temp_file = tempfile.mkstemp(dir=os.path.dirname(memo_file))
+    with os.fdopen(temp_fid, 'w') as fid:
+        fid.write(digest)
+    os.replace(temp_file, memo_file)
+    return digest
+
+
+def afni_version():
+    #This function returns the AFNI version string, or 'none' if AFNI
+    #cannot be run.
+    try:
+        proc = subprocess.Popen(['afni', '-ver'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        call_output, stderr = proc.communicate()
+        return call_output.decode(errors='replace').strip() or 'none'
+    except OSError:
+        return 'none'
+
+
+def open_cache(cache_dir, input_files, max_size=None, tool_version=None):
+    #This function sets up a cache for one run and returns a dictionary
+    #describing it. The run's inputs are identified by the contents of
+    #input_files (the DWI image, mask and shell index file), and every
+    #stage key also includes tool_version and CACHE_VERSION. max_size is
+    #the cache size limit in bytes (None for no limit).
+    logging.info('-------Starting: open_cache-------')
+    os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+    if tool_version is None:
+        tool_version = afni_version()
+    digest = hashlib.sha256()
+    for input_file in input_files:
+        digest.update(_file_digest(input_file, cache_dir).encode())
+    cache_info = {
+        'dir': cache_dir,
+        'max_size': max_size,
+        'inputs_key': digest.hexdigest(),
+        'tool_version': '{}|{}'.format(CACHE_VERSION, tool_version),
+        }
+    if max_size is not None:
+        evict(cache_dir, max_size)
+    logging.info('-------Done: open_cache-------')
+    return cache_info
+
+
+def stage_key(cache_info, stage, params):
+    #This function returns the cache key of a stage: a hash of the run's
+    #inputs, the tool version, the stage name and its parameters (which
+    #must be JSON-serializable).
+    key_source = json.dumps([cache_info['inputs_key'], cache_info['tool_version'], stage, params], sort_keys=True)
+    return hashlib.sha256(key_source.encode()).hexdigest()
+
+
+def _entry_dir(cache_info, key):
+    return os.path.join(cache_info['dir'], 'objects', key[:2], key)
+
+
+def _link_or_copy(source, destination):
+    #Hard links make a hit free when the cache and outputs share a file
+    #system; otherwise fall back to a copy.
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def has_entry(cache_info, key):
+    #This function says whether the cache holds a stage's results.
+    return os.path.exists(os.path.join(_entry_dir(cache_info, key), 'meta.json'))
+
+
+def fetch(cache_info, key, outputs, overwrite=0):
+    #This function restores the output files of a cached stage to the
+    #paths in outputs and returns the stage's metrics dictionary, or None
+    #on a miss. Existing outputs are replaced only if overwrite is set.
+    entry_dir = _entry_dir(cache_info, key)
+    meta_file = os.path.join(entry_dir, 'meta.json')
+    try:
+        with open(meta_file, 'r') as fid:
+            meta = json.load(fid)
+        for count, output in enumerate(outputs):
+            if os.path.exists(output):
+                if overwrite:
+                    os.remove(output)
+                else:
+                    logging.error('ERROR: output already there and overwrite not set: {}'.format(output))
+                    raise RuntimeError('fetch: output already exists!')
+            _link_or_copy(os.path.join(entry_dir, str(count)), output)
+        #Mark the entry as recently used
+        os.utime(meta_file)
+    except (OSError, ValueError):
+        #Missing or evicted while we looked: treat it as a miss
+        return None
+    return meta['metrics']
+
+
+def store(cache_info, key, outputs, metrics=None):
+    #This function adds a stage's output files and metrics to the cache,
+    #then evicts the least recently used entries if the cache is over its
+    #size limit. The entry is built in a temporary directory and renamed
+    #into place, so concurrent runs never see half of one.
+    entry_dir = _entry_dir(cache_info, key)
+    if os.path.exists(entry_dir):
+        return
+    os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+    try:
+        for count, output in enumerate(outputs):
+            _link_or_copy(output, os.path.join(temp_dir, str(count)))
+        with open(os.path.join(temp_dir, 'meta.json'), 'w') as fid:
+            json.dump({'outputs': [os.path.basename(x) for x in outputs], 'metrics': metrics or {}}, fid)
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        #Another run stored the same entry first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    if cache_info['max_size'] is not None:
+        evict(cache_info['dir'], cache_info['max_size'])
+
+
+def evict(cache_dir, max_size):
+    #This function deletes the least recently used cache entries until
+    #the cache holds no more than max_size bytes.
+    entries = []
+    total_size = 0
+    objects_dir = os.path.join(cache_dir, 'objects')
+    for prefix in os.listdir(objects_dir):
+        prefix_dir = os.path.join(objects_dir, prefix)
+        for key in os.listdir(prefix_dir):
+            entry_dir = os.path.join(prefix_dir, key)
+            meta_file = os.path.join(entry_dir, 'meta.json')
+            try:
+                last_used = os.stat(meta_file).st_mtime
+                size = sum([os.stat(os.path.join(entry_dir, x)).st_size for x in os.listdir(entry_dir)])
+            except OSError:
+                continue
+            entries.append((last_used, size, entry_dir))
+            total_size += size
+    entries.sort()
+    for last_used, size, entry_dir in entries:
+        if total_size <= max_size:
+            break
+        logging.info('Evicting cache entry: {}'.format(entry_dir))
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+    return total_size
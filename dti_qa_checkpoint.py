@@ -0,0 +1,112 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import uuid
+
+
+#Checkpoints of a run are kept in this directory of its output_dir
+CHECKPOINT_DIR = '.dti_qa_checkpoints'
+
+
+def _file_fingerprint(input_file):
+    #This function identifies a file by path, size and modification time,
+    #which is enough to tell whether a rerun has the same inputs without
+    #reading them.
+    stat = os.stat(input_file)
+    return [os.path.abspath(input_file), stat.st_size, stat.st_mtime_ns]
+
+
+def open_checkpoints(output_dir, input_files, overwrite=0):
+    #This function sets up the checkpoints of a run and returns a
+    #dictionary describing them. The run's inputs are identified by the
+    #fingerprints of input_files (the DWI image, mask and shell index
+    #file); a marker left by a run with other inputs is never used. If
+    #overwrite is set, the checkpoints of earlier runs are deleted.
+    checkpoint_dir = os.path.join(output_dir, CHECKPOINT_DIR)
+    if overwrite and os.path.exists(checkpoint_dir):
+        logging.info('Overwrite set; deleting checkpoints: {}'.format(checkpoint_dir))
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    digest = hashlib.sha256(json.dumps([_file_fingerprint(x) for x in input_files]).encode())
+    return {'dir': checkpoint_dir, 'inputs_key': digest.hexdigest(), 'run': uuid.uuid4().hex}
+
+
+def _marker_file(checkpoint_info, stage, params):
+    #Markers are named by a hash of the inputs, stage and parameters
+    key_source = json.dumps([checkpoint_info['inputs_key'], stage, params], sort_keys=True)
+    key = hashlib.sha256(key_source.encode()).hexdigest()
+    return os.path.join(checkpoint_info['dir'], '{}_{}_{}.json'.format(stage, params.get('shell', 'all'), key[:16]))
+
+
+def _write_marker(marker_file, contents):
+    temp_fid, temp_file = tempfile.mkstemp(dir=os.path.dirname(marker_file), prefix='.tmp_')
+    with os.fdopen(temp_fid, 'w') as fid:
+        json.dump(contents, fid)
+    os.replace(temp_file, marker_file)
+
+
+def _read_marker(marker_file):
+    try:
+        with open(marker_file, 'r') as fid:
+            return json.load(fid)
+    except (OSError, ValueError):
+        return None
+
+
+def is_done(checkpoint_info, stage, params, outputs):
+    #This function returns the metrics saved when a stage finished, or
+    #None if it has not finished with these inputs and parameters or any
+    #of its output files has since been changed or removed.
+    marker = _read_marker(_marker_file(checkpoint_info, stage, params))
+    if marker is None or marker.get('state') != 'done':
+        return None
+    try:
+        if [_file_fingerprint(x) for x in outputs] != marker['outputs']:
+            logging.info('Outputs of {} {} have changed since it finished; running it again.'.format(stage, params.get('shell', '')))
+            return None
+    except OSError:
+        return None
+    return marker['metrics']
+
+
+def mark_started(checkpoint_info, stage, params, outputs):
+    #This function records that a stage is about to write its outputs. If
+    #an earlier run was cut off in the same stage, the outputs it left
+    #behind are deleted first, so the stage can be run again without
+    #setting overwrite. Outputs written earlier in this same run (e.g. by
+    #a pass that writes several shells' images before their stages start)
+    #are left alone.
+    marker_file = _marker_file(checkpoint_info, stage, params)
+    marker = _read_marker(marker_file)
+    if marker is not None and marker.get('run') == checkpoint_info['run']:
+        return
+    if marker is not None:
+        for output in outputs:
+            if os.path.exists(output):
+                logging.info('Removing output left by an interrupted run: {}'.format(output))
+                os.remove(output)
+    _write_marker(marker_file, {'state': 'started', 'run': checkpoint_info['run'], 'stage': stage, 'params': params})
+
+
+def mark_done(checkpoint_info, stage, params, outputs, metrics=None):
+    #This function records that a stage finished, with the fingerprints of
+    #its output files and its metrics.
+    _write_marker(_marker_file(checkpoint_info, stage, params), {
+        'state': 'done',
+        'run': checkpoint_info['run'],
+        'stage': stage,
+        'params': params,
+        'outputs': [_file_fingerprint(x) for x in outputs],
+        'metrics': metrics or {},
+        })
+
+
+def remove_checkpoints(checkpoint_info):
+    #This function deletes every checkpoint of a run, e.g. once a run whose
+    #intermediates are not kept has finished.
+    if os.path.exists(checkpoint_info['dir']):
+        logging.info('Removing checkpoints: {}'.format(checkpoint_info['dir']))
+        shutil.rmtree(checkpoint_info['dir'], ignore_errors=True)
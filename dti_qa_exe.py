@@ -1,14 +1,19 @@
 #!/usr/bin/python3
 
 import os
+import sys
 import logging
 import argparse
 import dti_qa_lib as dtal
+import dti_qa_native as dtan
+import dti_qa_triage as dtatr
+import dti_qa_pgzip as dtaz
 
 #Preprocessing:
-#   1. Apply the DWI mask to the raw DWI data
-#   2. Create the 4D image of each shell
-#   3. Create the mean image for each shell
+#   1. Create the 4D image of each shell
+#   2. Create the mean image for each shell
+#   (the DWI mask is passed to each stage that needs it rather than applied
+#   to a full copy of the DWI data)
 
 #Calculating outlier count metrics:
 #   1. Use 3dToutcount on each shell dataset
@@ -17,6 +22,7 @@ import dti_qa_lib as dtal
 
 #Calculating motion correction metrics:
 #   1. 3dvolreg each shell 4D image using the mean as the base
+#      (with --motion-engine native, register each volume to the mean in-process instead)
 #   2. Find the maximum displacement for each shell and then for the image
 
 #Calculating TSNR metrics:
@@ -27,14 +33,29 @@ import dti_qa_lib as dtal
 #Set up argument parser and help dialogue
 parser=argparse.ArgumentParser(
     description='''Create image QA metrics for DWI data. Based on: "The Impact of Quality Assurance Assessment on Diffusion Tensor Imaging Outcomes in a Large-Scale Population-Based Cohort", Roalf et al., Neuroimage, 2016. ''',
-    usage='python3 dti_qa.py dti_image mask_image shell_index_file output_dir [--overwrite]')
+    usage='python3 dti_qa.py dti_image mask_image shell_index_file output_dir [--overwrite] [--engine {afni,native}] [--motion-engine {afni,native}] [--jobs N] [--stage-jobs N] [--max-memory SIZE] [--cache-dir DIR [--cache-size SIZE]] [--scratch-dir DIR] [--timing] [--atlas IMAGE] [--compress-threads N] [--compress-level L] [--triage [--triage-threshold METRIC=VALUE ...] [--triage-margin FRACTION]] [--results-db FILE]')
 parser.add_argument('--overwrite', help='if set, delete the output_dir if it already exists', action='store_const', const=1, default=0)
+parser.add_argument('--engine', help='how to compute the mean, TSNR and outlier metrics: afni (3dTstat/3dROIstats/3dToutcount, the default) or native (in-process NumPy)', choices=dtal.ENGINES, default='afni')
+parser.add_argument('--motion-engine', help='how to compute the maximum displacement: afni (3dvolreg) or native (in-process rigid registration, no registered image written); default: the same as --engine', choices=dtal.ENGINES, default=None)
+parser.add_argument('--jobs', help='number of shells to process at the same time (default 1)', type=int, default=1)
+parser.add_argument('--stage-jobs', help='number of independent stages of a shell (e.g. outcount, TSNR and motion correction) to run at the same time (default 1)', type=int, default=1)
+parser.add_argument('--max-memory', help='with --engine native, stream the 4D data in slabs that fit in this much memory (e.g. 512M, 2G) instead of loading it all', type=dtan.parse_memory_size, default=None)
+parser.add_argument('--cache-dir', help='keep stage outputs in a content-addressed cache in this directory and skip stages already cached', default=None)
+parser.add_argument('--cache-size', help='size limit of the cache (e.g. 50G); least recently used entries are evicted first', type=dtan.parse_memory_size, default=None)
+parser.add_argument('--scratch-dir', help='write intermediates to this directory (e.g. /dev/shm) as uncompressed .nii, delete them when used, and keep only the metrics CSV', default=None)
+parser.add_argument('--timing', help='if set, write the time, CPU, peak memory and I/O of every stage to a JSON file next to the metrics CSV', action='store_const', const=1, default=0)
+parser.add_argument('--atlas', help='label image on the grid of the DWI data; also write the TSNR and outlier rate of every region to a regional metrics CSV', default=None)
+parser.add_argument('--compress-threads', help='gzip the .nii.gz images that are kept in this library on this many threads (pigz-style, readable by any NIfTI tool) instead of single-threaded in AFNI or nibabel; default: every CPU if only --compress-level is given', type=int, default=None)
+parser.add_argument('--compress-level', help='gzip level (1-9) of the kept .nii.gz images with --compress-threads (default {})'.format(dtaz.DEFAULT_LEVEL), type=int, default=None)
+parser.add_argument('--triage', help='compute approximate metrics on subsampled data first and only run the full QA if one is near or past its threshold; adds a qa_path column to the metrics CSV', action='store_const', const=1, default=0)
+parser.add_argument('--triage-threshold', help='with --triage, a threshold as metric=value (outcount thresholds are fractions of the mask voxels); may be repeated (defaults: {})'.format(', '.join(['{}={}'.format(x, y) for x, y in sorted(dtatr.DEFAULT_THRESHOLDS.items())])), type=dtatr.parse_threshold, action='append', default=None)
+parser.add_argument('--triage-margin', help='with --triage, also run the full QA when a metric is within this fraction of its threshold (default {})'.format(dtatr.DEFAULT_MARGIN), type=float, default=dtatr.DEFAULT_MARGIN)
+parser.add_argument('--results-db', help='also store the metrics in this SQLite results database, which many runs can write to at once', default=None)
 parser.add_argument('subID', help='Subject ID associated with DTI data')
 parser.add_argument('dti_image', help='path and filename of a 4D .nii or .nii.gz')
 parser.add_argument('mask_image', help='path and filename of a 3D mask .nii or .nii.gz image')
 parser.add_argument('shell_index_file', help='path and filename of a b-vector file containing three rows, each with one element per diffusion volume')
 parser.add_argument('output_dir', help='output directory where things will be written')
-args = parser.parse_args()
 
 
 def main(args):
@@ -50,6 +71,23 @@ def main(args):
     shell_index_file = str(args.shell_index_file)
     output_dir = str(args.output_dir)
     overwrite = int(args.overwrite)
+    engine = str(args.engine)
+    motion_engine = args.motion_engine
+    jobs = int(args.jobs)
+    stage_jobs = int(args.stage_jobs)
+    max_memory = args.max_memory
+    cache_dir = args.cache_dir
+    cache_size = args.cache_size
+    scratch_dir = args.scratch_dir
+    timing = int(args.timing)
+    atlas_image = args.atlas
+    triage = None
+    if args.triage:
+        triage = dtatr.triage_options(args.triage_threshold, args.triage_margin)
+    results_db = args.results_db
+    compression = None
+    if args.compress_threads is not None or args.compress_level is not None:
+        compression = dtaz.compression_options(args.compress_threads, args.compress_level or dtaz.DEFAULT_LEVEL)
 
     logging.info('')
     logging.info('-------Input Arguments--------')
@@ -59,15 +97,36 @@ def main(args):
     logging.info('shell_index_file: {}'.format(shell_index_file))
     logging.info('output_dir: {}'.format(output_dir))
     logging.info('overwrite: {}'.format(overwrite))
+    logging.info('engine: {}'.format(engine))
+    logging.info('motion_engine: {}'.format(motion_engine))
+    logging.info('jobs: {}'.format(jobs))
+    logging.info('stage_jobs: {}'.format(stage_jobs))
+    logging.info('max_memory: {}'.format(max_memory))
+    logging.info('cache_dir: {}'.format(cache_dir))
+    logging.info('cache_size: {}'.format(cache_size))
+    logging.info('scratch_dir: {}'.format(scratch_dir))
+    logging.info('timing: {}'.format(timing))
+    logging.info('atlas_image: {}'.format(atlas_image))
+    logging.info('compression: {}'.format(compression))
+    logging.info('triage: {}'.format(triage))
+    logging.info('results_db: {}'.format(results_db))
     logging.info('------------------------------')
     logging.info('')
 
-    #Try running the QA
+    #Try running the QA; a nonzero exit status tells the caller it failed
     try:
-        output_written = dtal.qa_the_dti(sub, dti_image, mask_image, shell_index_file, output_dir, overwrite)
+        qa_kwargs = {'engine': engine, 'jobs': jobs, 'stage_jobs': stage_jobs, 'max_memory': max_memory, 'cache_dir': cache_dir, 'cache_size': cache_size, 'scratch_dir': scratch_dir,
+                     'timing': timing, 'motion_engine': motion_engine, 'results_db': results_db, 'atlas_image': atlas_image,
+                     'compression': compression}
+        if triage is not None:
+            output_written = dtatr.triage_the_dti(sub, dti_image, mask_image, shell_index_file, output_dir, overwrite, **triage, **qa_kwargs)
+        else:
+            output_written = dtal.qa_the_dti(sub, dti_image, mask_image, shell_index_file, output_dir, overwrite, **qa_kwargs)
     except Exception as err:
         logging.error('Something went wrong: {}'.format(err))
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
-    main(args)
\ No newline at end of file
+    sys.exit(main(parser.parse_args()))
\ No newline at end of file
@@ -0,0 +1,95 @@
+import io
+import os
+import json
+import logging
+import tempfile
+
+#indexed_gzip is optional; without it .nii.gz inputs are read from the start
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+
+#Seek-point index files are kept next to the input, named <input>.gzidx
+INDEX_SUFFIX = '.gzidx'
+
+#Bytes of uncompressed data between seek points: reading any volume
+#inflates at most this much data before it
+INDEX_SPACING = 4*1024*1024
+
+INDEX_VERSION = 1
+
+
+def index_file(input_image):
+    #This function returns the name of the seek-point index of a .gz file.
+    return input_image+INDEX_SUFFIX
+
+
+def _fingerprint(input_image):
+    #This function identifies the contents of a file by size and
+    #modification time, so an index is not used for a file it was not
+    #built from.
+    stat = os.stat(input_image)
+    return {'version': INDEX_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _load_index(fid, input_image):
+    #This function loads the saved index of input_image into fid, if there
+    #is one and it still matches the file. Returns True if it was loaded.
+    saved_index = index_file(input_image)
+    try:
+        with open(saved_index, 'rb') as index_fid:
+            meta = json.loads(index_fid.readline().decode())
+            if meta != _fingerprint(input_image):
+                logging.info('Seek-point index is out of date, ignoring it: {}'.format(saved_index))
+                return False
+            fid.import_index(fileobj=io.BytesIO(index_fid.read()))
+    except (OSError, ValueError, indexed_gzip.ZranError):
+        return False
+    logging.info('Using seek-point index: {}'.format(saved_index))
+    return True
+
+
+def open_indexed(input_image, build=1):
+    #This function opens a .gz file for random access and returns
+    #(file object, loaded), or (None, False) where that is not possible
+    #(indexed_gzip not installed or not a .gz file). If an up-to-date index
+    #was saved next to the file it is loaded (loaded is True). Otherwise,
+    #if build is set, the full index is built now (one pass through the
+    #file) and saved; if not, seek points are added as the file is read and
+    #save_index should be called afterwards.
+    if indexed_gzip is None or not input_image.endswith('.gz'):
+        return None, False
+    fid = indexed_gzip.IndexedGzipFile(filename=input_image, spacing=INDEX_SPACING, drop_handles=False)
+    loaded = _load_index(fid, input_image)
+    if not loaded and build:
+        save_index(fid, input_image)
+    return fid, loaded
+
+
+def save_index(fid, input_image, complete=0):
+    #This function saves the seek-point index of an open file next to the
+    #file, building the rest of the index first unless complete is set
+    #(e.g. the file has just been read to the end). The index is written to
+    #a temporary file and renamed into place, so concurrent runs never read
+    #half of one. If the directory cannot be written to, nothing is saved.
+    saved_index = index_file(input_image)
+    if not complete:
+        logging.info('Building seek-point index: {}'.format(input_image))
+        fid.build_full_index()
+    contents = io.BytesIO()
+    fid.export_index(fileobj=contents)
+    try:
+        temp_fid, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(saved_index)), prefix='.gzidx_')
+        with os.fdopen(temp_fid, 'wb') as index_fid:
+            index_fid.write((json.dumps(_fingerprint(input_image))+'\n').encode())
+            index_fid.write(contents.getvalue())
+        #mkstemp makes the file private; the index is as readable as the input
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, saved_index)
+    except OSError as err:
+        logging.info('Could not save seek-point index next to the input: {}'.format(err))
+        return None
+    logging.info('Saved seek-point index: {}'.format(saved_index))
+    return saved_index
@@ -1,7 +1,57 @@
 import subprocess
 import os, sys, shutil
+import concurrent.futures
+import tempfile
 import logging
 import numpy
+import dti_qa_native as dtan
+import dti_qa_cache as dtac
+import dti_qa_timing as dtat
+import dti_qa_checkpoint as dtak
+import dti_qa_results as dtar
+import dti_qa_pgzip as dtaz
+
+#Options of qa_the_dti (qa_the_shell takes those that apply to one shell):
+#   engine         'afni' (3dTstat, 3dROIstats, 3dToutcount) or 'native'
+#                  (a single pass through the DWI data with NumPy) for the
+#                  mean, TSNR and outlier metrics
+#   motion_engine  'afni' (3dvolreg) or 'native' (in-process registration,
+#                  no registered image) for maxdisp; default: engine
+#   jobs           shells run at once; stage_jobs, independent stages of a
+#                  shell run at once (up to jobs*stage_jobs AFNI programs)
+#   max_memory     native engine: stream the 4D data in slabs within this
+#                  many bytes, shared by the shells run at once
+#   cache_dir      content-addressed cache of stage outputs and metrics,
+#                  limited to cache_size bytes (least recently used evicted)
+#   scratch_dir    intermediates go there as .nii and are deleted once read;
+#                  only the metrics CSV is kept (the shell checkpoints are
+#                  removed once the run finishes)
+#   timing         write a JSON sidecar with the time, CPU, peak memory and
+#                  I/O of every stage
+#   results_db     also store the metrics in a dti_qa_results database
+#   atlas_image    label image on the DWI grid; the TSNR and outlier rate of
+#                  every region go to a regional CSV
+#   compression    from dtaz.compression_options; the .nii.gz images kept
+#                  are gzipped on several threads here rather than by AFNI
+#   split_shells   cut the shell images out of the DWI data in one pass
+#                  (default) where they are needed, rather than with one
+#                  3dTcat per shell
+#Every finished stage and shell is checkpointed in output_dir, so running
+#a cut-off run again on the same inputs picks up where it stopped
+#(overwrite starts from scratch).
+
+
+#Engines that can compute the mean, TSNR, average TSNR and outlier metrics
+ENGINES = ['afni', 'native']
+
+#AFNI programs the 'afni' engine calls
+AFNI_PROGRAMS = ['3dTcat', '3dTstat', '3dToutcount', '3dvolreg', '3dROIstats']
+
+#Header line of the QA metrics CSV files
+METRIC_HEADER = ','.join(dtar.METRIC_COLUMNS)
+
+#Header line of the regional metrics CSV files (with atlas_image)
+REGIONAL_HEADER = 'sub,shell,region,voxels,tsnr_mean,outlier_rate'
 
 
 def __add_prefix(input_file, prefix):
@@ -12,9 +62,49 @@ def __add_prefix(input_file, prefix):
     return output_file
 
 
-def select_trs(input_image, output_image, volume_string, overwrite=0):
+def metrics_file(dti_image, output_dir):
+    #This function returns the path of the metrics CSV that qa_the_dti
+    #writes for dti_image in output_dir.
+    output_file = __add_prefix(dti_image, '_QA_metrics')
+    output_file = output_file.split('.nii')[0]+'.csv'
+    return os.path.join(output_dir, os.path.split(output_file)[-1])
+
+
+def read_shell_index(shell_index_file):
+    #This function reads a shell index file into a list with one label per
+    #volume ('0' for b=0 volumes, '1' for the first shell, etc.). Labels
+    #may be separated by spaces, tabs or newlines, and a trailing newline
+    #is ignored, so every reader of the file gets the same labels.
+    with open(shell_index_file, 'r') as fid:
+        return fid.read().split()
+
+
+def _afni_output(output_image, compression):
+    #This function returns the file an AFNI program should write
+    #output_image to. With compression (from dtaz.compression_options), a
+    #.nii.gz is written uncompressed first, for _compress_output to gzip on
+    #several threads; AFNI's own gzip is single-threaded.
+    if compression is None or not output_image.endswith('.nii.gz'):
+        return output_image
+    afni_image = output_image[:-len('.gz')]
+    if os.path.exists(afni_image):
+        logging.info('Removing uncompressed output left by an earlier run: {}'.format(afni_image))
+        os.remove(afni_image)
+    return afni_image
+
+
+def _compress_output(afni_image, output_image, compression):
+    #This function gzips what an AFNI program wrote to afni_image (see
+    #_afni_output) into output_image and deletes afni_image.
+    if afni_image == output_image or not os.path.exists(afni_image):
+        return
+    dtaz.compress_file(afni_image, output_image, **compression)
+    os.remove(afni_image)
+
+
+def select_trs(input_image, output_image, volume_string, overwrite=0, compression=None):
     #This function uses AFNI's 3dTcat to select a number of TRs from
-    #a 4D image.
+    #a 4D image. compression is as for _afni_output.
     logging.info('-------Starting: select_trs-------')
     try:
         #Check the input file for a path
@@ -39,10 +129,11 @@ def select_trs(input_image, output_image, volume_string, overwrite=0):
                 raise RuntimeError('select_trs: output_image already exists!')
 
         #Put together call to 3dTcat
+        afni_image = _afni_output(output_image, compression)
         call_parts = [
                    '3dTcat',
                    '-prefix',
-                   output_image,
+                   afni_image,
                    input_image+'[{}]'.format(volume_string)
                   ]
 
@@ -50,7 +141,8 @@ def select_trs(input_image, output_image, volume_string, overwrite=0):
 
         logging.info('Calling: {}'.format(' '.join(call_parts)))
         proc = subprocess.Popen(call_parts, stdout=subprocess.PIPE)
-        call_output, stderr = proc.communicate()
+        call_output, stderr = dtat.communicate(proc)
+        _compress_output(afni_image, output_image, compression)
 
         if not os.path.exists(output_image):
             logging.error('ERROR: output_image should be there, but is not: {}'.format(output_image))
@@ -65,8 +157,9 @@ def select_trs(input_image, output_image, volume_string, overwrite=0):
 
 
 
-def create_mean(input_image, output_image, overwrite=0):
+def create_mean(input_image, output_image, overwrite=0, compression=None):
     #This function uses AFNI's 3dTstat to create a mean image.
+    #compression is as for _afni_output.
     logging.info('-------Starting: create_means-------')
     try:
         #Check the input file for a path
@@ -91,11 +184,12 @@ def create_mean(input_image, output_image, overwrite=0):
                 raise RuntimeError('create_mean: output_image already exists!')
 
         #Put together call to 3dMean
+        afni_image = _afni_output(output_image, compression)
         call_parts = [
                    '3dTstat',
                    '-mean',
                    '-prefix',
-                   output_image,
+                   afni_image,
                    input_image
                   ]
 
@@ -103,7 +197,8 @@ def create_mean(input_image, output_image, overwrite=0):
 
         logging.info('Calling: {}'.format(' '.join(call_parts)))
         proc = subprocess.Popen(call_parts, stdout=subprocess.PIPE)
-        call_output, stderr = proc.communicate()
+        call_output, stderr = dtat.communicate(proc)
+        _compress_output(afni_image, output_image, compression)
 
         if not os.path.exists(output_image):
             logging.error('ERROR: output_image should be there, but is not: {}'.format(output_image))
@@ -170,7 +265,7 @@ def apply_mask(input_image, mask_image, output_image, overwrite=0, skip=0):
         logging.info('...applying mask...')
         logging.info('Calling: {}'.format(' '.join(call_parts)))
         proc = subprocess.Popen(call_parts, stdout=subprocess.PIPE)
-        call_output, stderr = proc.communicate()
+        call_output, stderr = dtat.communicate(proc)
     except Exception as err:
         logging.error('ERROR applying mask: {}'.format(err))
         raise RuntimeError('error applying mask')
@@ -218,7 +313,7 @@ def outcount(input_image, mask_image):
 
         logging.info('Calling: {}'.format(' '.join(call_parts)))
         proc = subprocess.Popen(call_parts, stdout=subprocess.PIPE)
-        call_output, stderr = proc.communicate()
+        call_output, stderr = dtat.communicate(proc)
 
         #Find the mean and max of the 3dToutcount output
         outcount_array = numpy.array(call_output.split(), dtype=int)
@@ -234,9 +329,9 @@ def outcount(input_image, mask_image):
     return outcount_mean, outcount_max
 
 
-def motion_correct(input_image, base_image, output_image, overwrite=1):
+def motion_correct(input_image, base_image, output_image, overwrite=1, compression=None):
     #This function runs motion correction on an input image, using another image
-    #as the base for registration.
+    #as the base for registration. compression is as for _afni_output.
     logging.info('-------Starting: motion_correct-------')
     try:
         #Check the input file for a path
@@ -285,9 +380,10 @@ def motion_correct(input_image, base_image, output_image, overwrite=1):
 
         #Create call to motion-correct the image
         logging.info('Creating call parts list...')
+        afni_image = _afni_output(output_image, compression)
         call_parts = [
                       '3dvolreg',
-                      '-prefix', output_image,
+                      '-prefix', afni_image,
                       '-float',
                       '-maxdisp1D', motcor_out_maxdisp,
                       '-base', base_image,
@@ -297,7 +393,8 @@ def motion_correct(input_image, base_image, output_image, overwrite=1):
         logging.info('...running motion correction...')
         logging.info('Calling: {}'.format(' '.join(call_parts)))
         proc = subprocess.Popen(call_parts, stdout=subprocess.PIPE)
-        call_output, stderr = proc.communicate()
+        call_output, stderr = dtat.communicate(proc)
+        _compress_output(afni_image, output_image, compression)
     except Exception as err:
         logging.error('ERROR running motion correction: {}'.format(err))
         raise RuntimeError('error running motion correction')
@@ -307,8 +404,9 @@ def motion_correct(input_image, base_image, output_image, overwrite=1):
     return output_image, motcor_out_maxdisp
 
 
-def calc_tsnr(input_image, mask_image, output_image, overwrite=1):
+def calc_tsnr(input_image, mask_image, output_image, overwrite=1, compression=None):
     #Calculate a 3D voxel-wise TSNR image from the input 4D image
+    #(compression is as for _afni_output)
     logging.info('-------Starting: calc_tsnr-------')
     try:
         #Check the input file for a path
@@ -344,11 +442,12 @@ def calc_tsnr(input_image, mask_image, output_image, overwrite=1):
                 raise RuntimeError('calc_tsnr: output_image already exists!')
 
         #Put together call to 3dToutcount
+        afni_image = _afni_output(output_image, compression)
         call_parts = [
                    '3dTstat',
                    '-tsnr',
                    '-mask', mask_image,
-                   '-prefix', output_image,
+                   '-prefix', afni_image,
                    input_image
                   ]
 
@@ -356,7 +455,8 @@ def calc_tsnr(input_image, mask_image, output_image, overwrite=1):
 
         logging.info('Calling: {}'.format(' '.join(call_parts)))
         proc = subprocess.Popen(call_parts, stdout=subprocess.PIPE)
-        call_output, stderr = proc.communicate()
+        call_output, stderr = dtat.communicate(proc)
+        _compress_output(afni_image, output_image, compression)
 
     except:
         logging.error('ERROR: 3dTstat failed!')
@@ -409,7 +509,7 @@ def ave_tsnr(input_image, mask_image):
 
         logging.info('Calling: {}'.format(' '.join(call_parts)))
         proc = subprocess.Popen(call_parts, stdout=subprocess.PIPE)
-        call_output, stderr = proc.communicate()
+        call_output, stderr = dtat.communicate(proc)
 
         #Isolate the number in the output
         average_tsnr = float(call_output.strip())
@@ -423,16 +523,338 @@ def ave_tsnr(input_image, mask_image):
     return average_tsnr
 
 
-def qa_the_dti(sub, dti_image, mask_image, shell_index_file, output_dir, overwrite):
+def _remove_files(file_list):
+    #This function deletes intermediate files that are no longer needed.
+    for element in file_list:
+        if os.path.exists(element):
+            logging.info('Removing intermediate file: {}'.format(element))
+            os.remove(element)
+
+
+def _run_cached(cache_info, stage, params, outputs, overwrite, run_stage, timing_list=None, checkpoint_info=None):
+    #This function runs one stage through the cache. On a hit the stage's
+    #output files are restored and its saved metrics returned; on a miss
+    #run_stage() is called, and the metrics dictionary it returns is stored
+    #with its output files. Without a cache the stage is simply run. Cache
+    #hits are recorded in timing_list, if given. With checkpoint_info (from
+    #dtak.open_checkpoints), a stage that finished in an earlier run on the
+    #same inputs is skipped, and one that was cut off is started again.
+    if checkpoint_info is not None:
+        stage_metrics = dtak.is_done(checkpoint_info, stage, params, outputs)
+        if stage_metrics is not None:
+            logging.info('Finished in an earlier run, skipping: {} {}'.format(stage, params.get('shell', '')))
+            return stage_metrics
+        dtak.mark_started(checkpoint_info, stage, params, outputs)
+
+    stage_metrics = None
+    if cache_info is not None:
+        key = dtac.stage_key(cache_info, stage, params)
+        if timing_list is None:
+            timing_list = []
+        with dtat.stage_timer(timing_list, stage+'_cache_fetch', params.get('shell')) as record:
+            stage_metrics = dtac.fetch(cache_info, key, outputs, overwrite=overwrite)
+            record['cached'] = stage_metrics is not None
+        if stage_metrics is not None:
+            logging.info('Cache hit, skipping: {} {}'.format(stage, params.get('shell', '')))
+    if stage_metrics is None:
+        stage_metrics = run_stage()
+        if cache_info is not None:
+            dtac.store(cache_info, key, outputs, stage_metrics)
+
+    if checkpoint_info is not None:
+        dtak.mark_done(checkpoint_info, stage, params, outputs, stage_metrics)
+    return stage_metrics
+
+
+def _run_stage_graph(stage_list, stage_jobs=1):
+    #This function runs a list of stages, each a (name, dependencies, function)
+    #tuple, starting every stage whose dependencies are done as soon as it is
+    #ready, with at most stage_jobs stages running at once. The stages are
+    #run on threads, which wait on the AFNI subprocesses side by side. With
+    #stage_jobs=1 they run one at a time in list order. Returns a dictionary
+    #of each stage's return value; if a stage fails, the running stages are
+    #left to finish and its exception is raised.
+    results = {}
+    if stage_jobs <= 1:
+        for name, dependencies, function in stage_list:
+            results[name] = function()
+        return results
+
+    pending = list(stage_list)
+    running = {}
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=stage_jobs) as executor:
+        while pending or running:
+            #Launch every ready stage while there is room
+            if error is None:
+                for stage in list(pending):
+                    name, dependencies, function = stage
+                    if len(running) >= stage_jobs:
+                        break
+                    if all([x in results for x in dependencies]):
+                        pending.remove(stage)
+                        running[executor.submit(function)] = name
+            if not running:
+                break
+            done, not_done = concurrent.futures.wait(list(running.keys()), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as err:
+                    if error is None:
+                        error = err
+    if error is not None:
+        raise error
+    if pending:
+        raise RuntimeError('stage dependencies cannot be met: {}'.format(', '.join([x[0] for x in pending])))
+    return results
+
+
+def qa_the_shell(shell_label, shell_volume_list, dti_image, mask_image, shell_file, overwrite=0, engine='afni', shell_stats=None, dti_img=None, mask_data=None, max_memory=None, cache_info=None, ephemeral=0, motion_engine=None, stage_jobs=1, shell_split=0, checkpoint_info=None, atlas_image=None, compression=None):
+    #This function runs every QA stage on one shell and returns a dictionary
+    #of its metrics, with the stage timing records under 'timing' and, with
+    #atlas_image, the regional rows under 'regional'. Shells share nothing,
+    #so they can be run in separate processes. shell_stats, dti_img and
+    #mask_data are what qa_the_dti already holds for the native engine;
+    #shell_split says the shell image is already written; ephemeral deletes
+    #each intermediate once it has been read. The other options are those
+    #of qa_the_dti (see the notes at the top).
+    logging.info('-------Starting: qa_the_shell {}-------'.format(shell_label))
+    shell_metrics = {}
+    timing_list = []
+
+    def timed(stage):
+        return dtat.stage_timer(timing_list, stage, shell_label)
+
+    #Set the output file names of this shell
+    shell_image = shell_file.format(shell_label)
+    mean_shell_image = __add_prefix(shell_image, '_mean')
+    tsnr_output = __add_prefix(shell_image, '_tsnr')
+    volreg_output = __add_prefix(shell_image, '_volreg')
+    maxdisp_output = volreg_output.split('.nii')[0]+'_maxdisp.txt'
+    motion_output = volreg_output.split('.nii')[0]+'_motion.1D'
+    shell_params = {'shell': shell_label, 'volumes': shell_volume_list, 'engine': engine, 'ext': shell_image.split('.nii')[-1]}
+
+    #Each stage is a (name, dependencies, function) tuple for _run_stage_graph
+    stage_list = []
+
+    def cached_stage(stage, params, outputs, run_stage):
+        return lambda: _run_cached(cache_info, stage, params, outputs, overwrite, run_stage, timing_list, checkpoint_info)
+
+    if engine == 'native':
+        def run_native():
+            if mask_data is None:
+                shell_mask_data = dtan.load_mask(mask_image)
+            else:
+                shell_mask_data = mask_data
+            shell_dti_img = dti_img
+            if shell_dti_img is None:
+                shell_dti_img = dtan.load_image(dti_image)
+
+            if shell_stats is None and max_memory is not None:
+                #Memory-bounded: AFNI cuts the shell image, NumPy streams the statistics
+                shell_volume_string = ','.join([str(x) for x in shell_volume_list])
+                if not shell_split:
+                    with timed('select_trs'):
+                        select_trs(dti_image, shell_image, shell_volume_string, overwrite=overwrite, compression=compression)
+                with timed('stream_mean_tsnr'):
+                    mean_data, tsnr_data = dtan.stream_mean_tsnr(shell_dti_img, shell_volume_list, shell_mask_data, max_memory)
+
+                #Gather the masked voxels slab by slab
+                with timed('outcount'):
+                    outcount_mean, outcount_max, outcount_array = dtan.stream_outcount(shell_dti_img, shell_volume_list, shell_mask_data, max_memory)
+
+                #Calculate average TSNR from the TSNR data still in memory
+                with timed('ave_tsnr'):
+                    tsnr = dtan.ave_tsnr(tsnr_data, shell_mask_data)
+            else:
+                stats = shell_stats
+                if stats is None:
+                    #Not handed over by qa_the_dti (e.g. evicted from the cache meanwhile)
+                    with timed('fused_shell_stats'):
+                        stats = dtan.fused_shell_stats(shell_dti_img, {shell_label: shell_volume_list}, shell_mask_data,
+                                                       shell_images={shell_label: shell_image}, overwrite=overwrite, compression=compression)[shell_label]
+                #The single pass through the DWI data wrote the shell image already
+                mean_data = stats['mean_data']
+                tsnr_data = stats['tsnr_data']
+
+                #Use the masked voxels gathered by the single pass
+                with timed('outcount'):
+                    outcount_mean, outcount_max, outcount_array = dtan.outcount(stats['masked_data'])
+                tsnr = stats['tsnr_mean']
+
+            #Write the mean and TSNR images of the shell
+            with timed('create_mean'):
+                dtan.write_image(mean_data, shell_dti_img, mean_shell_image, overwrite=overwrite, compression=compression)
+            with timed('calc_tsnr'):
+                dtan.write_image(tsnr_data, shell_dti_img, tsnr_output, overwrite=overwrite, compression=compression)
+            return {'outcount_mean': float(outcount_mean), 'outcount_max': int(outcount_max), 'tsnr_mean': float(tsnr)}
+
+        def native_stats_stage():
+            stage_metrics = _run_cached(cache_info, 'native_stats', shell_params,
+                                        [shell_image, mean_shell_image, tsnr_output], overwrite, run_native, timing_list, checkpoint_info)
+            if ephemeral and atlas_image is None:
+                _remove_files([tsnr_output])
+            return stage_metrics
+        stage_list.append(('native_stats', [], native_stats_stage))
+        mean_stage = 'native_stats'
+    else:
+        #Create an image of just the shell volumes
+        def run_select_trs():
+            if shell_split:
+                #Already written by dtan.split_shells
+                return {}
+            shell_volume_string = ','.join([str(x) for x in shell_volume_list])
+            with timed('select_trs'):
+                select_trs(dti_image, shell_image, shell_volume_string, overwrite=overwrite, compression=compression)
+            return {}
+        stage_list.append(('select_trs', [], cached_stage('select_trs', shell_params, [shell_image], run_select_trs)))
+
+        #Create the mean image of the shell
+        def run_create_mean():
+            with timed('create_mean'):
+                create_mean(shell_image, mean_shell_image, overwrite=overwrite, compression=compression)
+            return {}
+        stage_list.append(('create_mean', ['select_trs'], cached_stage('create_mean', shell_params, [mean_shell_image], run_create_mean)))
+        mean_stage = 'create_mean'
+
+        ##Extract outlier metrics##
+        #Use 3dToutcount on the shell image
+        def run_outcount():
+            with timed('outcount'):
+                outcount_mean, outcount_max = outcount(shell_image, mask_image)
+            return {'outcount_mean': float(outcount_mean), 'outcount_max': int(outcount_max)}
+        stage_list.append(('outcount', ['select_trs'], cached_stage('outcount', shell_params, [], run_outcount)))
+
+        ##Extract TSNR metrics
+        def run_tsnr():
+            #Create a 3D voxel-wise TSNR image
+            with timed('calc_tsnr'):
+                tsnr_image = calc_tsnr(shell_image, mask_image, tsnr_output, overwrite=overwrite, compression=compression)
+
+            #Calculate average TSNR from the 3D TSNR image
+            with timed('ave_tsnr'):
+                tsnr = ave_tsnr(tsnr_image, mask_image)
+            return {'tsnr_mean': float(tsnr)}
+        def tsnr_stage():
+            stage_metrics = _run_cached(cache_info, 'tsnr', shell_params, [tsnr_output], overwrite, run_tsnr, timing_list, checkpoint_info)
+            if ephemeral and atlas_image is None:
+                _remove_files([tsnr_output])
+            return stage_metrics
+        stage_list.append(('tsnr', ['select_trs'], tsnr_stage))
+
+    ##Extract regional metrics##
+    if atlas_image is not None:
+        #Every region of the atlas from the TSNR image and per-voxel
+        #outlier counts, with 3dToutcount's test done in-process
+        def run_regional():
+            with timed('regional'):
+                if mask_data is None:
+                    shell_mask_data = dtan.load_mask(mask_image)
+                else:
+                    shell_mask_data = mask_data
+                label_data = dtan.load_labels(atlas_image)
+                if label_data.shape != shell_mask_data.shape:
+                    logging.error('ERROR: atlas_image shape {} does not match mask_image shape {}!'.format(label_data.shape, shell_mask_data.shape))
+                    raise RuntimeError('atlas_image is not on the grid of the DWI data!')
+                if engine == 'native' and shell_stats is not None:
+                    #The masked voxels are still in memory from the single pass
+                    tsnr_data = shell_stats['tsnr_data']
+                    outlier_counts = dtan.voxel_outliers(shell_stats['masked_data']).sum(axis=1)
+                    outlier_data = dtan.scatter_masked(outlier_counts, dtan.mask_index(shell_mask_data), tsnr_data.shape)
+                elif engine == 'native' and max_memory is not None:
+                    tsnr_data = dtan.load_data(tsnr_output)[0]
+                    shell_dti_img = dti_img if dti_img is not None else dtan.load_image(dti_image)
+                    outlier_data = dtan.outlier_map(shell_dti_img, shell_volume_list, shell_mask_data, max_memory=max_memory)
+                else:
+                    tsnr_data = dtan.load_data(tsnr_output)[0]
+                    shell_img = dtan.load_image(shell_image)
+                    outlier_data = dtan.outlier_map(shell_img, list(range(shell_img.shape[3])), shell_mask_data)
+                regional_rows = dtan.regional_stats(label_data, shell_mask_data, tsnr_data, outlier_data, len(shell_volume_list))
+            return {'regional': regional_rows}
+        tsnr_stage_name = 'native_stats' if engine == 'native' else 'tsnr'
+        stage_list.append(('regional', [tsnr_stage_name], cached_stage('regional', shell_params, [], run_regional)))
+
+    ##Extract motion metrics##
+    if motion_engine is None:
+        motion_engine = engine
+    motion_params = dict(shell_params, motion_engine=motion_engine)
+    if motion_engine == 'native':
+        #Estimate the motion in-process; no registered image is written
+        motion_outputs = [motion_output, maxdisp_output]
+        def run_motion_correct():
+            with timed('motion_correct'):
+                if mask_data is None:
+                    shell_mask_data = dtan.load_mask(mask_image)
+                else:
+                    shell_mask_data = mask_data
+                mean_data, mean_img = dtan.load_data(mean_shell_image)
+                params_array, maxdisp_array = dtan.motion_correct(shell_image, mean_data, shell_mask_data)
+                dtan.write_motion_files(params_array, maxdisp_array, motion_output, maxdisp_output, overwrite=overwrite)
+            return {'maxdisp': float(maxdisp_array.max())}
+    else:
+        motion_outputs = [volreg_output, maxdisp_output]
+        def run_motion_correct():
+            #Create motion correction files
+            with timed('motion_correct'):
+                volreg_image, maxdisp_file = motion_correct(shell_image, mean_shell_image, volreg_output, overwrite=overwrite, compression=compression)
+
+            #Find maximum max displacement for this shell
+            with open(maxdisp_file, 'r') as fid:
+                maxdisp_contents = fid.read()
+            maxdisp_array = numpy.array(maxdisp_contents.split('\n ')[1:], dtype=float)
+            return {'maxdisp': float(maxdisp_array.max())}
+    stage_list.append(('motion_correct', [mean_stage], cached_stage('motion_correct', motion_params, motion_outputs, run_motion_correct)))
+
+    #Run the stages, overlapping those that do not depend on each other
+    stage_results = _run_stage_graph(stage_list, stage_jobs)
+    for name, dependencies, function in stage_list:
+        shell_metrics.update(stage_results[name])
+    if ephemeral:
+        _remove_files(motion_outputs+[shell_image, mean_shell_image, tsnr_output])
+
+    shell_metrics['timing'] = timing_list
+    logging.info('-------Done: qa_the_shell {}-------'.format(shell_label))
+    return shell_metrics
+
+
+def qa_the_dti(sub, dti_image, mask_image, shell_index_file, output_dir, overwrite, engine='afni', jobs=1, max_memory=None, cache_dir=None, cache_size=None, scratch_dir=None, timing=0, motion_engine=None, stage_jobs=1, results_db=None, atlas_image=None, compression=None, split_shells=1):
+    #This function runs the QA of one DWI image, shell by shell, and writes
+    #its metrics CSV in output_dir (plus the regional CSV and timing sidecar
+    #if asked for). The options are described in the notes at the top.
+    #Returns the path of the metrics CSV; errors are logged and raised
+    #again.
 
     #Check inputs
+    if engine not in ENGINES:
+        logging.error('ERROR: engine not recognized: {}'.format(engine))
+        raise RuntimeError('engine must be one of: {}'.format(', '.join(ENGINES)))
+    if motion_engine is None:
+        motion_engine = engine
+    if motion_engine not in ENGINES:
+        logging.error('ERROR: motion_engine not recognized: {}'.format(motion_engine))
+        raise RuntimeError('motion_engine must be one of: {}'.format(', '.join(ENGINES)))
+
+    if int(jobs) < 1:
+        logging.error('ERROR: jobs must be at least 1: {}'.format(jobs))
+        raise RuntimeError('jobs must be at least 1!')
+    jobs = int(jobs)
+
+    if int(stage_jobs) < 1:
+        logging.error('ERROR: stage_jobs must be at least 1: {}'.format(stage_jobs))
+        raise RuntimeError('stage_jobs must be at least 1!')
+    stage_jobs = int(stage_jobs)
+
+    if max_memory is not None and engine != 'native':
+        logging.info('max_memory only applies to the native engine; ignoring it.')
+        max_memory = None
+
     if not os.path.exists(dti_image):
         logging.error('ERROR: dti_image cannot be found: {}'.format(dti_image))
         raise RuntimeError('dti_image not found!')
 
-    output_file = __add_prefix(dti_image, '_QA_metrics')
-    output_file = output_file.split('.nii')[0]+'.csv'
-    output_file = os.path.join(output_dir, os.path.split(output_file)[-1])
+    output_file = metrics_file(dti_image, output_dir)
 
     if os.path.exists(output_file) and overwrite==0:
         logging.error('ERROR: output_file exists and overwrite not set!')
@@ -449,6 +871,23 @@ def qa_the_dti(sub, dti_image, mask_image, shell_index_file, output_dir, overwri
         logging.error('ERROR: shell_index_file not found: {}'.format(shell_index_file))
         raise RuntimeError('shell_index_file not found!')
 
+    if scratch_dir is not None and not os.path.isdir(scratch_dir):
+        logging.error('ERROR: scratch_dir cannot be found: {}'.format(scratch_dir))
+        raise RuntimeError('scratch_dir not found!')
+
+    input_files = [dti_image, mask_image, shell_index_file]
+    if atlas_image is not None:
+        if not os.path.exists(atlas_image):
+            logging.error('ERROR: atlas_image cannot be found: {}'.format(atlas_image))
+            raise RuntimeError('atlas_image not found!')
+        if dtan.nibabel is None:
+            logging.error('ERROR: regional metrics need nibabel, which could not be imported!')
+            raise RuntimeError('atlas_image given but nibabel not available')
+        input_files.append(atlas_image)
+
+    work_dir = None
+    timing_list = []
+    run_start = dtat.snapshot()
     try:
         #Create dictionary to house the information for each shell
         metric_dict = {}
@@ -459,9 +898,7 @@ def qa_the_dti(sub, dti_image, mask_image, shell_index_file, output_dir, overwri
             os.makedirs(output_dir)
 
         #Read in b0 shell index file ('0' means a b=0 volume, '1' indicates the first shell, '2' indicates the second shell, etc.)
-        with open(shell_index_file, 'r') as fid:
-            contents = fid.read()
-        shell_index_list = contents.split(' ')
+        shell_index_list = read_shell_index(shell_index_file)
         ##Determine which volumes correspond to each shell
         #Find the number of unique entries in the shell index list
         unique_shell_list = list(set(shell_index_list))
@@ -470,75 +907,202 @@ def qa_the_dti(sub, dti_image, mask_image, shell_index_file, output_dir, overwri
             logging.error('ERROR: shell_index_file did not contain any 0s, suggesting no b=0 volumes! There should be at least one!')
             raise RuntimeError('shell_index_file contains no 0s')
 
-        #Create the masked output file name
+        #Pick up the stages and shells an earlier run on these inputs finished
+        checkpoint_info = dtak.open_checkpoints(output_dir, input_files, overwrite=overwrite)
+        #Intermediates in a scratch directory do not outlive the run, so
+        #then only whole shells are checkpointed, so that a scratch run that
+        #is cut off can be resumed; the checkpoints are removed once it
+        #finishes, leaving only the metrics CSV
+        stage_checkpoint_info = checkpoint_info if scratch_dir is None else None
+
+        #Key the cache on the contents of the inputs
+        cache_info = None
+        if cache_dir is not None:
+            with dtat.stage_timer(timing_list, 'open_cache'):
+                cache_info = dtac.open_cache(cache_dir, input_files, max_size=cache_size)
+
+        #The masked image is never read (the AFNI stages mask for
+        #themselves), so it is not made; its name is kept as the stem of
+        #the shell file names
         masked_output = os.path.join(output_dir, os.path.split(__add_prefix(dti_image, '_brain'))[-1])
-
-        #Apply the mask to the full dwi image
-        dti_masked_image = apply_mask(dti_image, mask_image, masked_output, overwrite=overwrite, skip=1)
+        if scratch_dir is not None:
+            work_dir = tempfile.mkdtemp(dir=scratch_dir, prefix='dti_qa_')
+            logging.info('Writing intermediates to scratch directory: {}'.format(work_dir))
+            dti_masked_image = os.path.join(work_dir, os.path.split(masked_output)[-1].split('.nii')[0]+'.nii')
+        else:
+            dti_masked_image = masked_output
 
         #Set the shell file name template
         shell_file = __add_prefix(dti_masked_image, '_shell{}')
 
         number_of_shells = len(unique_shell_list)-1
         unique_shell_list.sort()
+        shell_volume_lists = {}
         for element in unique_shell_list:
             #For each shell...
             if element != '0':
                 shell_label = element
-                metric_dict[shell_label] = {}
-                shell_volume_string = ''
                 #Create list of volumes in this shell
+                shell_volume_list = []
                 for count in range(len(shell_index_list)):
                     if shell_index_list[count] == shell_label:
-                        shell_volume_string = shell_volume_string+str(count)+','
-                #Remove the trailing ','
-                shell_volume_string = shell_volume_string[:-1]
-                #Create an image of just the shell volumes
-                output_image = shell_file.format(shell_label)
-                shell_image = select_trs(dti_image, output_image, shell_volume_string, overwrite=overwrite)
-
-                #Create the mean image of the shell
-                mean_output = __add_prefix(shell_image, '_mean')
-                mean_shell_image = create_mean(shell_image, mean_output, overwrite=overwrite)
-
-                ##Extract outlier metrics##
-                #Use 3dToutcount on the shell image
-                outcount_mean, outcount_max = outcount(shell_image, mask_image)
-
-                #Save the outcount mean and max to the working dictionary
-                metric_dict[shell_label]['outcount_mean'] = outcount_mean
-                metric_dict[shell_label]['outcount_max'] = outcount_max
-
-                ##Extract motion metrics##
-                #Create motion correction files
-                volreg_output = __add_prefix(shell_image, '_volreg')
-                volreg_image, maxdisp_file = motion_correct(shell_image, mean_shell_image, volreg_output, overwrite=overwrite)
-
-                #Find maximum max displacement for this shell
-                with open(maxdisp_file, 'r') as fid:
-                    maxdisp_contents = fid.read()
-                maxdisp_array = numpy.array(maxdisp_contents.split('\n ')[1:], dtype=float)
-                metric_dict[shell_label]['maxdisp'] = maxdisp_array.max()
-
-                ##Extract TSNR metrics
-                #Create a 3D voxel-wise TSNR image
-                tsnr_output = __add_prefix(shell_image, '_tsnr')
-                tsnr_image = calc_tsnr(shell_image, mask_image, tsnr_output, overwrite=overwrite)
-
-                #Calculate average TSNR from the 3D TSNR image
-                tsnr = ave_tsnr(tsnr_image, mask_image)
-                metric_dict[shell_label]['tsnr_mean'] = tsnr
-
-        header_line = 'sub,shell,outcount_mean,outcount_max,maxdisp,tsnr_mean'
+                        shell_volume_list.append(count)
+                shell_volume_lists[shell_label] = shell_volume_list
+
+        def shell_params(shell_label, stage):
+            #The parameters qa_the_shell keys a shell's stages on
+            params = {'shell': shell_label, 'volumes': shell_volume_lists[shell_label], 'engine': engine, 'ext': shell_file.split('.nii')[-1]}
+            if stage == 'shell':
+                params['motion_engine'] = motion_engine
+            return params
+
+        def stage_outputs(shell_label, stage):
+            shell_image = shell_file.format(shell_label)
+            if stage == 'native_stats':
+                return [shell_image, __add_prefix(shell_image, '_mean'), __add_prefix(shell_image, '_tsnr')]
+            return [shell_image]
+
+        def stage_done(shell_label, stage):
+            #Whether a shell's stage can be skipped: cached or checkpointed
+            if cache_info is not None and dtac.has_entry(cache_info, dtac.stage_key(cache_info, stage, shell_params(shell_label, stage))):
+                return True
+            return stage_checkpoint_info is not None and dtak.is_done(stage_checkpoint_info, stage, shell_params(shell_label, stage), stage_outputs(shell_label, stage)) is not None
+
+        def start_stage(shell_label, stage):
+            #Clear what an interrupted run left of a stage before a pass writes its outputs
+            if stage_checkpoint_info is not None:
+                dtak.mark_started(stage_checkpoint_info, stage, shell_params(shell_label, stage), stage_outputs(shell_label, stage))
+
+        #Shells finished by an earlier run are not run again
+        for shell_label in list(shell_volume_lists.keys()):
+            shell_metrics = dtak.is_done(checkpoint_info, 'shell', shell_params(shell_label, 'shell'), [])
+            if shell_metrics is not None:
+                logging.info('Shell {} finished in an earlier run, skipping it.'.format(shell_label))
+                metric_dict[shell_label] = shell_metrics
+        run_shell_list = [x for x in shell_volume_lists.keys() if x not in metric_dict]
+
+        #The native engine reads the DWI data and mask a single time
+        if engine == 'native':
+            #Resolve the mask once into the flat voxel index the shells share
+            mask_data = dtan.load_mask(mask_image)
+            voxel_index = dtan.mask_index(mask_data)
+            logging.info('Mask holds {} of {} voxels.'.format(voxel_index.size, mask_data.size))
+            if max_memory is None:
+                dti_img = dtan.load_image(dti_image)
+                #Shells whose results are cached can be left out of the pass
+                pass_volume_lists = {}
+                shell_images = {}
+                for shell_label in run_shell_list:
+                    if stage_done(shell_label, 'native_stats'):
+                        continue
+                    start_stage(shell_label, 'native_stats')
+                    pass_volume_lists[shell_label] = shell_volume_lists[shell_label]
+                    shell_images[shell_label] = shell_file.format(shell_label)
+                fused_stats = {}
+                if pass_volume_lists:
+                    with dtat.stage_timer(timing_list, 'fused_shell_stats'):
+                        fused_stats = dtan.fused_shell_stats(dti_img, pass_volume_lists, mask_data, shell_images=shell_images, overwrite=overwrite, index=voxel_index, compression=compression)
+
+        #Otherwise cut every shell image out of the DWI data in one pass,
+        #rather than one 3dTcat (and one inflation of a .nii.gz) per shell
+        split_shell_list = []
+        if split_shells and dtan.nibabel is not None and (engine == 'afni' or max_memory is not None):
+            split_stage = 'select_trs' if engine == 'afni' else 'native_stats'
+            split_volume_lists = {}
+            shell_images = {}
+            for shell_label in run_shell_list:
+                if stage_done(shell_label, split_stage):
+                    continue
+                start_stage(shell_label, split_stage)
+                split_volume_lists[shell_label] = shell_volume_lists[shell_label]
+                shell_images[shell_label] = shell_file.format(shell_label)
+            if split_volume_lists:
+                with dtat.stage_timer(timing_list, 'split_shells'):
+                    dtan.split_shells(dtan.load_image(dti_image), split_volume_lists, shell_images, overwrite=overwrite, compression=compression)
+                split_shell_list = list(split_volume_lists.keys())
+
+        shell_args = []
+        for shell_label in run_shell_list:
+            shell_volume_list = shell_volume_lists[shell_label]
+            shell_kwargs = {'overwrite': overwrite, 'engine': engine, 'cache_info': cache_info, 'ephemeral': int(scratch_dir is not None), 'motion_engine': motion_engine, 'stage_jobs': stage_jobs,
+                            'shell_split': int(shell_label in split_shell_list), 'checkpoint_info': stage_checkpoint_info, 'atlas_image': atlas_image,
+                            'compression': compression}
+            if engine == 'native' and max_memory is not None:
+                #Split the memory budget between the shells run at once
+                shell_kwargs['mask_data'] = mask_data
+                shell_kwargs['max_memory'] = max(1, int(max_memory) // min(jobs, number_of_shells))
+            elif engine == 'native':
+                #Hand each shell only its own results from the single pass
+                shell_kwargs['shell_stats'] = fused_stats.get(shell_label)
+                shell_kwargs['dti_img'] = dti_img
+                shell_kwargs['mask_data'] = mask_data
+            shell_args.append(((shell_label, shell_volume_list, dti_image, mask_image, shell_file), shell_kwargs))
+
+        if jobs > 1 and len(shell_args) > 1:
+            #Run the shells on a process pool, then collect the results in shell order
+            logging.info('Running {} shells on {} processes...'.format(len(shell_args), min(jobs, len(shell_args))))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(shell_args))) as executor:
+                futures = [executor.submit(qa_the_shell, *args, **kwargs) for args, kwargs in shell_args]
+                #Checkpoint every shell that finished, even if another failed
+                shell_error = None
+                for future in concurrent.futures.as_completed(futures):
+                    shell_label = shell_args[futures.index(future)][0][0]
+                    try:
+                        shell_metrics = future.result()
+                    except Exception as err:
+                        shell_error = shell_error or err
+                        continue
+                    metric_dict[shell_label] = shell_metrics
+                    dtak.mark_done(checkpoint_info, 'shell', shell_params(shell_label, 'shell'), [], {x: shell_metrics[x] for x in shell_metrics if x != 'timing'})
+                if shell_error is not None:
+                    raise shell_error
+        else:
+            for args, kwargs in shell_args:
+                shell_metrics = qa_the_shell(*args, **kwargs)
+                metric_dict[args[0]] = shell_metrics
+                dtak.mark_done(checkpoint_info, 'shell', shell_params(args[0], 'shell'), [], {x: shell_metrics[x] for x in shell_metrics if x != 'timing'})
+
+        header_line = METRIC_HEADER
         lines_to_write = []
         lines_to_write.append(header_line)
-        for key in metric_dict.keys():
+        for key in sorted(metric_dict.keys()):
             new_line = '{},{},{},{},{},{}'.format(sub,key,metric_dict[key]['outcount_mean'],metric_dict[key]['outcount_max'],metric_dict[key]['maxdisp'],metric_dict[key]['tsnr_mean'])
             lines_to_write.append(new_line)
         logging.info('Writing output file: {}'.format(output_file))
         with open(output_file, 'w') as fid:
             for line in lines_to_write:
                 fid.write(line+'\n')
+        if results_db is not None:
+            dtar.store_metrics(results_db, sub, metric_dict)
+
+        if atlas_image is not None:
+            regional_file = output_file.split('.csv')[0]+'_regional.csv'
+            logging.info('Writing regional metrics file: {}'.format(regional_file))
+            with open(regional_file, 'w') as fid:
+                fid.write(REGIONAL_HEADER+'\n')
+                for key in sorted(metric_dict.keys()):
+                    for region, voxels, tsnr_mean, outlier_rate in metric_dict[key]['regional']:
+                        fid.write('{},{},{},{},{},{}\n'.format(sub, key, region, voxels, tsnr_mean, outlier_rate))
+
+        if timing:
+            #Put the run total first, then the stages in shell order
+            all_timing = [dtat.make_record('qa_the_dti', None, run_start, dtat.snapshot())]+timing_list
+            for key in sorted(metric_dict.keys()):
+                all_timing = all_timing+metric_dict[key].get('timing', [])
+            timing_file = output_file.split('.csv')[0]+'_timing.json'
+            run_info = {'sub': sub, 'dti_image': dti_image, 'engine': engine, 'motion_engine': motion_engine, 'jobs': jobs, 'stage_jobs': stage_jobs,
+                        'max_memory': max_memory, 'cache_dir': cache_dir, 'scratch_dir': scratch_dir, 'results_db': results_db, 'atlas_image': atlas_image, 'compression': compression,
+                        'split_shells': split_shells}
+            dtat.write_timing(all_timing, timing_file, run_info=run_info)
+        if scratch_dir is not None:
+            dtak.remove_checkpoints(checkpoint_info)
         logging.info('Finished well.')
     except Exception as err:
-        logging.error('Something went wrong: {}'.format(err))
\ No newline at end of file
+        #Leave the checkpoints for a rerun, but let the caller know
+        logging.error('Something went wrong: {}'.format(err))
+        raise
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return output_file
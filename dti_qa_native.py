@@ -0,0 +1,874 @@
+import os
+import math
+import logging
+import contextlib
+import statistics
+import numpy
+import dti_qa_gzindex as dtag
+import dti_qa_pgzip as dtaz
+
+#nibabel is only needed by the native engine, so AFNI-only installs
+#can still import this module.
+try:
+    import nibabel
+    import nibabel.openers
+except ImportError:
+    nibabel = None
+
+
+def _check_image(input_image, func_name):
+    #Make sure an image file name has a full path and is a .nii or .nii.gz
+    input_path, input_file = os.path.split(input_image)
+    if input_path == '':
+        logging.error('ERROR: image must contain a full path to the image file: {}'.format(input_image))
+        raise RuntimeError('{}: bad input image'.format(func_name))
+    if len(input_file.split('.nii')) == 1:
+        logging.error('ERROR: image file type not recognized. Should be .nii or .nii.gz: {}'.format(input_image))
+        raise RuntimeError('{}: bad input image'.format(func_name))
+
+
+def _check_output(output_image, overwrite, func_name):
+    #Delete an existing output image if overwrite is set, otherwise complain.
+    if os.path.exists(output_image):
+        logging.info('output_image already exists...')
+        if overwrite:
+            logging.info('Overwrite set to 1, deleting...')
+            os.remove(output_image)
+        else:
+            logging.error('ERROR: output_image already there and overwrite not set!')
+            raise RuntimeError('{}: output_image already exists!'.format(func_name))
+
+
+def load_image(input_image):
+    #This function loads a .nii or .nii.gz image with nibabel. The data
+    #are not read until they are asked for; uncompressed .nii data are
+    #memory-mapped read-only.
+    if nibabel is None:
+        logging.error('ERROR: the native engine requires nibabel, which could not be imported!')
+        raise RuntimeError('load_image: nibabel not available')
+    _check_image(input_image, 'load_image')
+    if not os.path.exists(input_image):
+        logging.error('ERROR: image cannot be found: {}'.format(input_image))
+        raise RuntimeError('load_image: image not found')
+    return nibabel.load(input_image, mmap='r')
+
+
+def load_data(input_image):
+    #This function loads the voxel data of an image as float32 and
+    #returns it along with the nibabel image it came from.
+    logging.info('Loading image data: {}'.format(input_image))
+    img = load_image(input_image)
+    data = img.get_fdata(dtype=numpy.float32)
+    return data, img
+
+
+def load_mask(mask_image):
+    #This function loads a mask image as a boolean array (nonzero is in).
+    img = load_image(mask_image)
+    return numpy.asanyarray(img.dataobj) != 0
+
+
+def mask_index(mask_data):
+    #This function resolves a mask into the flat indices of its voxels in
+    #Fortran order, the order NIfTI stores voxels in, so the masked voxels
+    #of a volume read from file are volume.ravel(order='F')[index].
+    return numpy.flatnonzero(numpy.asarray(mask_data).ravel(order='F'))
+
+
+def gather_masked(data, index):
+    #This function returns the masked voxels of a 3D array as a flat array.
+    return numpy.asarray(data).ravel(order='F')[index]
+
+
+def scatter_masked(values, index, shape):
+    #This function puts the masked voxel values back into a 3D float32
+    #array of the given shape, with 0 outside the mask.
+    data = numpy.zeros(shape, dtype=numpy.float32, order='F')
+    data.ravel(order='F')[index] = values
+    return data
+
+
+def write_image(data, template_img, output_image, overwrite=0, compression=None):
+    #This function writes a float32 array to a NIfTI file, using the
+    #geometry of template_img. A .nii.gz is gzipped on several threads if
+    #compression (from dtaz.compression_options) is given.
+    if compression is not None and output_image.endswith('.gz'):
+        data = numpy.asarray(data, dtype=numpy.float32)
+        fid = _open_volume_writer(output_image, template_img, data.shape[3] if data.ndim == 4 else None, overwrite=overwrite, compression=compression)
+        try:
+            fid.write(data.tobytes(order='F'))
+        except BaseException:
+            _abort_writers([fid])
+            raise
+        fid.close()
+    else:
+        _check_output(output_image, overwrite, 'write_image')
+        header = template_img.header.copy()
+        header.set_data_dtype(numpy.float32)
+        out_img = nibabel.Nifti1Image(numpy.asarray(data, dtype=numpy.float32), template_img.affine, header)
+        nibabel.save(out_img, output_image)
+    if not os.path.exists(output_image):
+        logging.error('ERROR: output_image should be there, but is not: {}'.format(output_image))
+        raise RuntimeError('write_image: writing output_image failed!')
+    return output_image
+
+
+def select_trs(dti_data, volume_list):
+    #This function returns the volumes of a 4D array that belong to a shell.
+    return dti_data[..., volume_list]
+
+
+def create_mean(shell_data):
+    #This function calculates the voxel-wise mean of a 4D array, the same
+    #as AFNI's 3dTstat -mean.
+    logging.info('-------Starting: create_mean (native)-------')
+    mean_data = shell_data.mean(axis=3, dtype=numpy.float64).astype(numpy.float32)
+    logging.info('-------Done: create_mean (native)-------')
+    return mean_data
+
+
+def calc_tsnr(shell_data, mask_data, mean_data=None):
+    #This function calculates a voxel-wise TSNR image, the same as AFNI's
+    #3dTstat -tsnr -mask: fabs(mean)/stdev, not detrended, with the
+    #sample (N-1) standard deviation. Voxels outside the mask or with
+    #zero variance are set to 0.
+    logging.info('-------Starting: calc_tsnr (native)-------')
+    if mean_data is None:
+        mean_data = shell_data.mean(axis=3, dtype=numpy.float64)
+    if shell_data.shape[3] < 2:
+        logging.error('ERROR: TSNR needs at least two volumes!')
+        raise RuntimeError('calc_tsnr: too few volumes')
+    stdev_data = shell_data.std(axis=3, ddof=1, dtype=numpy.float64)
+    tsnr_data = numpy.zeros(stdev_data.shape, dtype=numpy.float64)
+    good = mask_data & (stdev_data > 0)
+    tsnr_data[good] = numpy.abs(mean_data[good])/stdev_data[good]
+    logging.info('-------Done: calc_tsnr (native)-------')
+    return tsnr_data.astype(numpy.float32)
+
+
+def ave_tsnr(tsnr_data, mask_data):
+    #This function calculates the mean of the nonzero voxels of a TSNR
+    #image inside a mask, the same as AFNI's 3dROIstats -nzmean.
+    logging.info('-------Starting: ave_tsnr (native)-------')
+    values = tsnr_data[mask_data]
+    values = values[values != 0]
+    if values.size == 0:
+        average_tsnr = 0.0
+    else:
+        average_tsnr = float(values.mean(dtype=numpy.float64))
+    logging.info('-------Done: ave_tsnr (native)-------')
+    return average_tsnr
+
+
+def parse_memory_size(memory_string):
+    #This function turns a memory size such as '512M', '2G' or '1000000'
+    #into a number of bytes.
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    memory_string = str(memory_string).strip().upper()
+    if memory_string.endswith('B'):
+        memory_string = memory_string[:-1]
+    factor = 1
+    if memory_string and memory_string[-1] in units:
+        factor = units[memory_string[-1]]
+        memory_string = memory_string[:-1]
+    try:
+        memory_bytes = int(float(memory_string)*factor)
+    except ValueError:
+        raise ValueError('memory size not understood: {}'.format(memory_string))
+    if memory_bytes < 1:
+        raise ValueError('memory size must be positive')
+    return memory_bytes
+
+
+@contextlib.contextmanager
+def _slab_reader(img):
+    #This function gives, for a with statement, a function that reads voxels
+    #[:, :, z0:z1, v] of a 4D image as float64; any file it opened is closed
+    #when the with statement ends. Uncompressed images are read through a read-only
+    #memory map. Compressed images are read through their seek-point index
+    #(see dtag.open_indexed), so each slab only inflates the data just
+    #before it, or else through nibabel's array proxy, which has to inflate
+    #the file up to each requested slab.
+    proxy = img.dataobj
+    slope = float(proxy.slope)
+    inter = float(proxy.inter)
+    raw_data = None
+    indexed_fid = None
+    if getattr(proxy, '_mmap', False) and not img.get_filename().endswith('.gz'):
+        raw_data = proxy.get_unscaled()
+    else:
+        indexed_fid, loaded = dtag.open_indexed(img.get_filename())
+        if indexed_fid is None:
+            logging.info('Image is compressed and cannot be memory-mapped; reading slabs through gzip.')
+    shape = img.shape[:3]
+    dtype = img.header.get_data_dtype()
+    slice_bytes = int(shape[0])*int(shape[1])*dtype.itemsize
+
+    def read_slab(z0, z1, volume):
+        if raw_data is not None:
+            slab = numpy.array(raw_data[:, :, z0:z1, volume], dtype=numpy.float64)
+        elif indexed_fid is not None:
+            #Slices z0 to z1 of a volume are contiguous in the file
+            indexed_fid.seek(int(proxy.offset)+(volume*int(shape[2])+z0)*slice_bytes)
+            buffer = indexed_fid.read((z1-z0)*slice_bytes)
+            slab = numpy.frombuffer(buffer, dtype=dtype).reshape(shape[:2]+(z1-z0,), order='F').astype(numpy.float64)
+        else:
+            return numpy.asarray(proxy[:, :, z0:z1, volume], dtype=numpy.float64)
+        if slope != 1.0 or inter != 0.0:
+            slab = slab*slope+inter
+        return slab
+
+    try:
+        yield read_slab
+    finally:
+        if indexed_fid is not None:
+            indexed_fid.close()
+
+
+def plan_slabs(shape, n_volumes, max_memory):
+    #This function picks how many z-slices and how many volumes to hold at
+    #once so that the working set of the streaming statistics stays under
+    #max_memory bytes. Each voxel of a slab needs 16 bytes of running mean
+    #and sum of squares plus 8 bytes for every volume read at once.
+    slice_voxels = int(shape[0])*int(shape[1])
+    volume_batch = n_volumes
+    slab_slices = max_memory // (slice_voxels*(16+8*volume_batch))
+    if slab_slices < 1:
+        volume_batch = max(1, (max_memory // slice_voxels - 16) // 8)
+        volume_batch = min(volume_batch, n_volumes)
+        slab_slices = max(1, max_memory // (slice_voxels*(16+8*volume_batch)))
+    slab_slices = min(slab_slices, int(shape[2]))
+    return int(slab_slices), int(volume_batch)
+
+
+def stream_mean_tsnr(dti_img, volume_list, mask_data, max_memory):
+    #This function computes the mean and TSNR images of the volumes of
+    #dti_img listed in volume_list without loading the 4D data. The image
+    #is processed in slabs of z-slices sized to max_memory, and within a
+    #slab the mean and sum of squared deviations are accumulated over
+    #batches of volumes (Chan et al. pairwise update), so the full series is
+    #never held in memory. Returns float32 mean and TSNR arrays that match
+    #create_mean and calc_tsnr.
+    logging.info('-------Starting: stream_mean_tsnr (native)-------')
+    shape = dti_img.shape[:3]
+    n_volumes = len(volume_list)
+    if n_volumes < 2:
+        logging.error('ERROR: TSNR needs at least two volumes!')
+        raise RuntimeError('stream_mean_tsnr: too few volumes')
+    slab_slices, volume_batch = plan_slabs(shape, n_volumes, max_memory)
+    logging.info('Using slabs of {} slices and batches of {} volumes.'.format(slab_slices, volume_batch))
+
+    mean_data = numpy.zeros(shape, dtype=numpy.float32)
+    tsnr_data = numpy.zeros(shape, dtype=numpy.float32)
+    with _slab_reader(dti_img) as read_slab:
+        for z0 in range(0, shape[2], slab_slices):
+            z1 = min(z0+slab_slices, shape[2])
+            count = 0
+            run_mean = numpy.zeros(shape[:2]+(z1-z0,), dtype=numpy.float64)
+            run_m2 = numpy.zeros(shape[:2]+(z1-z0,), dtype=numpy.float64)
+            for b0 in range(0, n_volumes, volume_batch):
+                batch_volumes = volume_list[b0:b0+volume_batch]
+                batch = numpy.stack([read_slab(z0, z1, v) for v in batch_volumes], axis=3)
+                batch_count = len(batch_volumes)
+                batch_mean = batch.mean(axis=3)
+                batch_m2 = ((batch-batch_mean[..., None])**2).sum(axis=3)
+                delta = batch_mean-run_mean
+                total = count+batch_count
+                run_mean += delta*(batch_count/total)
+                run_m2 += batch_m2+delta**2*(count*batch_count/total)
+                count = total
+            stdev = numpy.sqrt(run_m2/(count-1))
+            slab_tsnr = numpy.zeros(stdev.shape, dtype=numpy.float64)
+            good = mask_data[:, :, z0:z1] & (stdev > 0)
+            slab_tsnr[good] = numpy.abs(run_mean[good])/stdev[good]
+            mean_data[:, :, z0:z1] = run_mean
+            tsnr_data[:, :, z0:z1] = slab_tsnr
+
+    logging.info('-------Done: stream_mean_tsnr (native)-------')
+    return mean_data, tsnr_data
+
+
+def _iter_volume_bytes(img, volume_list, keep_index=1):
+    #This function yields (volume index, raw bytes as stored in the file)
+    #for the volumes of a 4D image listed in volume_list, in increasing
+    #order. The file is opened once and read front to back, so each volume
+    #is read (and, for .nii.gz, inflated) a single time. Unless keep_index
+    #is 0 (e.g. for intermediates), the seek-point index of a .nii.gz is
+    #saved next to it for later reads.
+    shape = img.shape[:3]
+    dtype = img.header.get_data_dtype()
+    volume_bytes = int(numpy.prod(shape))*dtype.itemsize
+    offset = int(img.dataobj.offset)
+    filename = img.get_filename()
+    #A .nii.gz is read through its seek-point index when there is one, so
+    #skipped volumes are not inflated; otherwise one is made along the way
+    fid, loaded = dtag.open_indexed(filename, build=0)
+    indexed = fid is not None
+    if not indexed:
+        fid = nibabel.openers.ImageOpener(filename, 'rb')
+    with fid:
+        position = 0
+        for volume in sorted(volume_list):
+            start = offset+volume*volume_bytes
+            if start != position:
+                fid.seek(start)
+            buffer = fid.read(volume_bytes)
+            if len(buffer) != volume_bytes:
+                logging.error('ERROR: image ended before volume {}!'.format(volume))
+                raise RuntimeError('_iter_volume_bytes: image file is truncated')
+            position = start+volume_bytes
+            yield volume, buffer
+        if indexed and not loaded and keep_index and volume_list:
+            dtag.save_index(fid, filename, complete=int(max(volume_list) == img.shape[3]-1))
+
+
+def iter_volumes(img, volume_list, keep_index=1):
+    #This function yields (volume index, float32 3D array) for the volumes
+    #of a 4D image listed in volume_list, in increasing order, reading the
+    #file a single time (see _iter_volume_bytes). The file is closed when
+    #the last volume has been read; callers that may stop early should close
+    #the iterator (e.g. with contextlib.closing).
+    shape = img.shape[:3]
+    proxy = img.dataobj
+    dtype = img.header.get_data_dtype()
+    slope = float(proxy.slope)
+    inter = float(proxy.inter)
+    for volume, buffer in _iter_volume_bytes(img, volume_list, keep_index=keep_index):
+        data = numpy.frombuffer(buffer, dtype=dtype).reshape(shape, order='F').astype(numpy.float32)
+        if slope != 1.0 or inter != 0.0:
+            data = data*numpy.float32(slope)+numpy.float32(inter)
+        yield volume, data
+
+
+def iter_array_volumes(dti_data, volume_list):
+    #This function yields (volume index, 3D view) for the volumes of a 4D
+    #array listed in volume_list, in increasing order, without copying them.
+    for volume in sorted(volume_list):
+        yield volume, dti_data[..., volume]
+
+
+def _open_volume_writer(output_image, template_img, n_volumes, overwrite=0, keep_dtype=0, compression=None):
+    #This function starts a 4D NIfTI file with the geometry of template_img
+    #and returns the open file, ready for the volumes to be written one
+    #after the other with fid.write(volume.tobytes(order='F')). The file is
+    #float32 unless keep_dtype is set, in which case it keeps the data type
+    #and scaling of template_img so raw volumes can be copied straight in.
+    #If n_volumes is None the file is 3D. A .nii.gz is gzipped on several
+    #threads if compression (from dtaz.compression_options) is given.
+    _check_output(output_image, overwrite, '_open_volume_writer')
+    header = template_img.header.copy()
+    if keep_dtype:
+        #nibabel keeps a loaded image's scaling on its array proxy, not its header
+        header.set_slope_inter(template_img.dataobj.slope, template_img.dataobj.inter)
+    else:
+        header.set_data_dtype(numpy.float32)
+        header.set_slope_inter(None, None)
+    if n_volumes is None:
+        header.set_data_shape(template_img.shape[:3])
+    else:
+        header.set_data_shape(template_img.shape[:3]+(n_volumes,))
+    header.set_qform(template_img.affine)
+    header.set_sform(template_img.affine)
+    #The data start right after the header and extensions, on a 16-byte boundary
+    header_size = 352+sum([x.get_sizeondisk() for x in header.extensions])
+    header.set_data_offset(header_size)
+    if compression is not None and output_image.endswith('.gz'):
+        fid = dtaz.ParallelGzipWriter(output_image, **compression)
+    else:
+        fid = nibabel.openers.ImageOpener(output_image, 'wb')
+    header.write_to(fid)
+    fid.write(b'\0'*(header_size-fid.tell()))
+    return fid
+
+
+def _abort_writers(writers):
+    #This function closes files opened by _open_volume_writer after a
+    #failed write and deletes them, so no truncated image is left behind
+    #for a later run to pick up.
+    for fid in writers:
+        if isinstance(fid, dtaz.ParallelGzipWriter):
+            fid.abort()
+        else:
+            fid.close()
+            if os.path.exists(fid.name):
+                os.remove(fid.name)
+
+
+def split_shells(dti_img, shell_volume_lists, shell_images, overwrite=0, compression=None):
+    #This function writes the 4D image of every shell in a single pass
+    #through dti_img, in place of one 3dTcat per shell, each of which would
+    #inflate a .nii.gz input again. Each volume is read once and its raw
+    #bytes appended to its shell's file, which keeps the input's data type
+    #and scaling. shell_volume_lists maps each shell label to its list of
+    #volumes and shell_images maps it to the output file name. compression
+    #is passed on to _open_volume_writer. Returns shell_images.
+    logging.info('-------Starting: split_shells (native)-------')
+    volume_to_shell = {}
+    writers = {}
+    try:
+        for shell_label, volume_list in shell_volume_lists.items():
+            for volume in volume_list:
+                volume_to_shell[volume] = shell_label
+            writers[shell_label] = _open_volume_writer(shell_images[shell_label], dti_img, len(volume_list), overwrite=overwrite, keep_dtype=1,
+                                                       compression=compression)
+        with contextlib.closing(_iter_volume_bytes(dti_img, list(volume_to_shell.keys()))) as volume_iter:
+            for volume, buffer in volume_iter:
+                writers[volume_to_shell[volume]].write(buffer)
+    except BaseException:
+        _abort_writers(writers.values())
+        raise
+    for fid in writers.values():
+        fid.close()
+    logging.info('-------Done: split_shells (native)-------')
+    return shell_images
+
+
+def fused_shell_stats(dti_img, shell_volume_lists, mask_data, shell_images=None, overwrite=0, index=None, compression=None):
+    #This function makes a single pass through a 4D image and computes what
+    #every shell needs from it. Each volume is read once and used to update
+    #its shell's running sum (whole volume) and running mean and sum of
+    #squared deviations (mask only; the same pairwise update as
+    #stream_mean_tsnr, one volume at a time),
+    #is gathered into the shell's (masked voxels x volumes) matrix, and has
+    #its masked mean recorded. If shell_images maps a shell label to a file
+    #name, the shell's volumes are also appended to that file as they go by.
+    #shell_volume_lists maps each shell label to its list of volumes; index
+    #is mask_index(mask_data), if it has already been worked out. dti_img may
+    #also be a 4D array already in memory, which is read through views of
+    #its volumes (shell_images cannot be written then). compression is
+    #passed on to _open_volume_writer.
+    #Returns a dictionary per shell with mean_data and tsnr_data (float32,
+    #as create_mean and calc_tsnr), tsnr_mean (as ave_tsnr), masked_data
+    #(the contiguous masked voxels x volumes matrix, rows in index order)
+    #and volume_means (masked mean of each volume, in shell order).
+    logging.info('-------Starting: fused_shell_stats (native)-------')
+    shape = dti_img.shape[:3]
+    if index is None:
+        index = mask_index(mask_data)
+
+    volume_to_shell = {}
+    shell_stats = {}
+    writers = {}
+    try:
+        for shell_label, volume_list in shell_volume_lists.items():
+            if len(volume_list) < 2:
+                logging.error('ERROR: TSNR needs at least two volumes in shell {}!'.format(shell_label))
+                raise RuntimeError('fused_shell_stats: too few volumes')
+            for position, volume in enumerate(volume_list):
+                volume_to_shell[volume] = (shell_label, position)
+            shell_stats[shell_label] = {
+                'sum': numpy.zeros(shape, dtype=numpy.float64),
+                'count': 0,
+                'masked_mean': numpy.zeros(index.size, dtype=numpy.float64),
+                'm2': numpy.zeros(index.size, dtype=numpy.float64),
+                'masked_data': numpy.zeros((index.size, len(volume_list)), dtype=numpy.float32),
+                'volume_means': numpy.zeros(len(volume_list), dtype=numpy.float64),
+                }
+            if shell_images is not None and shell_label in shell_images:
+                writers[shell_label] = _open_volume_writer(shell_images[shell_label], dti_img, len(volume_list), overwrite=overwrite, compression=compression)
+
+        if isinstance(dti_img, numpy.ndarray):
+            volume_iter = iter_array_volumes(dti_img, list(volume_to_shell.keys()))
+        else:
+            volume_iter = iter_volumes(dti_img, list(volume_to_shell.keys()))
+        with contextlib.closing(volume_iter):
+            for volume, data in volume_iter:
+                shell_label, position = volume_to_shell[volume]
+                stats = shell_stats[shell_label]
+                masked = gather_masked(data, index)
+                stats['sum'] += data
+                stats['count'] += 1
+                delta = masked-stats['masked_mean']
+                stats['masked_mean'] += delta/stats['count']
+                stats['m2'] += delta*(masked-stats['masked_mean'])
+                stats['masked_data'][:, position] = masked
+                if masked.size > 0:
+                    stats['volume_means'][position] = masked.mean(dtype=numpy.float64)
+                if shell_label in writers:
+                    writers[shell_label].write(data.tobytes(order='F'))
+    except BaseException:
+        _abort_writers(writers.values())
+        raise
+    for fid in writers.values():
+        fid.close()
+
+    results = {}
+    for shell_label, volume_list in shell_volume_lists.items():
+        stats = shell_stats[shell_label]
+        n_volumes = len(volume_list)
+        mean_data = stats['sum']/n_volumes
+        masked_mean = stats['masked_mean']
+        stdev = numpy.sqrt(stats['m2']/(n_volumes-1))
+        masked_tsnr = numpy.zeros(index.size, dtype=numpy.float64)
+        good = stdev > 0
+        masked_tsnr[good] = numpy.abs(masked_mean[good])/stdev[good]
+        masked_tsnr = masked_tsnr.astype(numpy.float32)
+        tsnr_data = scatter_masked(masked_tsnr, index, shape)
+        nonzero = masked_tsnr[masked_tsnr != 0]
+        results[shell_label] = {
+            'mean_data': mean_data.astype(numpy.float32),
+            'tsnr_data': tsnr_data,
+            'tsnr_mean': float(nonzero.mean(dtype=numpy.float64)) if nonzero.size else 0.0,
+            'masked_data': stats['masked_data'],
+            'volume_means': stats['volume_means'],
+            }
+
+    logging.info('-------Done: fused_shell_stats (native)-------')
+    return results
+
+
+def _l1_detrend(masked_data, polort, iterations=50):
+    #This function removes a polynomial trend of order polort from each row
+    #of a (voxels x volumes) matrix with an L1 (least absolute deviation)
+    #fit, done for all voxels at once by iteratively reweighted least
+    #squares. polort=0 is an exact median subtraction.
+    if polort == 0:
+        return masked_data-numpy.median(masked_data, axis=1, keepdims=True)
+    n_volumes = masked_data.shape[1]
+    time = numpy.linspace(-1.0, 1.0, n_volumes)
+    basis = numpy.polynomial.legendre.legvander(time, polort)
+    data = masked_data.astype(numpy.float64)
+    #Start from the least squares fit
+    coef = numpy.linalg.lstsq(basis, data.T, rcond=None)[0].T
+    for count in range(iterations):
+        residual = data-coef @ basis.T
+        weights = 1.0/numpy.maximum(numpy.abs(residual), 1e-6)
+        #Solve the weighted normal equations of every voxel at once
+        normal = numpy.einsum('vt,ti,tj->vij', weights, basis, basis)
+        rhs = numpy.einsum('vt,ti,vt->vi', weights, basis, data)
+        coef = numpy.linalg.solve(normal, rhs[..., None])[..., 0]
+    return data-coef @ basis.T
+
+
+def voxel_outliers(masked_data, qthr=0.001, polort=0):
+    #This function flags the outlying points of a (masked voxels x volumes)
+    #matrix with 3dToutcount's test (see outcount) and returns a boolean
+    #matrix of the same shape.
+    n_volumes = masked_data.shape[1]
+    if n_volumes < 3:
+        logging.error('ERROR: outlier counts need at least three volumes!')
+        raise RuntimeError('outcount: too few volumes')
+    alpha = statistics.NormalDist().inv_cdf(1.0-qthr/n_volumes)*math.sqrt(math.pi/2.0)
+    deviation = numpy.abs(_l1_detrend(masked_data, polort))
+    mad = numpy.median(deviation, axis=1)
+    outliers = deviation > (alpha*mad)[:, None]
+    outliers[mad <= 0, :] = False
+    return outliers
+
+
+def outcount(masked_data, qthr=0.001, polort=0):
+    #This function counts the outlying voxels of each volume, the same as
+    #AFNI's 3dToutcount -mask. masked_data is a (masked voxels x volumes)
+    #matrix. Each voxel time series is detrended (polort=0, the 3dToutcount
+    #default, just removes the median) and a point is an outlier when its
+    #absolute deviation is more than qginv(qthr/N)*sqrt(pi/2)*MAD, where
+    #MAD is the median absolute deviation of that voxel and N the number of
+    #volumes. Voxels with a MAD of 0 cannot have outliers and are skipped.
+    #Returns the mean and max outlier count and the per-volume counts.
+    logging.info('-------Starting: outcount (native)-------')
+    outcount_array = voxel_outliers(masked_data, qthr=qthr, polort=polort).sum(axis=0)
+    outcount_mean = outcount_array.mean()
+    outcount_max = outcount_array.max()
+    logging.info('-------Done: outcount (native)-------')
+    return outcount_mean, outcount_max, outcount_array
+
+
+def stream_outcount(dti_img, volume_list, mask_data, max_memory, qthr=0.001, polort=0):
+    #This function runs outcount on the volumes of dti_img listed in
+    #volume_list without loading the 4D data. The masked voxels are
+    #gathered one slab of z-slices at a time (every volume of a slab has to
+    #be held at once, because the median is over time) and the per-volume
+    #counts of the slabs are added up.
+    logging.info('-------Starting: stream_outcount (native)-------')
+    shape = dti_img.shape[:3]
+    slab_slices = max(1, max_memory // (int(shape[0])*int(shape[1])*(16+8*len(volume_list))))
+    slab_slices = min(slab_slices, int(shape[2]))
+    outcount_array = numpy.zeros(len(volume_list), dtype=int)
+    with _slab_reader(dti_img) as read_slab:
+        for z0 in range(0, shape[2], slab_slices):
+            z1 = min(z0+slab_slices, shape[2])
+            slab_mask = mask_data[:, :, z0:z1]
+            if not slab_mask.any():
+                continue
+            slab_data = numpy.stack([read_slab(z0, z1, v)[slab_mask] for v in volume_list], axis=1)
+            outcount_array += outcount(slab_data, qthr=qthr, polort=polort)[2]
+    logging.info('-------Done: stream_outcount (native)-------')
+    return outcount_array.mean(), outcount_array.max(), outcount_array
+
+
+def outlier_map(dti_img, volume_list, mask_data, max_memory=None, qthr=0.001, polort=0):
+    #This function counts how many of the volumes of dti_img listed in
+    #volume_list are outliers (see outcount) at each mask voxel and returns
+    #the counts as a 3D array (0 outside the mask). The volumes are read a
+    #single time, or one slab of z-slices at a time if max_memory is given.
+    logging.info('-------Starting: outlier_map (native)-------')
+    shape = dti_img.shape[:3]
+    count_data = numpy.zeros(shape, dtype=numpy.int32)
+    if max_memory is None:
+        index = mask_index(mask_data)
+        masked_data = numpy.zeros((index.size, len(volume_list)), dtype=numpy.float32)
+        position = {x: count for count, x in enumerate(volume_list)}
+        with contextlib.closing(iter_volumes(dti_img, volume_list, keep_index=0)) as volume_iter:
+            for volume, data in volume_iter:
+                masked_data[:, position[volume]] = gather_masked(data, index)
+        count_data = scatter_masked(voxel_outliers(masked_data, qthr=qthr, polort=polort).sum(axis=1), index, shape).astype(numpy.int32)
+    else:
+        slab_slices = max(1, max_memory // (int(shape[0])*int(shape[1])*(16+8*len(volume_list))))
+        slab_slices = min(slab_slices, int(shape[2]))
+        with _slab_reader(dti_img) as read_slab:
+            for z0 in range(0, shape[2], slab_slices):
+                z1 = min(z0+slab_slices, shape[2])
+                slab_mask = mask_data[:, :, z0:z1]
+                if not slab_mask.any():
+                    continue
+                slab_data = numpy.stack([read_slab(z0, z1, v)[slab_mask] for v in volume_list], axis=1)
+                slab_counts = numpy.zeros(slab_mask.shape, dtype=numpy.int32)
+                slab_counts[slab_mask] = voxel_outliers(slab_data, qthr=qthr, polort=polort).sum(axis=1)
+                count_data[:, :, z0:z1] = slab_counts
+    logging.info('-------Done: outlier_map (native)-------')
+    return count_data
+
+
+def load_labels(atlas_image):
+    #This function loads a label atlas (0 is background, each positive
+    #integer a region) as an integer array.
+    img = load_image(atlas_image)
+    label_data = numpy.rint(numpy.asanyarray(img.dataobj)).astype(numpy.int64)
+    if label_data.min() < 0:
+        logging.error('ERROR: atlas labels must not be negative: {}'.format(atlas_image))
+        raise RuntimeError('load_labels: bad atlas')
+    return label_data
+
+
+def regional_stats(label_data, mask_data, tsnr_data, outlier_data, n_volumes):
+    #This function computes the metrics of every atlas region at once, in
+    #place of one 3dROIstats run per region: each quantity is summed over
+    #all regions by a single bincount over the mask voxels. A region is
+    #the voxels of one label inside the mask. Returns a list of [region,
+    #voxels, tsnr_mean, outlier_rate] rows in label order, where tsnr_mean
+    #is the mean of the nonzero TSNR voxels (as ave_tsnr) and outlier_rate
+    #the fraction of voxels x volumes that are outliers (from the per-voxel
+    #counts of outlier_map).
+    labels = label_data[mask_data]
+    if labels.size == 0:
+        return []
+    tsnr = tsnr_data[mask_data].astype(numpy.float64)
+    outliers = outlier_data[mask_data].astype(numpy.float64)
+    n_labels = int(labels.max())+1
+    nonzero = tsnr != 0
+    voxel_count = numpy.bincount(labels, minlength=n_labels)
+    tsnr_count = numpy.bincount(labels[nonzero], minlength=n_labels)
+    tsnr_sum = numpy.bincount(labels[nonzero], weights=tsnr[nonzero], minlength=n_labels)
+    outlier_sum = numpy.bincount(labels, weights=outliers, minlength=n_labels)
+    rows = []
+    for region in numpy.flatnonzero(voxel_count[1:])+1:
+        tsnr_mean = tsnr_sum[region]/tsnr_count[region] if tsnr_count[region] else 0.0
+        rows.append([int(region), int(voxel_count[region]), float(tsnr_mean), float(outlier_sum[region]/(voxel_count[region]*n_volumes))])
+    return rows
+
+
+def downsample(data, factor):
+    #This function block-averages a 3D array by an integer factor along
+    #each axis (trailing voxels that do not fill a block are dropped).
+    if factor == 1:
+        return data
+    shape = [x // factor for x in data.shape]
+    cropped = data[:shape[0]*factor, :shape[1]*factor, :shape[2]*factor]
+    blocks = cropped.reshape(shape[0], factor, shape[1], factor, shape[2], factor)
+    return blocks.mean(axis=(1, 3, 5))
+
+
+def _trilinear(data, coords):
+    #This function samples a 3D array at fractional voxel coordinates
+    #(3 x n) with trilinear interpolation. Returns the values and a boolean
+    #array that is False for points outside the array (their value is 0).
+    shape = numpy.array(data.shape)[:, None]
+    valid = numpy.all((coords >= 0) & (coords <= shape-1), axis=0)
+    base = numpy.floor(coords).astype(numpy.intp)
+    base = numpy.clip(base, 0, shape-2)
+    frac = numpy.clip(coords-base, 0.0, 1.0)
+    values = numpy.zeros(coords.shape[1], dtype=numpy.float64)
+    for corner in range(8):
+        offset = [(corner >> axis) & 1 for axis in range(3)]
+        weight = numpy.ones(coords.shape[1], dtype=numpy.float64)
+        for axis in range(3):
+            if offset[axis]:
+                weight *= frac[axis]
+            else:
+                weight *= 1.0-frac[axis]
+        values += weight*data[base[0]+offset[0], base[1]+offset[1], base[2]+offset[2]]
+    values[~valid] = 0.0
+    return values, valid
+
+
+def _rotation_matrix(angles):
+    #This function returns the rotation matrix Rz.Ry.Rx for rotations (in
+    #radians) about the x, y and z axes.
+    cx, cy, cz = numpy.cos(angles)
+    sx, sy, sz = numpy.sin(angles)
+    rx = numpy.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = numpy.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = numpy.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return rz @ ry @ rx
+
+
+def _transform_points(params, points, center):
+    #This function applies a rigid transform (tx, ty, tz in mm, rx, ry, rz
+    #in radians) about center to points given in mm (3 x n).
+    rotation = _rotation_matrix(params[3:])
+    return rotation @ (points-center)+center+params[:3, None]
+
+
+def _motion_levels(base_data, mask_data, zooms, levels, max_points, min_points=1000, seed=0):
+    #This function prepares the base image at each resolution level: the
+    #sample points inside the mask (in mm), the base values there and the
+    #Gauss-Newton Jacobian and normal matrix built from the base gradient.
+    rng = numpy.random.default_rng(seed)
+    level_list = []
+    for factor in levels:
+        base = downsample(base_data.astype(numpy.float64), factor)
+        mask = downsample(mask_data.astype(numpy.float64), factor) > 0.5
+        level_zooms = numpy.asarray(zooms, dtype=numpy.float64)*factor
+        index = numpy.array(numpy.nonzero(mask))
+        #Levels too coarse to hold the brain in a useful number of voxels are skipped
+        if index.shape[1] < min_points and factor != levels[-1]:
+            continue
+        if index.shape[1] > max_points:
+            index = index[:, rng.choice(index.shape[1], size=max_points, replace=False)]
+        #Voxel i of this level sits at original voxel factor*i+(factor-1)/2
+        points = (index*factor+(factor-1)/2.0)*numpy.asarray(zooms, dtype=numpy.float64)[:, None]
+        gradient = numpy.gradient(base, *level_zooms)
+        grad = numpy.array([g[tuple(index)] for g in gradient])
+        level_list.append({'factor': factor, 'points': points, 'values': base[tuple(index)], 'grad': grad})
+    return level_list
+
+
+def _register_volume(moving_data, level_list, zooms, center, iterations, tolerance):
+    #This function finds the rigid transform that maps the base onto one
+    #volume, coarse level first, by Gauss-Newton on the sum of squared
+    #differences with the Jacobian taken from the base gradient.
+    zooms = numpy.asarray(zooms, dtype=numpy.float64)[:, None]
+    params = numpy.zeros(6, dtype=numpy.float64)
+    for level in level_list:
+        factor = level['factor']
+        moving = downsample(moving_data.astype(numpy.float64), factor)
+        points = level['points']
+        rel = points-center
+        grad = level['grad']
+        #Derivatives of the intensity with respect to the six parameters
+        jacobian = numpy.array([
+            grad[0], grad[1], grad[2],
+            grad[2]*rel[1]-grad[1]*rel[2],
+            grad[0]*rel[2]-grad[2]*rel[0],
+            grad[1]*rel[0]-grad[0]*rel[1],
+            ])
+        def level_cost(level_params):
+            moved = _transform_points(level_params, points, center)
+            coords = (moved/zooms-(factor-1)/2.0)/factor
+            values, valid = _trilinear(moving, coords)
+            residual = values[valid]-level['values'][valid]
+            return (residual**2).mean() if valid.sum() >= 6 else numpy.inf, residual, valid
+
+        cost, residual, valid = level_cost(params)
+        for count in range(iterations):
+            if not numpy.isfinite(cost):
+                break
+            jac = jacobian[:, valid]
+            try:
+                update = numpy.linalg.solve(jac @ jac.T, jac @ residual)
+            except numpy.linalg.LinAlgError:
+                break
+            #Only take steps that lower the cost, halving them if needed
+            for halving in range(5):
+                new_params = params-update
+                new_cost, new_residual, new_valid = level_cost(new_params)
+                if new_cost < cost:
+                    break
+                update = update/2.0
+            if not new_cost < cost:
+                break
+            params, cost, residual, valid = new_params, new_cost, new_residual, new_valid
+            if numpy.abs(update[:3]).max() < tolerance and numpy.abs(update[3:]).max() < tolerance/100.0:
+                break
+    return params
+
+
+def motion_setup(shape, zooms, base_data, mask_data, levels=(4, 2, 1), max_points=200000):
+    #This function prepares everything the registration of volumes of the
+    #given 3D shape and voxel size (mm) to a base image needs, so it is
+    #only done once per base. Returns a dictionary for register_volume.
+    zooms = numpy.asarray(zooms[:3], dtype=numpy.float64)
+    shape = numpy.asarray(shape[:3], dtype=numpy.float64)
+    level_list = _motion_levels(base_data, mask_data, zooms, levels, max_points)
+    if not level_list or level_list[-1]['points'].shape[1] < 6:
+        logging.error('ERROR: mask has too few voxels to register!')
+        raise RuntimeError('motion_correct: mask too small')
+    return {
+        'zooms': zooms,
+        'center': ((shape-1)/2.0*zooms)[:, None],
+        'levels': level_list,
+        #Displacements are measured over every mask voxel at full resolution
+        'brain_points': numpy.array(numpy.nonzero(mask_data), dtype=numpy.float64)*zooms[:, None],
+        }
+
+
+def register_volume(setup, moving_data, iterations=10, tolerance=0.01):
+    #This function registers one volume to the base of setup (from
+    #motion_setup) and returns its motion parameters (x, y, z shifts in mm
+    #and x, y, z rotations in degrees) and the maximum displacement (mm)
+    #of any mask voxel.
+    params = _register_volume(moving_data, setup['levels'], setup['zooms'], setup['center'], iterations, tolerance)
+    brain_points = setup['brain_points']
+    displacement = _transform_points(params, brain_points, setup['center'])-brain_points
+    maxdisp = numpy.sqrt((displacement**2).sum(axis=0)).max()
+    return numpy.concatenate([params[:3], numpy.degrees(params[3:])]), maxdisp
+
+
+def estimate_motion(volume_iter, n_volumes, shape, zooms, base_data, mask_data, levels=(4, 2, 1), iterations=10, tolerance=0.01, max_points=200000):
+    #This function estimates the rigid-body motion of n_volumes volumes of
+    #the given 3D shape and voxel size (mm) against a base image, taking
+    #them one at a time from volume_iter, which yields (volume index, 3D
+    #array) in shell order (e.g. iter_volumes). See motion_correct.
+    setup = motion_setup(shape, zooms, base_data, mask_data, levels=levels, max_points=max_points)
+    params_array = numpy.zeros((n_volumes, 6), dtype=numpy.float64)
+    maxdisp_array = numpy.zeros(n_volumes, dtype=numpy.float64)
+    for position, (volume, moving_data) in enumerate(volume_iter):
+        params_array[position], maxdisp_array[position] = register_volume(setup, moving_data, iterations, tolerance)
+    return params_array, maxdisp_array
+
+
+def motion_correct(shell_image, base_data, mask_data, levels=(4, 2, 1), iterations=10, tolerance=0.01, max_points=200000):
+    #This function estimates the rigid-body motion of every volume of a
+    #shell image against a base image (the shell mean), the way 3dvolreg
+    #does, but without resampling or writing the registered volumes. The
+    #volumes are read one at a time and registered coarse to fine (block
+    #averaging by each factor in levels) with Gauss-Newton on the sum of
+    #squared differences over the voxels in mask_data (at most max_points
+    #of them at each level). Returns the motion parameters of each volume
+    #(n x 6: x, y, z shifts in mm and x, y, z rotations in degrees) and
+    #the maximum displacement (mm) of any mask voxel in each volume.
+    logging.info('-------Starting: motion_correct (native)-------')
+    shell_img = load_image(shell_image)
+    n_volumes = shell_img.shape[3]
+    with contextlib.closing(iter_volumes(shell_img, range(n_volumes), keep_index=0)) as volume_iter:
+        params_array, maxdisp_array = estimate_motion(volume_iter, n_volumes, shell_img.shape, shell_img.header.get_zooms(), base_data, mask_data,
+                                                      levels=levels, iterations=iterations, tolerance=tolerance, max_points=max_points)
+    logging.info('-------Done: motion_correct (native)-------')
+    return params_array, maxdisp_array
+
+
+def write_motion_files(params_array, maxdisp_array, params_file, maxdisp_file, overwrite=0):
+    #This function writes the motion parameters (one line per volume) and
+    #the maximum displacements, the latter in the same layout as 3dvolreg's
+    #-maxdisp1D file so both can be read the same way.
+    for output_file in [params_file, maxdisp_file]:
+        _check_output(output_file, overwrite, 'write_motion_files')
+    with open(params_file, 'w') as fid:
+        fid.write('# dx(mm) dy(mm) dz(mm) rx(deg) ry(deg) rz(deg)\n')
+        for params in params_array:
+            fid.write(' '.join(['{:.6f}'.format(x) for x in params])+'\n')
+    with open(maxdisp_file, 'w') as fid:
+        fid.write('# maximum displacement (mm)\n')
+        for maxdisp in maxdisp_array:
+            fid.write(' {:.6f}\n'.format(maxdisp))
+    return params_file, maxdisp_file
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import shutil
+import logging
+import argparse
+import numpy
+import dti_qa_lib as dtal
+import dti_qa_native as dtan
+import dti_qa_api as dtai
+
+#Checks that every way of computing the QA metrics agrees with the
+#AFNI-driven pipeline on synthetic phantoms:
+#   1. Make a phantom with brain-like structure, known rigid motion of
+#      every volume, noise and a few corrupted volumes
+#   2. Run qa_the_dti with the AFNI engine and one 3dTcat per shell (the
+#      reference) and with each other configuration in CONFIGURATIONS,
+#      and the in-process API
+#   3. Compare every metric of every shell with the reference within
+#      TOLERANCES and report any that are out
+#   4. Check apply_mask (3dcalc) against the masked phantom
+#This is done for every phantom shape and seed asked for.
+#Without AFNI installed, the stand-ins in afni_standins/ (which follow
+#the exact AFNI calls dti_qa_lib makes) are put first on the PATH.
+
+
+#Directory of the AFNI stand-ins, next to this script
+STANDIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'afni_standins')
+
+#qa_the_dti keyword arguments of the reference
+REFERENCE = {'engine': 'afni', 'split_shells': 0}
+
+#Configurations compared with the reference: name and qa_the_dti keyword
+#arguments; 'api' runs dti_qa_api.qa_arrays instead
+CONFIGURATIONS = [
+    ('afni_split', {'engine': 'afni'}),
+    ('native', {'engine': 'native'}),
+    ('native_stream', {'engine': 'native', 'max_memory': 1024*1024}),
+    ('afni_native_motion', {'engine': 'afni', 'motion_engine': 'native'}),
+    ('native_afni_motion', {'engine': 'native', 'motion_engine': 'afni'}),
+    ('api', None),
+    ]
+
+#Largest difference allowed from the reference: (absolute, relative).
+#3dROIstats prints 6 significant digits; outlier counts may differ by a
+#voxel that sits on the threshold in float32 but not float64. Both
+#registrations come within a few hundredths of a mm of the phantom's known
+#motion, except on the volumes scaled up by 1.3, which least squares
+#cannot register exactly; and 3dvolreg measures maxdisp over the automask
+#of the shell mean, which takes in a rim of voxels outside the mask the
+#native engine uses. Together that keeps maxdisp within 0.1 mm (a
+#twentieth of the phantom's 2 mm voxels).
+TOLERANCES = {
+    'outcount_mean': (1.0, 0.0),
+    'outcount_max': (1.0, 0.0),
+    'tsnr_mean': (0.0, 1e-4),
+    'maxdisp': (0.1, 0.0),
+    }
+
+
+def make_parity_phantom(output_dir, shape=(48, 48, 32), n_volumes=21, n_shells=2, motion=1.0, seed=0):
+    #This function writes a DWI phantom whose volumes have known rigid
+    #motion (shifts of up to motion mm and rotations of up to motion
+    #degrees). The brain is a smooth analytic function of position, so
+    #each moved volume is sampled exactly rather than interpolated. Has a
+    #b=0 volume every 10 volumes, Gaussian noise and a corrupted volume
+    #per 20 for the outlier counts. Returns the paths of the DWI image,
+    #mask image and shell index file, and the motion parameters.
+    rng = numpy.random.default_rng(seed)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    zooms = numpy.array([2.0, 2.0, 2.0])
+    shape = tuple(shape)
+
+    shell_index_list = []
+    for count in range(n_volumes):
+        if count % 10 == 0:
+            shell_index_list.append(0)
+        else:
+            shell_index_list.append(1+len([x for x in shell_index_list if x != 0]) % n_shells)
+
+    extent = (numpy.array(shape)-1)/2.0*zooms
+    def brain(points):
+        #Ellipsoid with a smooth edge and internal texture (mm coordinates about the centre)
+        radius = numpy.sqrt(sum([(points[k]/(0.8*extent[k]))**2 for k in range(3)]))
+        envelope = 1.0/(1.0+numpy.exp((radius-1.0)*12.0))
+        texture = 1.0+0.3*numpy.sin(points[0]/6.0)*numpy.cos(points[1]/7.0)+0.2*numpy.sin(points[2]/5.0+points[0]/9.0)
+        return 1000.0*envelope*texture
+
+    grid = numpy.array(numpy.indices(shape).reshape(3, -1), dtype=numpy.float64)*zooms[:, None]-extent[:, None]
+    mask_data = (brain(grid) > 300.0).reshape(shape)
+
+    params_array = numpy.zeros((n_volumes, 6))
+    dwi_data = numpy.zeros(shape+(n_volumes,), dtype=numpy.float32)
+    for count, shell in enumerate(shell_index_list):
+        params = numpy.concatenate([rng.uniform(-motion, motion, 3), numpy.radians(rng.uniform(-motion, motion, 3))])
+        params_array[count] = params
+        #Sample the brain at the points the moved head puts under each voxel
+        cx, cy, cz = numpy.cos(params[3:])
+        sx, sy, sz = numpy.sin(params[3:])
+        rotation = numpy.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]) @ numpy.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]]) @ numpy.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+        moved = rotation.T @ (grid-params[:3, None])
+        signal = brain(moved).reshape(shape)*numpy.exp(-0.7*shell)
+        dwi_data[..., count] = signal+rng.normal(0, 10, size=shape)
+    for count in rng.choice(n_volumes, size=max(1, n_volumes//20), replace=False):
+        dwi_data[..., count] *= 1.3
+
+    affine = numpy.diag(list(zooms)+[1.0])
+    dti_image = os.path.join(output_dir, 'dwi.nii.gz')
+    mask_image = os.path.join(output_dir, 'mask.nii.gz')
+    shell_index_file = os.path.join(output_dir, 'shell_index.txt')
+    dtan.nibabel.save(dtan.nibabel.Nifti1Image(dwi_data, affine), dti_image)
+    dtan.nibabel.save(dtan.nibabel.Nifti1Image(mask_data.astype(numpy.int16), affine), mask_image)
+    with open(shell_index_file, 'w') as fid:
+        fid.write(' '.join([str(x) for x in shell_index_list]))
+    return dti_image, mask_image, shell_index_file, params_array
+
+
+def _read_metrics(metric_file):
+    #This function reads a metrics CSV into a dictionary of shell label to
+    #a dictionary of metric values.
+    metric_dict = {}
+    with open(metric_file, 'r') as fid:
+        lines = fid.read().splitlines()
+    header = lines[0].split(',')
+    for line in lines[1:]:
+        if line == '':
+            continue
+        values = dict(zip(header, line.split(',')))
+        metric_dict[values['shell']] = {x: float(values[x]) for x in TOLERANCES}
+    return metric_dict
+
+
+def run_configuration(name, qa_kwargs, work_dir, dti_image, mask_image, shell_index_file):
+    #This function runs one configuration on a phantom and returns its
+    #metrics as a dictionary of shell label to metric values.
+    if qa_kwargs is None:
+        shell_index = dtal.read_shell_index(shell_index_file)
+        results = dtai.qa_arrays(dtan.load_image(dti_image), dtan.load_image(mask_image), shell_index)
+        return {x: {y: getattr(results[x], y) for y in TOLERANCES} for x in results}
+    output_dir = os.path.join(work_dir, 'run_{}'.format(name))
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    output_file = dtal.qa_the_dti('parity', dti_image, mask_image, shell_index_file, output_dir, 1, **qa_kwargs)
+    return _read_metrics(output_file)
+
+
+def check_apply_mask(work_dir, dti_image, mask_image):
+    #This function masks the phantom with apply_mask (3dcalc) and returns
+    #the largest difference from masking it in NumPy.
+    output_image = os.path.join(work_dir, 'apply_mask', 'dwi_masked.nii.gz')
+    if os.path.exists(os.path.dirname(output_image)):
+        shutil.rmtree(os.path.dirname(output_image))
+    os.makedirs(os.path.dirname(output_image))
+    dtal.apply_mask(dti_image, mask_image, output_image)
+    masked_data = numpy.asarray(dtan.load_image(output_image).dataobj, dtype=numpy.float64)
+    expected = numpy.asarray(dtan.load_image(dti_image).dataobj, dtype=numpy.float64)*dtan.load_mask(mask_image)[..., None]
+    return float(numpy.abs(masked_data-expected).max())
+
+
+def compare_metrics(reference, metrics):
+    #This function returns a list of (shell, metric, reference value,
+    #value, difference, within tolerance) rows.
+    rows = []
+    for shell_label in sorted(reference.keys()):
+        for metric, (absolute, relative) in sorted(TOLERANCES.items()):
+            expected = reference[shell_label][metric]
+            value = metrics.get(shell_label, {}).get(metric, float('nan'))
+            difference = abs(value-expected)
+            rows.append((shell_label, metric, expected, value, difference, bool(difference <= absolute+relative*abs(expected))))
+    return rows
+
+
+#Set up argument parser and help dialogue
+parser=argparse.ArgumentParser(
+    description='''Check that the native engines and in-process API agree with the AFNI pipeline on synthetic phantoms.''',
+    usage='python3 dti_qa_parity.py work_dir [--use-installed-afni] [--shape 48x48x32,32x32x20] [--volumes N] [--shells N] [--motion MM] [--seeds 0,1,...]')
+parser.add_argument('--use-installed-afni', help='use the AFNI programs on the PATH as the reference instead of the stand-ins', action='store_const', const=1, default=0)
+parser.add_argument('--shape', help='comma-separated phantom matrix sizes; one phantom per size and seed (default 48x48x32,32x32x20)', default='48x48x32,32x32x20')
+parser.add_argument('--volumes', help='phantom volume count (default 21)', type=int, default=21)
+parser.add_argument('--shells', help='phantom shell count (default 2)', type=int, default=2)
+parser.add_argument('--motion', help='largest shift (mm) and rotation (degrees) of a phantom volume (default 1)', type=float, default=1.0)
+parser.add_argument('--seeds', help='comma-separated seeds; one phantom per seed (default 0)', default='0')
+parser.add_argument('work_dir', help='directory for the phantoms and QA outputs')
+
+
+def main(args):
+
+    #Set basic logger
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.WARNING)
+
+    if dtan.nibabel is None:
+        logging.error('ERROR: the parity checks need nibabel, which could not be imported!')
+        return 1
+    if not args.use_installed_afni:
+        os.environ['PATH'] = STANDIN_DIR+os.pathsep+os.environ.get('PATH', '')
+    for program in dtal.AFNI_PROGRAMS+['3dcalc']:
+        if shutil.which(program) is None:
+            logging.error('ERROR: {} is not on the PATH!'.format(program))
+            return 1
+    print('AFNI programs from: {}'.format(os.path.dirname(shutil.which('3dTstat'))))
+
+    shape_list = [tuple([int(y) for y in x.split('x')]) for x in args.shape.split(',') if x != '']
+    failures = 0
+    for shape in shape_list:
+        shape_name = 'x'.join([str(x) for x in shape])
+        for seed in [int(x) for x in args.seeds.split(',') if x != '']:
+            phantom_dir = os.path.join(args.work_dir, 'phantom_{}_{}'.format(shape_name, seed))
+            dti_image, mask_image, shell_index_file, params_array = make_parity_phantom(phantom_dir, shape, args.volumes, args.shells,
+                                                                                        motion=args.motion, seed=seed)
+            reference = run_configuration('afni', REFERENCE, args.work_dir, dti_image, mask_image, shell_index_file)
+            for name, qa_kwargs in CONFIGURATIONS:
+                metrics = run_configuration(name, qa_kwargs, args.work_dir, dti_image, mask_image, shell_index_file)
+                for shell_label, metric, expected, value, difference, passed in compare_metrics(reference, metrics):
+                    if not passed:
+                        failures += 1
+                    print('{} seed {} {:>20} shell {} {:>14}: afni {:12.6g} {:12.6g} diff {:10.3g} {}'.format(
+                        shape_name, seed, name, shell_label, metric, expected, value, difference, 'ok' if passed else 'FAIL'))
+            difference = check_apply_mask(args.work_dir, dti_image, mask_image)
+            passed = difference <= 1e-3
+            if not passed:
+                failures += 1
+            print('{} seed {} {:>20} {:>22}: max diff {:10.3g} {}'.format(shape_name, seed, 'apply_mask', '(3dcalc)', difference, 'ok' if passed else 'FAIL'))
+
+    if failures:
+        print('{} comparisons out of tolerance.'.format(failures))
+        return 1
+    print('Every configuration agrees with the AFNI pipeline.')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,159 @@
+import os
+import zlib
+import struct
+import logging
+import collections
+import concurrent.futures
+
+#Writes .nii.gz files with the compression spread over threads, the way
+#pigz does: the data are cut into blocks, each block is deflated on its own
+#thread (zlib lets go of the GIL while it works) with the last 32 KiB of the
+#block before it as a preset dictionary, and the blocks are written in
+#order as one gzip member. The result is an ordinary .gz file that gzip,
+#nibabel, AFNI and FSL read as usual.
+
+
+#Uncompressed bytes per block; each thread deflates a block at a time
+BLOCK_SIZE = 1024*1024
+
+#Deflate window: the most a block can look back into the one before it
+DICTIONARY_SIZE = 32*1024
+
+#Default compression level (as for gzip, 1 is fastest and 9 smallest)
+DEFAULT_LEVEL = 6
+
+
+def default_threads():
+    #This function returns the number of CPUs this process may run on.
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def compression_options(threads=None, level=DEFAULT_LEVEL):
+    #This function returns the compression keyword arguments that
+    #qa_the_dti takes as compression: threads (default: every CPU this
+    #process may run on) and level (1-9).
+    if threads is None:
+        threads = default_threads()
+    if int(threads) < 1:
+        logging.error('ERROR: compression threads must be at least 1: {}'.format(threads))
+        raise RuntimeError('compression threads must be at least 1!')
+    if int(level) < 1 or int(level) > 9:
+        logging.error('ERROR: compression level must be 1 to 9: {}'.format(level))
+        raise RuntimeError('compression level must be 1 to 9!')
+    return {'threads': int(threads), 'level': int(level)}
+
+
+def _deflate_block(block, dictionary, level, last):
+    #This function deflates one block as a piece of a raw deflate stream.
+    #Blocks other than the last end on a byte boundary without closing the
+    #stream (Z_SYNC_FLUSH), so the pieces can be joined in order.
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block)+compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+    #A write-only file object that gzips what is written to it on threads
+    #threads at compression level level. tell() is the number of
+    #uncompressed bytes written so far. The data go to a temporary file
+    #next to output_file, which is renamed to output_file when the writer is
+    #closed; abort() (or leaving a with statement on an exception) deletes
+    #it instead, so a failed write never leaves a truncated .gz behind.
+
+    def __init__(self, output_file, threads=1, level=DEFAULT_LEVEL, block_size=BLOCK_SIZE):
+        self.name = output_file
+        self.threads = max(1, int(threads))
+        self.level = int(level)
+        self.block_size = int(block_size)
+        self.closed = False
+        self._buffer = bytearray()
+        self._dictionary = b''
+        self._crc = 0
+        self._size = 0
+        self._pending = collections.deque()
+        self._partial_file = '{}.{}.part'.format(output_file, os.getpid())
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        self._fid = open(self._partial_file, 'wb')
+        #gzip header: deflate, no flags, no time stamp, unknown OS
+        extra_flags = 2 if self.level == 9 else 4 if self.level == 1 else 0
+        self._fid.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, extra_flags, 255))
+
+    def _submit(self, block, last=False):
+        self._pending.append(self._executor.submit(_deflate_block, block, self._dictionary, self.level, last))
+        self._dictionary = block[-DICTIONARY_SIZE:]
+        #Keep every thread busy, but only a few blocks ahead of the disk
+        while len(self._pending) > 2*self.threads:
+            self._fid.write(self._pending.popleft().result())
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self._size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._fid.write(self._pending.popleft().result())
+            #gzip trailer: CRC-32 and length (mod 2^32) of the uncompressed data
+            self._fid.write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+            self._fid.close()
+        except BaseException:
+            self.abort()
+            raise
+        self.closed = True
+        self._executor.shutdown()
+        os.replace(self._partial_file, self.name)
+
+    def abort(self):
+        #This function stops the writer without finishing the file and
+        #deletes what has been written so far.
+        if self.closed:
+            return
+        self.closed = True
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown()
+        self._fid.close()
+        if os.path.exists(self._partial_file):
+            os.remove(self._partial_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def compress_file(input_file, output_file, threads=1, level=DEFAULT_LEVEL, chunk_size=16*BLOCK_SIZE):
+    #This function gzips input_file into output_file with a
+    #ParallelGzipWriter, e.g. a .nii written by an AFNI program into the
+    #.nii.gz that is kept. Returns output_file.
+    logging.info('Compressing {} on {} thread(s) at level {}...'.format(input_file, threads, level))
+    with open(input_file, 'rb') as in_fid, ParallelGzipWriter(output_file, threads=threads, level=level) as out_fid:
+        while True:
+            chunk = in_fid.read(chunk_size)
+            if not chunk:
+                break
+            out_fid.write(chunk)
+    return output_file
@@ -0,0 +1,359 @@
+import os
+import json
+import time
+import socket
+import logging
+import tempfile
+import threading
+import concurrent.futures
+import dti_qa_batch as dtab
+import dti_qa_results as dtar
+
+#Runs a manifest of subjects from a queue kept on a shared file system, so
+#workers on any number of nodes can share one cohort without a scheduler:
+#   queue_dir/claims/<sub>.lock   held by the worker running <sub>; created
+#                                 with O_EXCL so only one worker gets it,
+#                                 and touched by that worker while it runs
+#   queue_dir/done/<sub>.json     the metrics CSV written for <sub>
+#   queue_dir/failed/<sub>.json   the error <sub> failed with
+#   queue_dir/clock/<worker>      touched to read the file server's clock
+#A claim whose lock has not been touched for lease_seconds (its worker
+#crashed or lost its node) is broken and the subject is run again. A
+#worker that finds its claim broken drops its result and leaves the
+#subject to the worker that took it over.
+
+
+QUEUE_DIRS = ['claims', 'done', 'failed', 'clock']
+
+#Seconds without a heartbeat before a claim is taken to be dead
+DEFAULT_LEASE = 300
+
+
+def worker_name():
+    #This function returns a name for this worker that is unique across nodes.
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def _make_queue(queue_dir):
+    for element in QUEUE_DIRS:
+        os.makedirs(os.path.join(queue_dir, element), exist_ok=True)
+
+
+def _write_json(output_file, contents):
+    #Write to a temporary file and rename it into place, so readers on
+    #other nodes never see half a file
+    temp_fid, temp_file = tempfile.mkstemp(dir=os.path.dirname(output_file), prefix='.tmp_')
+    with os.fdopen(temp_fid, 'w') as fid:
+        json.dump(contents, fid)
+    os.replace(temp_file, output_file)
+
+
+def _read_json(input_file):
+    try:
+        with open(input_file, 'r') as fid:
+            return json.load(fid)
+    except (OSError, ValueError):
+        return None
+
+
+def _fs_now(queue_dir, worker_id):
+    #This function returns the current time on the file server, by touching
+    #a file and reading back its modification time, so lease ages are not
+    #thrown off by clock differences between nodes.
+    clock_file = os.path.join(queue_dir, 'clock', worker_id)
+    with open(clock_file, 'a'):
+        os.utime(clock_file)
+    return os.stat(clock_file).st_mtime
+
+
+def _lock_file(queue_dir, sub):
+    return os.path.join(queue_dir, 'claims', '{}.lock'.format(sub))
+
+
+def _lock_age(queue_dir, sub, worker_id):
+    #This function returns how long ago a claim was last renewed, or None
+    #if there is no claim.
+    try:
+        last_renewed = os.stat(_lock_file(queue_dir, sub)).st_mtime
+    except FileNotFoundError:
+        return None
+    return _fs_now(queue_dir, worker_id)-last_renewed
+
+
+def _break_claim(queue_dir, sub, worker_id, lease_seconds):
+    #This function breaks a claim older than lease_seconds and returns True
+    #if it did. The lock is renamed to a name of this worker's own and
+    #checked to still be the expired lock that was looked at (same inode
+    #and modification time); if another worker replaced it, or its owner
+    #renewed it, in between, it is put back and the claim left alone.
+    lock_file = _lock_file(queue_dir, sub)
+    try:
+        observed = os.stat(lock_file)
+    except FileNotFoundError:
+        return False
+    age = _fs_now(queue_dir, worker_id)-observed.st_mtime
+    if age <= lease_seconds:
+        return False
+    owner = _read_json(lock_file) or {}
+    expired_file = '{}.expired.{}'.format(lock_file, worker_id)
+    try:
+        os.rename(lock_file, expired_file)
+    except FileNotFoundError:
+        return False
+    taken = os.stat(expired_file)
+    if (taken.st_ino, taken.st_mtime_ns) != (observed.st_ino, observed.st_mtime_ns):
+        #A link puts it back without replacing a lock made meanwhile
+        try:
+            os.link(expired_file, lock_file)
+        except FileExistsError:
+            pass
+        os.remove(expired_file)
+        return False
+    os.remove(expired_file)
+    logging.warning('Claim on {} by {} expired ({:.0f} s without a heartbeat); taking it over.'.format(sub, owner.get('worker'), age))
+    return True
+
+
+def claim(queue_dir, sub, worker_id, lease_seconds=DEFAULT_LEASE):
+    #This function tries to claim a subject for a worker and returns True
+    #if it got it. A claim older than lease_seconds is broken first (see
+    #_break_claim).
+    lock_file = _lock_file(queue_dir, sub)
+    for attempt in range(2):
+        try:
+            fid = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if attempt > 0 or not _break_claim(queue_dir, sub, worker_id, lease_seconds):
+                return False
+            continue
+        with os.fdopen(fid, 'w') as lock_fid:
+            json.dump({'worker': worker_id, 'host': socket.gethostname(), 'pid': os.getpid(), 'claimed': time.time()}, lock_fid)
+        return True
+    return False
+
+
+def _owns(queue_dir, sub, worker_id):
+    contents = _read_json(_lock_file(queue_dir, sub))
+    return contents is not None and contents.get('worker') == worker_id
+
+
+def release(queue_dir, sub, worker_id):
+    #This function gives up a worker's claim on a subject, if it still has it.
+    if _owns(queue_dir, sub, worker_id):
+        try:
+            os.remove(_lock_file(queue_dir, sub))
+        except FileNotFoundError:
+            pass
+
+
+def _heartbeat(queue_dir, sub, worker_id, interval, stop_event, lost_event):
+    #This function renews a claim every interval seconds until stop_event
+    #is set. If another worker has taken the claim over, it sets lost_event
+    #and stops.
+    while not stop_event.wait(interval):
+        if not _owns(queue_dir, sub, worker_id):
+            logging.error('ERROR: lost the claim on {} to another worker!'.format(sub))
+            lost_event.set()
+            return
+        try:
+            os.utime(_lock_file(queue_dir, sub))
+        except OSError as err:
+            logging.error('ERROR renewing the claim on {}: {}'.format(sub, err))
+
+
+def queue_status(subject_list, queue_dir, lease_seconds=DEFAULT_LEASE, worker_id=None):
+    #This function returns the subjects of a manifest by state: 'done',
+    #'failed', 'running' (claimed with a live lease), 'expired' (claimed,
+    #lease run out) and 'waiting' (not started).
+    if worker_id is None:
+        worker_id = worker_name()
+    status = {'done': [], 'failed': [], 'running': [], 'expired': [], 'waiting': []}
+    for subject in subject_list:
+        sub = subject['sub']
+        if os.path.exists(os.path.join(queue_dir, 'done', '{}.json'.format(sub))):
+            status['done'].append(sub)
+        elif os.path.exists(os.path.join(queue_dir, 'failed', '{}.json'.format(sub))):
+            status['failed'].append(sub)
+        else:
+            age = _lock_age(queue_dir, sub, worker_id)
+            if age is None:
+                status['waiting'].append(sub)
+            elif age > lease_seconds:
+                status['expired'].append(sub)
+            else:
+                status['running'].append(sub)
+    return status
+
+
+def _log_progress(status, total):
+    logging.info('Queue progress: {}/{} done, {} failed, {} running, {} waiting, {} expired'.format(
+        len(status['done']), total, len(status['failed']), len(status['running']), len(status['waiting']), len(status['expired'])))
+
+
+def run_worker(manifest_file, queue_dir, output_root, lease_seconds=DEFAULT_LEASE, poll_seconds=None, worker_id=None, **subject_kwargs):
+    #This function is one queue worker: it claims subjects of the manifest
+    #that are neither done nor failed (nor held by a live claim), runs
+    #dtab.qa_the_subject on each with subject_kwargs, and records the
+    #result in the queue. It keeps polling every poll_seconds while other
+    #workers still hold claims, so the subjects of a crashed worker are
+    #picked up once their lease runs out, and returns when every subject is
+    #done or failed. A subject taken over from a dead claim resumes from
+    #the checkpoints its last worker left (see qa_the_dti). Each pass goes
+    #down the manifest once; done and failed subjects are remembered, so
+    #later passes only look at the subjects still open. Returns the
+    #subjects this worker finished and failed.
+    if worker_id is None:
+        worker_id = worker_name()
+    if poll_seconds is None:
+        poll_seconds = max(1.0, lease_seconds/10.0)
+    _make_queue(queue_dir)
+    subject_list = dtab.read_manifest(manifest_file)
+    logging.info('-------Starting: run_worker {}-------'.format(worker_id))
+
+    finished_list = []
+    failed_list = []
+    #Subjects found done or failed; neither state changes while workers run
+    settled = {'done': set(), 'failed': set()}
+    while True:
+        status = queue_status([x for x in subject_list if x['sub'] not in settled['done'] | settled['failed']], queue_dir, lease_seconds, worker_id)
+        for state in settled:
+            settled[state].update(status[state])
+            status[state] = sorted(settled[state])
+        _log_progress(status, len(subject_list))
+        open_subs = set(status['waiting']+status['expired'])
+        if not open_subs:
+            if not status['running']:
+                break
+            #Wait in case a running worker dies and its lease runs out
+            time.sleep(poll_seconds)
+            continue
+
+        for subject in subject_list:
+            sub = subject['sub']
+            if sub not in open_subs or not claim(queue_dir, sub, worker_id, lease_seconds):
+                continue
+            #The claim may have been made just after another worker finished it
+            finished_states = [x for x in settled if os.path.exists(os.path.join(queue_dir, x, '{}.json'.format(sub)))]
+            if finished_states:
+                release(queue_dir, sub, worker_id)
+                settled[finished_states[0]].add(sub)
+                continue
+
+            logging.info('Worker {} claimed {}.'.format(worker_id, sub))
+            stop_event = threading.Event()
+            lost_event = threading.Event()
+            heartbeat = threading.Thread(target=_heartbeat, args=(queue_dir, sub, worker_id, lease_seconds/4.0, stop_event, lost_event), daemon=True)
+            heartbeat.start()
+            try:
+                sub, metric_file, error = dtab.qa_the_subject(subject, output_root, **subject_kwargs)
+            finally:
+                stop_event.set()
+                heartbeat.join()
+
+            #The subject belongs to the worker that took the claim over; its
+            #result, marker and lock are that worker's to write
+            if lost_event.is_set() or not _owns(queue_dir, sub, worker_id):
+                logging.error('Worker {} lost the claim on {} while running it; dropping its result.'.format(worker_id, sub))
+                continue
+
+            record = {'worker': worker_id, 'finished': time.time()}
+            if error is None:
+                record['metric_file'] = metric_file
+                _write_json(os.path.join(queue_dir, 'done', '{}.json'.format(sub)), record)
+                finished_list.append(sub)
+                settled['done'].add(sub)
+            else:
+                record['error'] = error
+                _write_json(os.path.join(queue_dir, 'failed', '{}.json'.format(sub)), record)
+                failed_list.append(sub)
+                settled['failed'].add(sub)
+                logging.error('{} failed: {}'.format(sub, error))
+            release(queue_dir, sub, worker_id)
+            logging.info('Worker {} has finished {} subjects, {} failed.'.format(worker_id, len(finished_list), len(failed_list)))
+
+    logging.info('Worker {} finished {} subjects, {} failed.'.format(worker_id, len(finished_list), len(failed_list)))
+    logging.info('-------Done: run_worker {}-------'.format(worker_id))
+    return finished_list, failed_list
+
+
+def reset_failed(manifest_file, queue_dir):
+    #This function puts the failed subjects of a manifest back in the
+    #queue, so the next workers run them again.
+    for subject in dtab.read_manifest(manifest_file):
+        failed_file = os.path.join(queue_dir, 'failed', '{}.json'.format(subject['sub']))
+        if os.path.exists(failed_file):
+            logging.info('Putting {} back in the queue.'.format(subject['sub']))
+            try:
+                os.remove(failed_file)
+            except FileNotFoundError:
+                pass
+
+
+def collect_results(manifest_file, queue_dir, output_file, results_db=None, triage=None):
+    #This function writes the combined metrics table of every subject done
+    #in the queue, in manifest order, and returns it along with the list of
+    #subjects not done (failed or never finished). If results_db is set the
+    #table is exported from that results database (with the qa_path column
+    #if triage is not None), as qa_the_cohort does.
+    subject_list = dtab.read_manifest(manifest_file)
+    metric_file_list = []
+    missing_list = []
+    for subject in subject_list:
+        record = _read_json(os.path.join(queue_dir, 'done', '{}.json'.format(subject['sub'])))
+        if record is None:
+            missing_list.append(subject['sub'])
+        else:
+            metric_file_list.append(record['metric_file'])
+    #Every node may write the table at the end; each writes all of it
+    temp_fid, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_file)), prefix='.tmp_')
+    os.close(temp_fid)
+    if results_db is not None:
+        done_list = [x['sub'] for x in subject_list if x['sub'] not in missing_list]
+        dtar.export_csv(results_db, temp_file, done_list, qa_path=int(triage is not None))
+    else:
+        dtab.combine_metrics(metric_file_list, temp_file)
+    os.chmod(temp_file, 0o644)
+    os.replace(temp_file, output_file)
+    return output_file, missing_list
+
+
+def qa_the_queue(manifest_file, output_root, queue_dir, output_file=None, cores=None, cores_per_job=1, jobs=1,
+                 lease_seconds=DEFAULT_LEASE, retry_failed=0, **subject_kwargs):
+    #This function runs cores // cores_per_job queue workers on this node
+    #(see qa_the_cohort for the core budget) until the whole manifest is
+    #done or failed, then writes the combined metrics table. Start it on
+    #as many nodes as wanted with the same queue_dir on a shared file
+    #system. If retry_failed is set, subjects that failed before are put
+    #back in the queue first. subject_kwargs are handed to
+    #dtab.qa_the_subject. Returns the
+    #combined metrics file and the list of subjects that are not done.
+    logging.info('-------Starting: qa_the_queue-------')
+    if cores is None:
+        cores = os.cpu_count() or 1
+    if int(cores) < 1 or int(cores_per_job) < 1:
+        logging.error('ERROR: cores and cores_per_job must be at least 1!')
+        raise RuntimeError('qa_the_queue: bad core budget')
+    workers = max(1, int(cores) // int(cores_per_job))
+    jobs, threads = dtab.split_cores(cores_per_job, jobs)
+    subject_kwargs['jobs'] = jobs
+
+    if not os.path.exists(output_root):
+        logging.info('Creating output directory...')
+        os.makedirs(output_root, exist_ok=True)
+    if output_file is None:
+        output_file = os.path.join(output_root, 'cohort_QA_metrics.csv')
+    _make_queue(queue_dir)
+    if retry_failed:
+        reset_failed(manifest_file, queue_dir)
+
+    logging.info('Running {} queue workers with {} cores each...'.format(workers, cores_per_job))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=dtab.init_worker, initargs=(threads,)) as executor:
+        futures = [executor.submit(run_worker, manifest_file, queue_dir, output_root, lease_seconds=lease_seconds,
+                                   **subject_kwargs) for count in range(workers)]
+        for future in futures:
+            future.result()
+
+    output_file, missing_list = collect_results(manifest_file, queue_dir, output_file, results_db=subject_kwargs.get('results_db'),
+                                                triage=subject_kwargs.get('triage'))
+    logging.info('-------Done: qa_the_queue-------')
+    return output_file, missing_list
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+import sys
+import time
+import logging
+import sqlite3
+import argparse
+
+#Keeps the QA metrics of many subjects in one SQLite database that any
+#number of worker processes can write to at the same time, and exports
+#them in the layout of the per-subject metrics CSV files.
+
+
+#Columns of the QA metrics, in CSV order
+METRIC_COLUMNS = ['sub', 'shell', 'outcount_mean', 'outcount_max', 'maxdisp', 'tsnr_mean']
+
+#Which QA produced a row: 'full' (qa_the_dti) or 'triage' (the approximate
+#metrics of triage_the_dti, stored when the full QA was skipped)
+QA_PATH_COLUMN = 'qa_path'
+
+#Seconds a writer waits for another to finish before giving up
+BUSY_TIMEOUT = 600
+
+
+def open_results(db_file):
+    #This function opens (creating it if needed) a results database and
+    #returns the connection. The database is in write-ahead-log mode, so
+    #readers never block writers and writers only queue behind each other
+    #for the length of one commit. WAL needs shared memory between the
+    #writers, so the database must be on a local disk, not NFS.
+    connection = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    with connection:
+        connection.execute('''CREATE TABLE IF NOT EXISTS metrics (
+                                  sub TEXT NOT NULL,
+                                  shell TEXT NOT NULL,
+                                  outcount_mean REAL,
+                                  outcount_max INTEGER,
+                                  maxdisp REAL,
+                                  tsnr_mean REAL,
+                                  updated REAL,
+                                  qa_path TEXT NOT NULL DEFAULT 'full',
+                                  PRIMARY KEY (sub, shell))''')
+        connection.execute('CREATE INDEX IF NOT EXISTS metrics_shell ON metrics (shell)')
+        #Databases made before the qa_path column only hold full QA rows
+        if QA_PATH_COLUMN not in [x[1] for x in connection.execute('PRAGMA table_info(metrics)')]:
+            connection.execute("ALTER TABLE metrics ADD COLUMN qa_path TEXT NOT NULL DEFAULT 'full'")
+    return connection
+
+
+def _plain(value):
+    #sqlite3 cannot store NumPy scalars, only the Python numbers they hold
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def store_metrics(db_file, sub, metric_dict, qa_path='full'):
+    #This function writes the metrics of every shell of a subject (a
+    #dictionary of shell label to metrics, as made by qa_the_dti) in one
+    #transaction, replacing any earlier rows for the same subject and shell.
+    #qa_path records which QA produced them ('full' or 'triage').
+    logging.info('Storing metrics of {} in: {}'.format(sub, db_file))
+    rows = []
+    for shell_label in sorted(metric_dict.keys()):
+        shell_metrics = metric_dict[shell_label]
+        rows.append(tuple([str(sub), str(shell_label)]+[_plain(shell_metrics[x]) for x in METRIC_COLUMNS[2:]]+[time.time(), qa_path]))
+    columns = METRIC_COLUMNS+['updated', QA_PATH_COLUMN]
+    connection = open_results(db_file)
+    try:
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO metrics ({}) VALUES ({})'.format(', '.join(columns), ', '.join(['?']*len(columns))), rows)
+    finally:
+        connection.close()
+    return len(rows)
+
+
+def read_metrics(db_file, sub_list=None, qa_path=0):
+    #This function returns the metric rows (tuples in METRIC_COLUMNS order,
+    #plus the qa_path column if qa_path is set) of the subjects in
+    #sub_list, in that order, or of every subject sorted by subject if
+    #sub_list is None. Rows of one subject are in shell order.
+    columns = METRIC_COLUMNS+[QA_PATH_COLUMN] if qa_path else METRIC_COLUMNS
+    connection = open_results(db_file)
+    try:
+        query = 'SELECT {} FROM metrics'.format(', '.join(columns))
+        if sub_list is None:
+            return connection.execute(query+' ORDER BY sub, shell').fetchall()
+        rows = []
+        for sub in sub_list:
+            rows.extend(connection.execute(query+' WHERE sub = ? ORDER BY shell', (str(sub),)).fetchall())
+        return rows
+    finally:
+        connection.close()
+
+
+def export_csv(db_file, output_file, sub_list=None, qa_path=0):
+    #This function writes metric rows (see read_metrics) to a CSV file with
+    #the same columns as the per-subject metrics files, or as the triage
+    #metrics files (with the qa_path column) if qa_path is set.
+    logging.info('Exporting metrics from {} to: {}'.format(db_file, output_file))
+    rows = read_metrics(db_file, sub_list, qa_path=qa_path)
+    columns = METRIC_COLUMNS+[QA_PATH_COLUMN] if qa_path else METRIC_COLUMNS
+    with open(output_file, 'w') as fid:
+        fid.write(','.join(columns)+'\n')
+        for row in rows:
+            fid.write(','.join([str(x) for x in row])+'\n')
+    return output_file
+
+
+#Set up argument parser and help dialogue
+parser=argparse.ArgumentParser(
+    description='''Export the QA metrics kept in a results database to a CSV file.''',
+    usage='python3 dti_qa_results.py db_file output_file [--subs sub1,sub2,...] [--qa-path]')
+parser.add_argument('--subs', help='comma-separated subjects to export, in this order (default: all, sorted)', default=None)
+parser.add_argument('--qa-path', help="add the qa_path column ('full' or 'triage'), as in the metrics files of --triage runs", action='store_true')
+parser.add_argument('db_file', help='results database written with --results-db')
+parser.add_argument('output_file', help='CSV file to write')
+
+
+def main(args):
+
+    #Set basic logger
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+
+    sub_list = None
+    if args.subs is not None:
+        sub_list = [x for x in args.subs.split(',') if x != '']
+    export_csv(args.db_file, args.output_file, sub_list, qa_path=int(args.qa_path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import glob
+import math
+import time
+import logging
+import tempfile
+import argparse
+import statistics
+import numpy
+import dti_qa_lib as dtal
+import dti_qa_native as dtan
+import dti_qa_results as dtar
+import dti_qa_api as dtai
+
+#Runs the QA while the DWI series is being acquired: each volume is folded
+#into its shell's running statistics as soon as it arrives, and
+#provisional metrics of that shell are available straight away. Volumes
+#come in through add_volume, or watch_directory picks them up as 3D NIfTI
+#files (one per volume, in acquisition order by file name) appear in a
+#directory.
+#   TSNR      running mean and variance (Welford) of every mask voxel
+#   outliers  each new volume is tested against the median and MAD of its
+#             voxels over the shell so far (3dToutcount's test), which costs
+#             one pass over the mask voxels. The median and MAD, and the
+#             counts of the earlier volumes, are worked out again over
+#             every volume seen whenever the shell has doubled in size
+#             since the last time, and once more when it is done, which
+#             gives the same counts as the full QA. A shell of n volumes
+#             so costs a few times n volumes' worth of median work in all,
+#             not the n*n/2 of recounting the shell at every volume.
+#   motion    each volume registered to the first volume of its shell (the
+#             shell mean is not known until the end), so maxdisp is
+#             provisional and may differ from the full QA's
+
+
+#Columns of the provisional metrics file
+STREAM_COLUMNS = dtar.METRIC_COLUMNS+['volumes_seen', 'volumes_total']
+
+
+def open_stream(mask_data, shell_index, zooms):
+    #This function sets up the running QA of one DWI series and returns a
+    #dictionary holding its state. mask_data is a 3D array or nibabel image
+    #(nonzero is in), shell_index one label per volume that will arrive (0
+    #for b=0 volumes, 1 for the first shell, etc.) and zooms the voxel size
+    #in mm.
+    mask = dtai.as_mask(mask_data)
+    index = dtan.mask_index(mask)
+    volume_lists = dtai.shell_volume_lists(shell_index)
+    stream = {'mask': mask, 'index': index, 'zooms': tuple(zooms[:3]), 'n_volumes': len(shell_index),
+              'volume_to_shell': {}, 'shells': {}}
+    for shell_label, volume_list in volume_lists.items():
+        for position, volume in enumerate(volume_list):
+            stream['volume_to_shell'][volume] = (shell_label, position)
+        stream['shells'][shell_label] = {
+            'volumes': volume_list,
+            'seen': numpy.zeros(len(volume_list), dtype=bool),
+            'mean': numpy.zeros(index.size, dtype=numpy.float64),
+            'm2': numpy.zeros(index.size, dtype=numpy.float64),
+            'masked_data': numpy.zeros((index.size, len(volume_list)), dtype=numpy.float32),
+            'outcount_array': numpy.zeros(len(volume_list), dtype=int),
+            'outlier_median': None,
+            'outlier_mad': None,
+            'outliers_counted_at': 0,
+            'motion_setup': None,
+            'maxdisp_array': numpy.zeros(len(volume_list), dtype=numpy.float64),
+            'metrics': None,
+            }
+    return stream
+
+
+def _update_outliers(shell, position):
+    #This function updates the outlier counts of a shell for the volume
+    #just added at position (see the notes at the top).
+    count = int(shell['seen'].sum())
+    if count < 3:
+        return
+    if shell['outlier_median'] is None or count >= 2*shell['outliers_counted_at'] or shell['seen'].all():
+        #Exact: every volume seen so far against their median and MAD
+        seen_data = shell['masked_data'][:, shell['seen']]
+        shell['outcount_array'][shell['seen']] = dtan.outcount(seen_data)[2]
+        shell['outlier_median'] = numpy.median(seen_data, axis=1)
+        shell['outlier_mad'] = numpy.median(numpy.abs(seen_data-shell['outlier_median'][:, None]), axis=1)
+        shell['outliers_counted_at'] = count
+        return
+    #Provisional: only the new volume, against the last median and MAD
+    alpha = statistics.NormalDist().inv_cdf(1.0-0.001/count)*math.sqrt(math.pi/2.0)
+    deviation = numpy.abs(shell['masked_data'][:, position]-shell['outlier_median'])
+    mad = shell['outlier_mad']
+    shell['outcount_array'][position] = int(((deviation > alpha*mad) & (mad > 0)).sum())
+
+
+def _shell_metrics(shell):
+    #This function works out the provisional metrics of a shell from the
+    #volumes it has seen so far. Metrics that need more volumes are None.
+    count = int(shell['seen'].sum())
+    metrics = {'outcount_mean': None, 'outcount_max': None, 'maxdisp': None, 'tsnr_mean': None,
+               'volumes_seen': count, 'volumes_total': len(shell['volumes'])}
+    if count >= 2:
+        stdev = numpy.sqrt(shell['m2']/(count-1))
+        masked_tsnr = numpy.zeros(stdev.size, dtype=numpy.float64)
+        good = stdev > 0
+        masked_tsnr[good] = numpy.abs(shell['mean'][good])/stdev[good]
+        masked_tsnr = masked_tsnr.astype(numpy.float32)
+        nonzero = masked_tsnr[masked_tsnr != 0]
+        metrics['tsnr_mean'] = float(nonzero.mean(dtype=numpy.float64)) if nonzero.size else 0.0
+        metrics['maxdisp'] = float(shell['maxdisp_array'][shell['seen']].max())
+    if count >= 3:
+        outcount_array = shell['outcount_array'][shell['seen']]
+        metrics['outcount_mean'] = float(outcount_array.mean())
+        metrics['outcount_max'] = int(outcount_array.max())
+    return metrics
+
+
+def add_volume(stream, volume, data):
+    #This function adds volume number volume (a 3D array) to the running QA
+    #of stream and returns the label and updated provisional metrics of its
+    #shell, or (None, None) for a b=0 volume.
+    if volume not in stream['volume_to_shell']:
+        return None, None
+    shell_label, position = stream['volume_to_shell'][volume]
+    shell = stream['shells'][shell_label]
+    if shell['seen'][position]:
+        logging.info('Volume {} was already added; ignoring it.'.format(volume))
+        return shell_label, shell['metrics']
+    data = numpy.asarray(data)
+    if tuple(data.shape) != tuple(stream['mask'].shape):
+        logging.error('ERROR: volume {} has shape {}, the mask {}!'.format(volume, data.shape, stream['mask'].shape))
+        raise RuntimeError('add_volume: bad volume shape')
+
+    #Welford update of the running mean and variance of the mask voxels
+    masked = dtan.gather_masked(data, stream['index'])
+    count = int(shell['seen'].sum())+1
+    delta = masked-shell['mean']
+    shell['mean'] += delta/count
+    shell['m2'] += delta*(masked-shell['mean'])
+    shell['masked_data'][:, position] = masked
+    shell['seen'][position] = True
+
+    #The first volume of the shell is the registration base
+    if shell['motion_setup'] is None:
+        shell['motion_setup'] = dtan.motion_setup(data.shape, stream['zooms'], numpy.asarray(data, dtype=numpy.float32), stream['mask'])
+    else:
+        params, shell['maxdisp_array'][position] = dtan.register_volume(shell['motion_setup'], data)
+
+    _update_outliers(shell, position)
+    shell['metrics'] = _shell_metrics(shell)
+    return shell_label, shell['metrics']
+
+
+def stream_metrics(stream):
+    #This function returns the provisional metrics of every shell that has
+    #seen at least one volume, as a dictionary of shell label to metrics.
+    return {x: stream['shells'][x]['metrics'] for x in sorted(stream['shells'].keys()) if stream['shells'][x]['metrics'] is not None}
+
+
+def stream_done(stream):
+    #This function returns whether every shell has seen all its volumes.
+    return all([x['seen'].all() for x in stream['shells'].values()])
+
+
+def write_stream_metrics(stream, sub, output_file):
+    #This function writes the provisional metrics of every shell to a CSV
+    #file (the metrics columns plus how many volumes each shell has seen).
+    #The file is replaced in one step, so a reader never sees half of it.
+    lines = [','.join(STREAM_COLUMNS)]
+    for shell_label, metrics in stream_metrics(stream).items():
+        values = [sub, shell_label]+[metrics[x] for x in STREAM_COLUMNS[2:]]
+        lines.append(','.join(['' if x is None else str(x) for x in values]))
+    temp_fid, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_file)), prefix='.tmp_')
+    with os.fdopen(temp_fid, 'w') as fid:
+        fid.write('\n'.join(lines)+'\n')
+    os.chmod(temp_file, 0o644)
+    os.replace(temp_file, output_file)
+    return output_file
+
+
+def _settled_files(incoming_dir, pattern, taken, settle_seconds):
+    #This function lists the new files in incoming_dir, sorted by name, up
+    #to the first one that may still be being written (changed in the last
+    #settle_seconds), so volumes are never taken out of order.
+    file_list = []
+    now = time.time()
+    for input_file in sorted(glob.glob(os.path.join(incoming_dir, pattern))):
+        if input_file in taken:
+            continue
+        try:
+            if now-os.stat(input_file).st_mtime < settle_seconds:
+                break
+        except OSError:
+            break
+        file_list.append(input_file)
+    return file_list
+
+
+def watch_directory(sub, incoming_dir, mask_image, shell_index_file, output_file, pattern='*.nii*', poll_seconds=1.0, settle_seconds=2.0, idle_timeout=600.0, callback=None):
+    #This function watches incoming_dir for the volumes of a DWI series
+    #being acquired, one 3D NIfTI file per volume (the n-th file by name
+    #is volume n), and adds each to the running QA as soon as it has not
+    #changed for settle_seconds. After every volume the provisional
+    #metrics are written to output_file and, if given, callback(shell
+    #label, metrics) is called. Stops when every volume in the shell index
+    #file has arrived, or when no new volume has arrived for idle_timeout
+    #seconds. Returns the provisional metrics of every shell.
+    logging.info('-------Starting: watch_directory-------')
+    if not os.path.isdir(incoming_dir):
+        logging.error('ERROR: incoming_dir cannot be found: {}'.format(incoming_dir))
+        raise RuntimeError('watch_directory: incoming_dir not found')
+    shell_index = dtal.read_shell_index(shell_index_file)
+    mask_img = dtan.load_image(mask_image)
+    stream = open_stream(mask_img, shell_index, mask_img.header.get_zooms())
+    logging.info('Waiting for {} volumes in: {}'.format(stream['n_volumes'], incoming_dir))
+
+    taken = set()
+    volume = 0
+    last_arrival = time.time()
+    while volume < stream['n_volumes']:
+        file_list = _settled_files(incoming_dir, pattern, taken, settle_seconds)
+        if not file_list:
+            if time.time()-last_arrival > idle_timeout:
+                logging.error('No new volume for {} seconds; stopping after {} of {} volumes.'.format(idle_timeout, volume, stream['n_volumes']))
+                break
+            time.sleep(poll_seconds)
+            continue
+        for input_file in file_list:
+            if volume >= stream['n_volumes']:
+                logging.info('More volumes than in the shell index file; ignoring: {}'.format(input_file))
+                break
+            data = dtan.load_image(input_file).get_fdata(dtype=numpy.float32)
+            data = data.reshape(data.shape[:3])
+            shell_label, metrics = add_volume(stream, volume, data)
+            taken.add(input_file)
+            if shell_label is not None:
+                logging.info('Volume {} (shell {}): {}'.format(volume, shell_label, metrics))
+                write_stream_metrics(stream, sub, output_file)
+                if callback is not None:
+                    callback(shell_label, metrics)
+            volume += 1
+        last_arrival = time.time()
+
+    logging.info('-------Done: watch_directory-------')
+    return stream_metrics(stream)
+
+
+#Set up argument parser and help dialogue
+parser=argparse.ArgumentParser(
+    description='''Run the DWI QA while a series is acquired, updating the metrics of each shell as its volumes arrive.''',
+    usage='python3 dti_qa_stream.py subID incoming_dir mask_image shell_index_file output_file [--pattern GLOB] [--poll SECONDS] [--settle SECONDS] [--idle-timeout SECONDS]')
+parser.add_argument('--pattern', help='file names of the volumes in incoming_dir (default *.nii*)', default='*.nii*')
+parser.add_argument('--poll', help='seconds between looks at incoming_dir (default 1)', type=float, default=1.0)
+parser.add_argument('--settle', help='seconds a file must be unchanged before it is read (default 2)', type=float, default=2.0)
+parser.add_argument('--idle-timeout', help='stop if no volume has arrived for this many seconds (default 600)', type=float, default=600.0)
+parser.add_argument('subID', help='Subject ID associated with DTI data')
+parser.add_argument('incoming_dir', help='directory the 3D volumes are written to, one .nii or .nii.gz per volume')
+parser.add_argument('mask_image', help='path and filename of a 3D mask .nii or .nii.gz image')
+parser.add_argument('shell_index_file', help='shell index of every volume that will arrive, as for dti_qa_exe.py')
+parser.add_argument('output_file', help='CSV file the provisional metrics are written to after each volume')
+
+
+def main(args):
+
+    #Set basic logger
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+
+    try:
+        watch_directory(str(args.subID), args.incoming_dir, args.mask_image, args.shell_index_file, args.output_file,
+                        pattern=args.pattern, poll_seconds=args.poll, settle_seconds=args.settle, idle_timeout=args.idle_timeout)
+    except Exception as err:
+        logging.error('Something went wrong: {}'.format(err))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import logging
+import resource
+import threading
+import contextlib
+
+#The self fields of a record (cpu_self_s, peak_rss_self_kb) and its bytes
+#read and written are read from counters of the whole process, so when
+#stages run at the same time on threads (stage_jobs > 1) each record also
+#holds what the others did meanwhile; such records are marked overlapped.
+#The children fields are summed over the AFNI children each stage itself
+#waited for (see communicate), so they hold however stages overlap.
+TIMING_NOTES = {
+    'cpu_children_s': 'CPU time of the child processes the stage ran itself',
+    'peak_rss_children_kb': 'largest peak RSS of those child processes',
+    'children_blocks_read': 'file system blocks read by those child processes',
+    'children_blocks_written': 'file system blocks written by those child processes',
+    'cpu_self_s': 'CPU time of the whole process while the stage ran',
+    'peak_rss_self_kb': 'peak RSS of the whole process so far',
+    'bytes_read': 'bytes read by the whole process (and its reaped children) while the stage ran',
+    'bytes_written': 'bytes written by the whole process (and its reaped children) while the stage ran',
+    'overlapped': 'true if another stage ran on another thread of the same process at the same time, so the whole-process fields are shared with it',
+    }
+
+#Stages being timed in this process, and those of the current thread
+_active_stages = []
+_active_lock = threading.Lock()
+_thread_stages = threading.local()
+
+
+def _read_proc_io():
+    #This function returns the bytes read and written by this process so
+    #far, including children it has already waited for, from /proc/self/io
+    #(Linux only). Returns (None, None) where that file is not available.
+    try:
+        with open('/proc/self/io', 'r') as fid:
+            contents = fid.read()
+    except OSError:
+        return None, None
+    counters = {}
+    for line in contents.splitlines():
+        name, value = line.split(':')
+        counters[name.strip()] = int(value)
+    return counters.get('rchar'), counters.get('wchar')
+
+
+def snapshot():
+    #This function takes one reading of the clocks and counters.
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    bytes_read, bytes_written = _read_proc_io()
+    return {
+        'wall': time.perf_counter(),
+        'cpu_self': self_usage.ru_utime+self_usage.ru_stime,
+        'cpu_children': child_usage.ru_utime+child_usage.ru_stime,
+        'maxrss_self': self_usage.ru_maxrss,
+        'maxrss_children': child_usage.ru_maxrss,
+        'bytes_read': bytes_read,
+        'bytes_written': bytes_written,
+        }
+
+
+def make_record(stage, shell, start, end):
+    #This function turns two snapshots into a timing record. Its children
+    #fields cover every child reaped in between, which is right for a whole
+    #run; stage_timer puts those of the stage's own children in their place.
+    record = {'stage': stage, 'shell': shell, 'pid': os.getpid()}
+    record['wall_s'] = end['wall']-start['wall']
+    record['cpu_self_s'] = end['cpu_self']-start['cpu_self']
+    record['cpu_children_s'] = end['cpu_children']-start['cpu_children']
+    record['peak_rss_self_kb'] = end['maxrss_self']
+    record['peak_rss_children_kb'] = end['maxrss_children']
+    if start['bytes_read'] is not None:
+        record['bytes_read'] = end['bytes_read']-start['bytes_read']
+        record['bytes_written'] = end['bytes_written']-start['bytes_written']
+    else:
+        record['bytes_read'] = None
+        record['bytes_written'] = None
+    return record
+
+
+def _add_child_usage(usage):
+    #This function adds the resource usage of a reaped child to every stage
+    #being timed on this thread.
+    for state in getattr(_thread_stages, 'stack', []):
+        state['cpu_children_s'] += usage.ru_utime+usage.ru_stime
+        state['peak_rss_children_kb'] = max(state['peak_rss_children_kb'], usage.ru_maxrss)
+        state['children_blocks_read'] += usage.ru_inblock
+        state['children_blocks_written'] += usage.ru_oublock
+
+
+def communicate(proc):
+    #This function does what proc.communicate() does for a child started
+    #with only stdout piped, but reaps the child with os.wait4 so its own
+    #resource usage goes to the stages timing it (see stage_timer).
+    if not hasattr(os, 'wait4') or proc.stdin is not None or proc.stderr is not None:
+        return proc.communicate()
+    call_output = None
+    if proc.stdout is not None:
+        call_output = proc.stdout.read()
+        proc.stdout.close()
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    _add_child_usage(usage)
+    return call_output, None
+
+
+@contextlib.contextmanager
+def stage_timer(timing_list, stage, shell=None):
+    #This context manager measures the code it wraps and appends a record
+    #to timing_list: wall time, CPU time of this process, the peak RSS of
+    #this process so far (kB), the bytes read and written, and the CPU
+    #time, peak RSS and blocks read and written of the child processes
+    #(e.g. AFNI) the stage ran through communicate. See TIMING_NOTES for
+    #which fields are shared with stages running at the same time. A
+    #dictionary is yielded so the stage can add to its record (e.g.
+    #'cached': True).
+    extra = {}
+    state = {'thread': threading.get_ident(), 'overlapped': False, 'cpu_children_s': 0.0, 'peak_rss_children_kb': 0,
+             'children_blocks_read': 0, 'children_blocks_written': 0}
+    with _active_lock:
+        for other in _active_stages:
+            if other['thread'] != state['thread']:
+                other['overlapped'] = True
+                state['overlapped'] = True
+        _active_stages.append(state)
+    if not hasattr(_thread_stages, 'stack'):
+        _thread_stages.stack = []
+    _thread_stages.stack.append(state)
+    start = snapshot()
+    try:
+        yield extra
+    finally:
+        end = snapshot()
+        _thread_stages.stack.remove(state)
+        with _active_lock:
+            _active_stages.remove(state)
+        record = make_record(stage, shell, start, end)
+        for key in ['overlapped', 'cpu_children_s', 'peak_rss_children_kb', 'children_blocks_read', 'children_blocks_written']:
+            record[key] = state[key]
+        record.update(extra)
+        timing_list.append(record)
+        logging.info('Timing: {} {} took {:.2f} s'.format(stage, '' if shell is None else 'shell '+str(shell), record['wall_s']))
+
+
+def write_timing(timing_list, output_file, run_info=None):
+    #This function writes the timing records of a run, with totals per
+    #stage and what each field measures (TIMING_NOTES), to a JSON sidecar
+    #file. The totals of the whole-process fields count time shared by
+    #overlapped stages more than once.
+    stage_totals = {}
+    for record in timing_list:
+        totals = stage_totals.setdefault(record['stage'], {'count': 0, 'wall_s': 0.0, 'cpu_self_s': 0.0, 'cpu_children_s': 0.0, 'bytes_read': 0, 'bytes_written': 0})
+        totals['count'] += 1
+        for key in ['wall_s', 'cpu_self_s', 'cpu_children_s', 'bytes_read', 'bytes_written']:
+            if record[key] is not None:
+                totals[key] += record[key]
+    contents = {
+        'run': run_info or {},
+        'notes': TIMING_NOTES,
+        'overlapped_stages': len([x for x in timing_list if x.get('overlapped')]),
+        'stage_totals': stage_totals,
+        'stages': timing_list,
+        }
+    logging.info('Writing timing file: {}'.format(output_file))
+    with open(output_file, 'w') as fid:
+        json.dump(contents, fid, indent=1)
+    return output_file
@@ -0,0 +1,199 @@
+import os
+import contextlib
+import logging
+import numpy
+import dti_qa_lib as dtal
+import dti_qa_native as dtan
+import dti_qa_results as dtar
+import dti_qa_api as dtai
+
+#Screens a subject with cheap, approximate metrics before the full QA,
+#which is only run if a shell's approximate metrics are past, or close to,
+#a threshold. The approximations come from a single pass through the DWI
+#data:
+#   TSNR and outliers  from a random sample of the mask voxels; the outlier
+#                      counts are scaled up to the whole mask
+#   motion             registration of the block-averaged volumes to their
+#                      block-averaged mean, at that resolution only
+
+
+#Header line of the metrics CSV files written in triage mode: the metrics
+#plus which path produced each row ('triage' or 'full')
+TRIAGE_HEADER = dtal.METRIC_HEADER+',qa_path'
+
+#Thresholds past which a subject needs the full QA. maxdisp is in mm and
+#outcount_mean and outcount_max are fractions of the mask voxels (the
+#counts grow with the mask); a shell is past the tsnr_mean threshold when
+#it is below it and past the others when above them.
+DEFAULT_THRESHOLDS = {'maxdisp': 2.0, 'outcount_max': 0.05, 'tsnr_mean': 5.0}
+
+#Metrics for which lower values are worse
+LOWER_IS_WORSE = ['tsnr_mean']
+
+#Metrics whose thresholds are fractions of the mask voxels
+FRACTION_METRICS = ['outcount_mean', 'outcount_max']
+
+#Subjects within this fraction of a threshold also get the full QA, since
+#the approximate metrics may be on the wrong side of it
+DEFAULT_MARGIN = 0.2
+
+
+def parse_threshold(threshold_string):
+    #This function reads a threshold given as metric=value, e.g. maxdisp=1.5.
+    metric, separator, value = threshold_string.partition('=')
+    metric = metric.strip()
+    if separator == '' or metric not in dtar.METRIC_COLUMNS[2:]:
+        raise ValueError('threshold must be metric=value with metric one of: {}'.format(', '.join(dtar.METRIC_COLUMNS[2:])))
+    return metric, float(value)
+
+
+def triage_options(threshold_list=None, margin=DEFAULT_MARGIN):
+    #This function returns the triage keyword arguments for a list of
+    #(metric, threshold) pairs (e.g. from parse_threshold), which replace
+    #the matching DEFAULT_THRESHOLDS, and a margin.
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    thresholds.update(dict(threshold_list or []))
+    return {'thresholds': thresholds, 'margin': float(margin)}
+
+
+def approximate_metrics(dti_image, mask_image, shell_volume_lists, factor=2, voxel_fraction=0.1, min_voxels=1000, seed=0):
+    #This function computes approximate metrics of every shell in a single
+    #pass through the DWI data, keeping only a random voxel_fraction (at
+    #least min_voxels) of the mask voxels and each volume block-averaged by
+    #factor. Returns a dictionary of shell label to metrics, with the same
+    #keys as qa_the_dti's, and the number of mask voxels.
+    logging.info('-------Starting: approximate_metrics-------')
+    dti_img = dtan.load_image(dti_image)
+    mask_data = dtan.load_mask(mask_image)
+    index = dtan.mask_index(mask_data)
+    if index.size == 0:
+        logging.error('ERROR: mask_image is empty: {}'.format(mask_image))
+        raise RuntimeError('approximate_metrics: empty mask')
+    rng = numpy.random.default_rng(seed)
+    n_sample = min(index.size, max(int(min_voxels), int(round(index.size*voxel_fraction))))
+    sample_index = index[numpy.sort(rng.choice(index.size, size=n_sample, replace=False))]
+    logging.info('Sampling {} of {} mask voxels; block-averaging by {}.'.format(n_sample, index.size, factor))
+
+    small_mask = dtan.downsample(mask_data.astype(numpy.float64), factor) > 0.5
+    volume_to_shell = {}
+    shell_data = {}
+    for shell_label, volume_list in shell_volume_lists.items():
+        for position, volume in enumerate(volume_list):
+            volume_to_shell[volume] = (shell_label, position)
+        shell_data[shell_label] = {
+            'sampled': numpy.zeros((n_sample, len(volume_list)), dtype=numpy.float32),
+            'small': numpy.zeros(small_mask.shape+(len(volume_list),), dtype=numpy.float32),
+            }
+    with contextlib.closing(dtan.iter_volumes(dti_img, list(volume_to_shell.keys()))) as volume_iter:
+        for volume, data in volume_iter:
+            shell_label, position = volume_to_shell[volume]
+            shell_data[shell_label]['sampled'][:, position] = dtan.gather_masked(data, sample_index)
+            shell_data[shell_label]['small'][..., position] = dtan.downsample(data, factor)
+
+    zooms = numpy.asarray(dti_img.header.get_zooms()[:3], dtype=numpy.float64)*factor
+    metric_dict = {}
+    for shell_label, volume_list in shell_volume_lists.items():
+        sampled = shell_data[shell_label]['sampled']
+        small = shell_data[shell_label]['small']
+        stdev = sampled.std(axis=1, ddof=1, dtype=numpy.float64)
+        sampled_tsnr = numpy.zeros(n_sample, dtype=numpy.float64)
+        good = stdev > 0
+        sampled_tsnr[good] = numpy.abs(sampled.mean(axis=1, dtype=numpy.float64)[good])/stdev[good]
+        nonzero = sampled_tsnr[sampled_tsnr != 0]
+        outcount_mean, outcount_max, outcount_array = dtan.outcount(sampled)
+        params_array, maxdisp_array = dtan.estimate_motion(dtan.iter_array_volumes(small, range(len(volume_list))), len(volume_list),
+                                                           small_mask.shape, zooms, small.mean(axis=3), small_mask, levels=(1,))
+        metric_dict[shell_label] = {
+            'outcount_mean': float(outcount_mean)*index.size/n_sample,
+            'outcount_max': int(round(float(outcount_max)*index.size/n_sample)),
+            'maxdisp': float(maxdisp_array.max()),
+            'tsnr_mean': float(nonzero.mean()) if nonzero.size else 0.0,
+            }
+    logging.info('-------Done: approximate_metrics-------')
+    return metric_dict, int(index.size)
+
+
+def check_thresholds(metric_dict, mask_voxels, thresholds=None, margin=DEFAULT_MARGIN):
+    #This function returns a list of the reasons (as text) why metrics need
+    #the full QA: every shell metric that is past its threshold or within
+    #margin (a fraction of the threshold) of it. An empty list means none.
+    if thresholds is None:
+        thresholds = DEFAULT_THRESHOLDS
+    reason_list = []
+    for shell_label in sorted(metric_dict.keys()):
+        for metric, threshold in sorted(thresholds.items()):
+            value = metric_dict[shell_label][metric]
+            if metric in FRACTION_METRICS:
+                value = value/float(mask_voxels)
+            if metric in LOWER_IS_WORSE:
+                flagged = value <= threshold*(1.0+margin)
+            else:
+                flagged = value >= threshold*(1.0-margin)
+            if flagged:
+                reason_list.append('shell {} {} {:.4g} is near or past {:.4g}'.format(shell_label, metric, value, threshold))
+    return reason_list
+
+
+def _write_metrics(sub, metric_dict, qa_path, output_file):
+    #This function writes metrics in the triage layout (TRIAGE_HEADER).
+    with open(output_file, 'w') as fid:
+        fid.write(TRIAGE_HEADER+'\n')
+        for key in sorted(metric_dict.keys()):
+            metrics = metric_dict[key]
+            fid.write('{},{},{},{},{},{},{}\n'.format(sub, key, metrics['outcount_mean'], metrics['outcount_max'], metrics['maxdisp'], metrics['tsnr_mean'], qa_path))
+
+
+def triage_the_dti(sub, dti_image, mask_image, shell_index_file, output_dir, overwrite, thresholds=None, margin=DEFAULT_MARGIN,
+                   factor=2, voxel_fraction=0.1, results_db=None, **qa_kwargs):
+    #This function computes approximate metrics of every shell (see
+    #approximate_metrics) and, only if check_thresholds finds one past or
+    #within margin of its threshold, runs qa_the_dti with qa_kwargs. The
+    #metrics CSV (in the same place as qa_the_dti's) gets a qa_path column
+    #saying whether its rows are the approximate ('triage') or the full
+    #('full') metrics. thresholds maps metric names to thresholds (see
+    #DEFAULT_THRESHOLDS, which is used if None). If results_db is set the
+    #rows are stored there with the same qa_path. When the full QA is
+    #skipped, so are its images and the regional CSV of an atlas_image in
+    #qa_kwargs. Returns the path of the metrics CSV.
+    logging.info('-------Starting: triage_the_dti-------')
+    for image in [dti_image, mask_image, shell_index_file]:
+        if not os.path.exists(image):
+            logging.error('ERROR: input cannot be found: {}'.format(image))
+            raise RuntimeError('triage_the_dti: input not found!')
+    output_file = dtal.metrics_file(dti_image, output_dir)
+    if os.path.exists(output_file) and not overwrite:
+        logging.error('ERROR: output_file exists and overwrite not set!')
+        raise RuntimeError('output_file exists and overwrite not set!')
+
+    shell_volume_lists = dtai.shell_volume_lists(dtal.read_shell_index(shell_index_file))
+    metric_dict, mask_voxels = approximate_metrics(dti_image, mask_image, shell_volume_lists, factor=factor, voxel_fraction=voxel_fraction)
+    reason_list = check_thresholds(metric_dict, mask_voxels, thresholds=thresholds, margin=margin)
+
+    if reason_list:
+        for reason in reason_list:
+            logging.info('Running the full QA: {}'.format(reason))
+        dtal.qa_the_dti(sub, dti_image, mask_image, shell_index_file, output_dir, overwrite, results_db=results_db, **qa_kwargs)
+        #Read the full metrics back and add the qa_path column
+        metric_dict = {}
+        with open(output_file, 'r') as fid:
+            for line in fid.read().splitlines()[1:]:
+                if line == '':
+                    continue
+                values = dict(zip(dtar.METRIC_COLUMNS, line.split(',')))
+                metric_dict[values['shell']] = values
+        qa_path = 'full'
+    else:
+        logging.info('Every approximate metric is clear of its threshold; skipping the full QA.')
+        if not os.path.exists(output_dir):
+            logging.info('Creating output directory...')
+            os.makedirs(output_dir)
+        if qa_kwargs.get('atlas_image') is not None:
+            logging.info('Skipping the regional stats of the atlas, which only the full QA computes.')
+        if results_db is not None:
+            dtar.store_metrics(results_db, sub, metric_dict, qa_path='triage')
+        qa_path = 'triage'
+
+    logging.info('Writing output file: {}'.format(output_file))
+    _write_metrics(sub, metric_dict, qa_path, output_file)
+    logging.info('-------Done: triage_the_dti-------')
+    return output_file